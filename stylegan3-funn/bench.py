@@ -0,0 +1,211 @@
+# Copyright (c) 2021, NVIDIA CORPORATION & AFFILIATES.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+"""Micro-benchmarks for the performance-critical parts of training and inference."""
+
+import copy
+import json
+import time
+import contextlib
+import click
+import numpy as np
+import torch
+
+from torch_utils import gen_utils
+from torch_utils.ops import bias_act
+from torch_utils.ops import filtered_lrelu
+from torch_utils.ops import upfirdn2d
+from training import augment
+
+#----------------------------------------------------------------------------
+
+def parse_comma_separated_list(s):
+    if isinstance(s, list):
+        return s
+    if s is None or s.lower() == 'none' or s == '':
+        return []
+    return s.split(',')
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+# Average time in seconds of fn(), after warmup_iters untimed calls.
+def _time_fn(fn, device, num_iters, warmup_iters):
+    for _ in range(warmup_iters):
+        fn()
+    _sync(device)
+    t0 = time.time()
+    for _ in range(num_iters):
+        fn()
+    _sync(device)
+    return (time.time() - t0) / num_iters
+
+# Per-iteration times in seconds of each fn in fns, called in sequence.
+def _time_stages(fns, device, num_iters, warmup_iters):
+    for _ in range(warmup_iters):
+        for fn in fns:
+            fn()
+    times = [[] for _ in fns]
+    for _ in range(num_iters):
+        for fn, stage_times in zip(fns, times):
+            _sync(device)
+            t0 = time.perf_counter()
+            fn()
+            _sync(device)
+            stage_times.append(time.perf_counter() - t0)
+    return [np.array(stage_times) for stage_times in times]
+
+def _latency_stats(times):
+    return {f'p{q}_ms': float(np.percentile(times, q) * 1e3) for q in [50, 90, 99]}
+
+# Use the reference implementation of the custom ops, even on CUDA devices.
+@contextlib.contextmanager
+def _ref_impl():
+    modules = [bias_act, filtered_lrelu, upfirdn2d]
+    inits = [module._init for module in modules]
+    try:
+        for module in modules:
+            module._init = lambda: False
+        yield
+    finally:
+        for module, init in zip(modules, inits):
+            module._init = init
+
+#----------------------------------------------------------------------------
+
+@click.group()
+def main():
+    """Micro-benchmarks.
+
+    \b
+    python bench.py augment --augpipe=blit,geom,color,bgc --p=0.2,0.6,1 --res=256
+    python bench.py generator --network=ffhq1024 --cfg=stylegan3-r --batch=1,8,32 --out=bench.json
+    """
+
+#----------------------------------------------------------------------------
+
+@main.command(name='augment')
+@click.option('--augpipe', help='Augmentation pipelines to compare', metavar='[NAME|A,B,C|all]', type=parse_comma_separated_list, default='all', show_default=True)
+@click.option('--p',       help='Augmentation probabilities', metavar='[FLOAT|A,B,C]', type=parse_comma_separated_list, default='0.2,0.6,1', show_default=True)
+@click.option('--batch',   help='Batch size', metavar='INT', type=click.IntRange(min=1), default=32, show_default=True)
+@click.option('--res',     help='Image resolution', metavar='INT', type=click.IntRange(min=8), default=256, show_default=True)
+@click.option('--channels', help='Number of image channels', type=click.Choice(['1', '3', '4']), default='3', show_default=True)
+@click.option('--backward', help='Include the backward pass, as in the D step', metavar='BOOL', type=bool, default=True, show_default=True)
+@click.option('--iters',   help='Number of timed iterations', metavar='INT', type=click.IntRange(min=1), default=50, show_default=True)
+@click.option('--device',  help='Device to benchmark on', metavar='STR', type=str, default='cuda', show_default=True)
+def augment_pipe(augpipe, p, batch, res, channels, backward, iters, device):
+    """Compare the throughput of the reference and fused AugmentPipe per preset."""
+    device = torch.device(device)
+    names = list(augment.augpipe_specs.keys()) if augpipe == ['all'] else augpipe
+    for name in names:
+        if name not in augment.augpipe_specs:
+            raise click.ClickException(f'Unknown augpipe: {name}')
+    images = torch.randn([batch, int(channels), res, res], device=device)
+
+    print(f'{"augpipe":<8s} {"p":>5s} {"reference":>14s} {"fused":>14s} {"speedup":>8s}')
+    for name in names:
+        for prob in p:
+            rates = []
+            for fused in [False, True]:
+                pipe = augment.AugmentPipe(**augment.augpipe_specs[name], fused=fused).train().requires_grad_(False).to(device)
+                pipe.p.copy_(torch.as_tensor(float(prob)))
+                def run():
+                    x = images.detach().requires_grad_(backward)
+                    y = pipe(x.clone()) # not a leaf, like the images of the D step
+                    if backward:
+                        y.sum().backward()
+                rates.append(batch / _time_fn(run, device=device, num_iters=iters, warmup_iters=min(iters, 5)))
+            print(f'{name:<8s} {float(prob):5.2f} {rates[0]:10.1f} img/s {rates[1]:10.1f} img/s {rates[1] / rates[0]:7.2f}x')
+
+#----------------------------------------------------------------------------
+
+@main.command(name='generator')
+@click.option('--network', 'network_pkl', help='Network pickle filename: can be URL, local file, or the name of the model in torch_utils.gen_utils.resume_specs', required=True)
+@click.option('--cfg',        help='Config of the network, used only if you want to use the pretrained models in torch_utils.gen_utils.resume_specs', type=click.Choice(['stylegan2', 'stylegan3-t', 'stylegan3-r']))
+@click.option('--batch',      help='Batch sizes', metavar='[INT|A,B,C]', type=parse_comma_separated_list, default='1,8,32', show_default=True)
+@click.option('--precision',  help='Synthesis precisions; fp32 sets force_fp32', metavar='[fp16|fp32|fp16,fp32]', type=parse_comma_separated_list, default='fp16,fp32', show_default=True)
+@click.option('--noise-mode', help='Noise modes', metavar='[const|random|none|A,B]', type=parse_comma_separated_list, default='const', show_default=True)
+@click.option('--impl',       help='Implementations of the custom ops', metavar='[cuda|ref|cuda,ref]', type=parse_comma_separated_list, default='cuda', show_default=True)
+@click.option('--device',     help='Devices to benchmark on', metavar='[STR|A,B]', type=parse_comma_separated_list, default='cuda', show_default=True)
+@click.option('--iters',      help='Number of timed iterations', metavar='INT', type=click.IntRange(min=1), default=50, show_default=True)
+@click.option('--warmup',     help='Number of untimed iterations', metavar='INT', type=click.IntRange(min=0), default=5, show_default=True)
+@click.option('--seed',       help='Random seed', metavar='INT', type=click.IntRange(min=0), default=0, show_default=True)
+@click.option('--out',        help='Save the results to this JSON file', metavar='PATH', default=None)
+def generator(network_pkl, cfg, batch, precision, noise_mode, impl, device, iters, warmup, seed, out):
+    """Measure the mapping and synthesis latency, throughput, and peak memory of G_ema.
+
+    Every combination of the swept options is run; configurations that are
+    equivalent on the CPU (fp16, cuda ops) are skipped there, and running out
+    of memory is reported as an error for that configuration only.
+    """
+    for value, choices, name in [(precision, ['fp16', 'fp32'], 'precision'), (noise_mode, ['const', 'random', 'none'], 'noise mode'), (impl, ['cuda', 'ref'], 'impl')]:
+        for v in value:
+            if v not in choices:
+                raise click.ClickException(f'Unknown {name}: {v}')
+
+    G_cpu = gen_utils.load_network('G_ema', network_pkl, cfg, torch.device('cpu'))
+    results = []
+    for device_name in device:
+        dev = torch.device(device_name)
+        G = copy.deepcopy(G_cpu).to(dev)
+        for impl_name in impl:
+            if impl_name == 'cuda' and dev.type != 'cuda' and 'ref' in impl:
+                continue # the ops fall back to ref on the CPU anyway
+            for prec in precision:
+                if prec == 'fp16' and dev.type != 'cuda' and 'fp32' in precision:
+                    continue # fp16 layers run in fp32 on the CPU anyway
+                for mode in noise_mode:
+                    for batch_size in [int(b) for b in batch]:
+                        result = dict(device=device_name, impl=impl_name, precision=prec, noise_mode=mode, batch=batch_size)
+                        print(' '.join(f'{k}={v}' for k, v in result.items()) + '...', end=' ', flush=True)
+                        torch.manual_seed(seed)
+                        z = torch.randn([batch_size, G.z_dim], device=dev)
+                        c = torch.nn.functional.one_hot(torch.randint(G.c_dim, [batch_size], device=dev), G.c_dim).float() if G.c_dim > 0 else torch.zeros([batch_size, 0], device=dev)
+                        state = dict()
+                        def run_mapping(mapping=G.mapping, z=z, c=c):
+                            state['ws'] = mapping(z, c)
+                        def run_synthesis(synthesis=G.synthesis, mode=mode, force_fp32=(prec == 'fp32')):
+                            synthesis(state['ws'], noise_mode=mode, force_fp32=force_fp32)
+                        if dev.type == 'cuda':
+                            torch.cuda.empty_cache()
+                            torch.cuda.reset_peak_memory_stats(dev)
+                        try:
+                            with torch.no_grad(), (_ref_impl() if impl_name == 'ref' else contextlib.nullcontext()):
+                                mapping_times, synthesis_times = _time_stages([run_mapping, run_synthesis], device=dev, num_iters=iters, warmup_iters=warmup)
+                        except RuntimeError as err:
+                            if 'out of memory' not in str(err):
+                                raise
+                            result['error'] = 'out of memory'
+                            print(result['error'])
+                            results.append(result)
+                            state.clear()
+                            continue
+                        total_times = mapping_times + synthesis_times
+                        result['mapping'] = _latency_stats(mapping_times)
+                        result['synthesis'] = _latency_stats(synthesis_times)
+                        result['total'] = _latency_stats(total_times)
+                        result['img_per_sec'] = float(batch_size / total_times.mean())
+                        result['peak_mem_mb'] = float(torch.cuda.max_memory_allocated(dev) / 2**20) if dev.type == 'cuda' else None
+                        print(f'{result["img_per_sec"]:.1f} img/s')
+                        results.append(result)
+        del G
+
+    report = dict(network=network_pkl, cfg=cfg, iters=iters, warmup=warmup, torch=torch.__version__,
+        gpu=torch.cuda.get_device_name() if torch.cuda.is_available() else None, results=results)
+    print(json.dumps(report, indent=2))
+    if out is not None:
+        with open(out, 'wt') as f:
+            json.dump(report, f, indent=2)
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
+
+#----------------------------------------------------------------------------
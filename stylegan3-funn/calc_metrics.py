@@ -19,6 +19,7 @@ import dnnlib
 import legacy
 from metrics import metric_main
 from metrics import metric_utils
+from metrics import metric_queue
 from torch_utils import training_stats
 from torch_utils import custom_ops
 from torch_utils import misc
@@ -58,13 +59,10 @@ def subprocess_fn(rank, args, temp_dir):
         c = torch.empty([1, G.c_dim], device=device)
         misc.print_module_summary(G, [z, c])
 
-    # Calculate each metric.
-    for metric in args.metrics:
-        if rank == 0 and args.verbose:
-            print(f'Calculating {metric}...')
-        progress = metric_utils.ProgressMonitor(verbose=args.verbose)
-        result_dict = metric_main.calc_metric(metric=metric, G=G, dataset_kwargs=args.dataset_kwargs,
-            num_gpus=args.num_gpus, rank=rank, device=device, progress=progress)
+    # Calculate each metric, sharing generator passes between them.
+    progress = metric_utils.ProgressMonitor(verbose=args.verbose)
+    for result_dict in metric_main.calc_metrics(metrics=args.metrics, G=G, dataset_kwargs=args.dataset_kwargs,
+            num_gpus=args.num_gpus, rank=rank, device=device, progress=progress, fid_stop_above=args.fid_stop_above):
         if rank == 0:
             metric_main.report_metric(result_dict, run_dir=args.run_dir, snapshot_pkl=args.network_pkl)
         if rank == 0 and args.verbose:
@@ -87,14 +85,18 @@ def parse_comma_separated_list(s):
 
 @click.command()
 @click.pass_context
-@click.option('network_pkl', '--network', help='Network pickle filename or URL', metavar='PATH', required=True)
+@click.option('network_pkl', '--network', help='Network pickle filename or URL', metavar='PATH')
 @click.option('--metrics', help='Quality metrics', metavar='[NAME|A,B,C|none]', type=parse_comma_separated_list, default='fid50k_full', show_default=True)
 @click.option('--data', help='Dataset to evaluate against  [default: look up]', metavar='[ZIP|DIR]')
 @click.option('--mirror', help='Enable dataset x-flips  [default: look up]', type=bool, metavar='BOOL')
 @click.option('--gpus', help='Number of GPUs to use', type=int, default=1, metavar='INT', show_default=True)
 @click.option('--verbose', help='Print optional information', type=bool, default=True, metavar='BOOL', show_default=True)
+@click.option('--watch', help='Evaluate the snapshots queued by a training run with --metrics-async', metavar='DIR', type=click.Path(file_okay=False))
+@click.option('--device', help='Device to use with --watch', metavar='DEVICE', type=str, default='cuda', show_default=True)
+@click.option('--fid-stop-above', help='Stop fid50k_full_prog early once the FID is above this with 95% confidence', metavar='FLOAT', type=float, default=None)
+@click.option('--parent-pid', help='With --watch, also exit once the queue is empty and this process is gone', metavar='INT', type=int, default=None)
 
-def calc_metrics(ctx, network_pkl, metrics, data, mirror, gpus, verbose):
+def calc_metrics(ctx, network_pkl, metrics, data, mirror, gpus, verbose, watch, device, fid_stop_above, parent_pid):
     """Calculate quality metrics for previous training run or pretrained network pickle.
 
     Examples:
@@ -109,6 +111,10 @@ def calc_metrics(ctx, network_pkl, metrics, data, mirror, gpus, verbose):
     python calc_metrics.py --metrics=fid50k_full --data=~/datasets/ffhq-1024x1024.zip --mirror=1 \\
         --network=https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/stylegan3-t-ffhq-1024x1024.pkl
 
+    \b
+    # Evaluate the snapshots of a run started with --metrics-async as they are written, on a spare GPU.
+    python calc_metrics.py --watch=~/training-runs/00000-stylegan3-r-mydataset --device=cuda:1
+
     \b
     Recommended metrics:
       fid50k_full  Frechet inception distance against the full dataset.
@@ -118,6 +124,7 @@ def calc_metrics(ctx, network_pkl, metrics, data, mirror, gpus, verbose):
       eqt50k_int   Equivariance w.r.t. integer translation (EQ-T).
       eqt50k_frac  Equivariance w.r.t. fractional translation (EQ-T_frac).
       eqr50k       Equivariance w.r.t. rotation (EQ-R).
+      eq50k        All three equivariance metrics from shared reference images.
 
     \b
     Legacy metrics:
@@ -128,8 +135,22 @@ def calc_metrics(ctx, network_pkl, metrics, data, mirror, gpus, verbose):
     """
     dnnlib.util.Logger(should_flush=True)
 
+    # Metric worker for an ongoing training run.
+    if watch is not None:
+        if network_pkl is not None:
+            ctx.fail('--watch and --network are mutually exclusive')
+        torch.backends.cuda.matmul.allow_tf32 = False
+        torch.backends.cudnn.allow_tf32 = False
+        conv2d_gradfix.enabled = True
+        if verbose:
+            print(f'Watching "{watch}" for snapshots to evaluate...')
+        metric_queue.run_worker(run_dir=watch, device=torch.device(device), verbose=verbose, parent_pid=parent_pid)
+        return
+
     # Validate arguments.
-    args = dnnlib.EasyDict(metrics=metrics, num_gpus=gpus, network_pkl=network_pkl, verbose=verbose)
+    if network_pkl is None:
+        ctx.fail('--network is required unless --watch is given')
+    args = dnnlib.EasyDict(metrics=metrics, num_gpus=gpus, network_pkl=network_pkl, verbose=verbose, fid_stop_above=fid_stop_above)
     if not all(metric_main.is_valid_metric(metric) for metric in args.metrics):
         ctx.fail('\n'.join(['--metrics can only contain the following values:'] + metric_main.list_valid_metrics()))
     if not args.num_gpus >= 1:
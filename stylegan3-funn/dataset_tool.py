@@ -8,9 +8,13 @@
 
 """Tool for creating ZIP/PNG based datasets."""
 
+import collections
+import concurrent.futures
 import functools
 import gzip
+import hashlib
 import io
+import itertools
 import json
 import os
 import pickle
@@ -19,11 +23,13 @@ import sys
 import tarfile
 import zipfile
 from pathlib import Path
-from typing import Callable, Optional, Tuple, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import click
 import numpy as np
 import PIL.Image
+import scipy.fft
+import torch
 from tqdm import tqdm
 from torch_utils import gen_utils
 
@@ -79,7 +85,25 @@ def is_image_ext(fname: Union[str, Path]) -> bool:
 # ----------------------------------------------------------------------------
 
 
-def open_image_folder(source_dir, force_channels: int = None, *, max_images: Optional[int], subfolders_as_labels: Optional[bool] = False):
+def open_image(file, force_channels: int = None, draft_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    img = PIL.Image.open(file)  # Let PIL handle the mode
+    # Decode JPEGs at a reduced size, as long as it is at least draft_size
+    if draft_size is not None and img.format == 'JPEG':
+        img.draft(img.mode, draft_size)
+    # Convert grayscale image to RGB
+    if img.mode == 'L':
+        img = img.convert('RGB')
+    # Force the number of channels if so requested
+    if force_channels is not None:
+        img = img.convert(gen_utils.channels_dict[int(force_channels)])
+    return np.array(img)
+
+
+# ----------------------------------------------------------------------------
+
+
+def open_image_folder(source_dir, force_channels: int = None, *, max_images: Optional[int], subfolders_as_labels: Optional[bool] = False,
+                      draft_size: Optional[Tuple[int, int]] = None):
     input_images = [str(f) for f in sorted(Path(source_dir).rglob('*')) if is_image_ext(f) and os.path.isfile(f)]
 
     # Load labels.
@@ -115,18 +139,11 @@ def open_image_folder(source_dir, force_channels: int = None, *, max_images: Opt
             arch_fname = arch_fname.replace('\\', '/')
             # Adding Pull #39 from Andreas Jansson: https://github.com/NVlabs/stylegan3/pull/39
             try:
-                img = PIL.Image.open(fname)  # Let PIL handle the mode
-                # Convert grayscale image to RGB
-                if img.mode == 'L':
-                    img = img.convert('RGB')
-                # Force the number of channels if so requested
-                if force_channels is not None:
-                    img = img.convert(gen_utils.channels_dict[int(force_channels)])
-                img = np.array(img)
+                img = open_image(fname, force_channels, draft_size)
             except Exception as e:
                 sys.stderr.write(f'Failed to read {fname}: {e}')
                 continue
-            yield dict(img=img, label=labels.get(arch_fname))
+            yield dict(img=img, label=labels.get(arch_fname), name=arch_fname)
             if idx >= max_idx-1:
                 break
     return max_idx, iterate_images()
@@ -135,13 +152,14 @@ def open_image_folder(source_dir, force_channels: int = None, *, max_images: Opt
 # ----------------------------------------------------------------------------
 
 
-def open_image_zip(source, force_channels: int = None, *, max_images: Optional[int]):
+def open_image_zip(source, force_channels: int = None, *, max_images: Optional[int], draft_size: Optional[Tuple[int, int]] = None):
     with zipfile.ZipFile(source, mode='r') as z:
-        input_images = [str(f) for f in sorted(z.namelist()) if is_image_ext(f)]
+        names = z.namelist()
+        input_images = sorted(f for f in names if is_image_ext(f))
 
         # Load labels.
         labels = {}
-        if 'dataset.json' in z.namelist():
+        if 'dataset.json' in names:
             with z.open('dataset.json', 'r') as file:
                 labels = json.load(file)['labels']
                 if labels is not None:
@@ -152,22 +170,18 @@ def open_image_zip(source, force_channels: int = None, *, max_images: Optional[i
     max_idx = maybe_min(len(input_images), max_images)
 
     def iterate_images():
+        # Opened here, so the zip is only open while the images are being iterated, and is closed
+        # when the iteration stops early or the generator is discarded.
         with zipfile.ZipFile(source, mode='r') as z:
             for idx, fname in enumerate(input_images):
                 with z.open(fname, 'r') as file:
                     # Same as above: PR #39 by Andreas Jansson and turn Grayscale to RGB
                     try:
-                        img = PIL.Image.open(file) # type: ignore
-                        if img.mode == 'L':
-                            img = img.convert('RGB')
-                        # Force the number of channels if so requested
-                        if force_channels is not None:
-                            img = img.convert(gen_utils.channels_dict[int(force_channels)])
-                        img = np.array(img)
+                        img = open_image(file, force_channels, draft_size)
                     except Exception as e:
                         sys.stderr.write(f'Failed to read {fname}: {e}')
                         continue
-                yield dict(img=img, label=labels.get(fname))
+                yield dict(img=img, label=labels.get(fname), name=fname)
                 if idx >= max_idx-1:
                     break
     return max_idx, iterate_images()
@@ -180,25 +194,25 @@ def open_lmdb(lmdb_dir: str, *, max_images: Optional[int]):
     import cv2  # pip install opencv-python # pylint: disable=import-error
     import lmdb  # pip install lmdb # pylint: disable=import-error
 
-    with lmdb.open(lmdb_dir, readonly=True, lock=False).begin(write=False) as txn:
-        max_idx = maybe_min(txn.stat()['entries'], max_images)
+    env = lmdb.open(lmdb_dir, readonly=True, lock=False)
+    max_idx = maybe_min(env.stat()['entries'], max_images)
 
     def iterate_images():
-        with lmdb.open(lmdb_dir, readonly=True, lock=False).begin(write=False) as txn:
-            for idx, (_key, value) in enumerate(txn.cursor()):
-                try:
+        with env, env.begin(write=False) as txn:
+            for idx, value in enumerate(txn.cursor().iternext(keys=False, values=True)):
+                if idx >= max_idx:
+                    break
+                # cv2 decodes the usual JPEG/WebP records; PIL is only tried on what it cannot decode.
+                img = cv2.imdecode(np.frombuffer(value, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if img is not None:
+                    img = img[:, :, ::-1]  # BGR => RGB
+                else:
                     try:
-                        img = cv2.imdecode(np.frombuffer(value, dtype=np.uint8), 1)
-                        if img is None:
-                            raise IOError('cv2.imdecode failed')
-                        img = img[:, :, ::-1]  # BGR => RGB
-                    except IOError:
                         img = np.array(PIL.Image.open(io.BytesIO(value)))
-                    yield dict(img=img, label=None)
-                    if idx >= max_idx-1:
-                        break
-                except:
-                    print(sys.exc_info()[1])
+                    except Exception as e:
+                        sys.stderr.write(f'Failed to decode record {idx}: {e}\n')
+                        continue
+                yield dict(img=img, label=None)
 
     return max_idx, iterate_images()
 
@@ -272,29 +286,72 @@ def open_mnist(images_gz: str, *, max_images: Optional[int]):
 # ----------------------------------------------------------------------------
 
 
+def pil_resize(imgs: np.ndarray, width: int, height: int) -> np.ndarray:
+    """Resize a batch of same-size [N, H, W(, C)] uint8 images with PIL's Lanczos filter."""
+    return np.stack([np.array(PIL.Image.fromarray(img).resize((width, height), PIL.Image.LANCZOS)) for img in imgs])
+
+
+def _lanczos_matrix(in_size: int, out_size: int, a: int = 3) -> torch.Tensor:
+    """Resampling matrix [out_size, in_size] of an antialiased Lanczos filter, with the same taps as PIL."""
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = a * filter_scale
+    center = (torch.arange(out_size, dtype=torch.float64) + 0.5) * scale
+    idx = torch.floor(center - support + 0.5).unsqueeze(1) + torch.arange(int(np.ceil(support)) * 2 + 1)
+    x = (idx + 0.5 - center.unsqueeze(1)) / filter_scale
+    weights = torch.sinc(x) * torch.sinc(x / a) * (x.abs() < a) * (idx >= 0) * (idx < in_size)
+    weights = weights / weights.sum(dim=1, keepdim=True)
+    matrix = torch.zeros([out_size, in_size], dtype=torch.float64)
+    matrix.scatter_add_(1, idx.clamp(0, in_size - 1).to(torch.int64), weights)
+    return matrix.to(torch.float32)
+
+
+def torch_resize(imgs: np.ndarray, width: int, height: int, max_batch_elems: int = 2 ** 26) -> np.ndarray:
+    """
+    Vectorized version of pil_resize(): both Lanczos passes are done as matrix products over the whole batch, so
+    that they run on all the CPU threads. As in PIL, the intermediate result is rounded to uint8 and RGBA images
+    are resized with premultiplied alpha; the output still differs from PIL's fixed-point arithmetic by up to 1 LSB
+    (more in nearly transparent pixels).
+    """
+    N, H, W = imgs.shape[:3]
+    mat_w = _lanczos_matrix(W, width).t()
+    mat_h = _lanczos_matrix(H, height)
+    results = []
+    for chunk in torch.from_numpy(np.ascontiguousarray(imgs)).split(max(max_batch_elems // imgs[0].size, 1)):
+        x = (chunk if chunk.ndim == 4 else chunk.unsqueeze(3)).permute(0, 3, 1, 2).to(torch.float32)  # [n, C, H, W]
+        if x.shape[1] == 4:
+            x = torch.cat([x[:, :3] * x[:, 3:] / 255, x[:, 3:]], dim=1).round()
+        x = (x @ mat_w).round().clamp(0, 255)  # [n, C, H, width]
+        x = (mat_h @ x).round().clamp(0, 255)  # [n, C, height, width]
+        if x.shape[1] == 4:
+            x = torch.cat([(x[:, :3] * 255 / x[:, 3:]).nan_to_num(0, 0, 0).round().clamp(0, 255), x[:, 3:]], dim=1)
+        results.append(x.to(torch.uint8).permute(0, 2, 3, 1))
+    x = torch.cat(results).numpy()
+    return x if imgs.ndim == 4 else x[..., 0]
+
+
+# ----------------------------------------------------------------------------
+
+
 def make_transform(
     transform: Optional[str],
     output_width: Optional[int],
-    output_height: Optional[int]
-) -> Callable[[np.ndarray], Optional[np.ndarray]]:
+    output_height: Optional[int],
+    resize: Callable[[np.ndarray, int, int], np.ndarray] = pil_resize
+) -> Callable[[List[np.ndarray]], List[Optional[np.ndarray]]]:
+    """
+    Returns a function that crops and resizes a list of images. Each transform below returns the cropped image, the
+    size to resize it to, and the padding to add afterwards (or None to drop the image); images of the same size are
+    then resized together, and the ones that already have the right size are left as they are.
+    """
     def scale(width, height, img):
-        w = img.shape[1]
-        h = img.shape[0]
-        if width == w and height == h:
-            return img
-        img = PIL.Image.fromarray(img)
-        ww = width if width is not None else w
-        hh = height if height is not None else h
-        img = img.resize((ww, hh), PIL.Image.LANCZOS)
-        return np.array(img)
+        return img, (width or img.shape[1], height or img.shape[0]), None
 
     def center_crop(width, height, img):
         crop = np.min(img.shape[:2])
         img = img[(img.shape[0] - crop) // 2: (img.shape[0] + crop) // 2,
                   (img.shape[1] - crop) // 2: (img.shape[1] + crop) // 2]
-        img = PIL.Image.fromarray(img, gen_utils.channels_dict[img.shape[2]])
-        img = img.resize((width, height), PIL.Image.LANCZOS)
-        return np.array(img)
+        return img, (width, height), None
 
     def center_crop_wide(width, height, img):
         ch = int(np.round(width * img.shape[0] / img.shape[1]))
@@ -302,13 +359,8 @@ def make_transform(
             return None
 
         img = img[(img.shape[0] - ch) // 2: (img.shape[0] + ch) // 2]
-        img = PIL.Image.fromarray(img, gen_utils.channels_dict[img.shape[2]])
-        img = img.resize((width, height), PIL.Image.LANCZOS)
-        img = np.array(img)
-
-        canvas = np.zeros([width, width, 3], dtype=np.uint8)
-        canvas[(width - height) // 2 : (width + height) // 2, :] = img
-        return canvas
+        pad = (width - height) // 2
+        return img, (width, height), [(pad, width - height - pad), (0, 0)]  # square canvas, img in the middle rows
 
     def center_crop_tall(width, height, img):
         ch = int(np.round(height * img.shape[1] / img.shape[0]))
@@ -316,47 +368,139 @@ def make_transform(
             return None
 
         img = img[:, (img.shape[1] - ch) // 2: (img.shape[1] + ch) // 2]  # center-crop: [width0, height0, C] -> [width0, height, C]
-        img = PIL.Image.fromarray(img, gen_utils.channels_dict[img.shape[2]])
-        img = img.resize((width, height), PIL.Image.LANCZOS)  # resize: [width0, height, 3] -> [width, height, 3]
-        img = np.array(img)
-
-        canvas = np.zeros([height, height, 3], dtype=np.uint8)  # square canvas
-        canvas[:, (height - width) // 2: (height + width) // 2] = img  # replace the middle with img
-        return canvas
+        pad = (height - width) // 2
+        return img, (width, height), [(0, 0), (pad, height - width - pad)]  # square canvas, img in the middle columns
+
+    def transform_images(crop_fn, imgs):
+        crops = [crop_fn(img) for img in imgs]
+
+        # Resize the images in groups of the same size.
+        groups = collections.defaultdict(list)  # (shape, size) => [idx, ...]
+        for idx, crop in enumerate(crops):
+            if crop is not None and crop[0].shape[:2] != crop[1][::-1]:
+                groups[(crop[0].shape, crop[1])].append(idx)
+        results = [crop[0] if crop is not None else None for crop in crops]
+        for (_shape, (width, height)), idxs in groups.items():
+            for idx, img in zip(idxs, resize(np.stack([results[idx] for idx in idxs]), width, height)):
+                results[idx] = img
+
+        # Pad to a square canvas, if needed.
+        for idx, crop in enumerate(crops):
+            if crop is not None and crop[2] is not None:
+                results[idx] = np.pad(results[idx], crop[2] + [(0, 0)] * (results[idx].ndim - 2))
+        return results
 
     if transform is None:
-        return functools.partial(scale, output_width, output_height)
+        return functools.partial(transform_images, functools.partial(scale, output_width, output_height))
     if transform == 'center-crop':
         if (output_width is None) or (output_height is None):
             error(f'must specify --resolution=WxH when using {transform} transform')
-        return functools.partial(center_crop, output_width, output_height)
+        return functools.partial(transform_images, functools.partial(center_crop, output_width, output_height))
     if transform == 'center-crop-wide':
         if (output_width is None) or (output_height is None):
             error(f'must specify --resolution=WxH when using {transform} transform')
-        return functools.partial(center_crop_wide, output_width, output_height)
+        return functools.partial(transform_images, functools.partial(center_crop_wide, output_width, output_height))
     if transform == 'center-crop-tall':
         if (output_width is None) or (output_height is None):
             error(f'must specify --resolution=WxH when using {transform} transform')
-        return functools.partial(center_crop_tall, output_width, output_height)
+        return functools.partial(transform_images, functools.partial(center_crop_tall, output_width, output_height))
     assert False, 'unknown transform'
 
 
 # ----------------------------------------------------------------------------
 
 
-def open_dataset(source, force_channels, *, max_images: Optional[int], subfolders_as_labels: Optional[bool] = False):
+def image_phash(img: np.ndarray) -> Tuple[int, float]:
+    """
+    64-bit perceptual hash (pHash): signs of the lowest 8x8 DCT frequencies of the 32x32 grayscale image.
+    Also returns the RMS of the AC coefficients the hash is based on; when it is near zero (flat images),
+    the hash bits only encode rounding noise and must not be compared.
+    """
+    gray = PIL.Image.fromarray(img).convert('L').resize((32, 32), PIL.Image.BOX)
+    dct = scipy.fft.dctn(np.asarray(gray, dtype=np.float32), norm='ortho')[:8, :8].flatten()
+    bits = dct > np.median(dct[1:])  # The DC term would dominate the median
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big'), float(np.sqrt(np.mean(dct[1:] ** 2)))
+
+
+# ----------------------------------------------------------------------------
+
+
+class HashIndex:
+    """
+    Multi-index hashing for finding 64-bit hashes within a Hamming distance of max_dist. The hashes are split
+    into max_dist + 1 chunks, one table each; by the pigeonhole principle, any match agrees exactly on at least
+    one chunk, so a lookup only checks the few hashes that share a chunk with the query.
+    """
+    def __init__(self, max_dist: int, num_bits: int = 64):
+        num_chunks = max_dist + 1
+        bounds = np.linspace(0, num_bits, num_chunks + 1).astype(int)
+        self.max_dist = max_dist
+        self.chunks = [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(bounds[:-1], bounds[1:])]  # (shift, mask)
+        self.tables = [collections.defaultdict(list) for _ in self.chunks]
+        self.items = []  # [(hash, value), ...]
+
+    def query(self, h: int, accept: Optional[Callable[[object], bool]] = None) -> Optional[Tuple[int, object]]:
+        """Return (distance, value) of the closest indexed hash within max_dist whose value passes accept(), or None."""
+        best = None
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            for item_idx in table.get((h >> shift) & mask, []):
+                other, value = self.items[item_idx]
+                dist = bin(h ^ other).count('1')
+                if dist <= self.max_dist and (best is None or dist < best[0]) and (accept is None or accept(value)):
+                    best = (dist, value)
+        return best
+
+    def add(self, h: int, value: object) -> None:
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            table[(h >> shift) & mask].append(len(self.items))
+        self.items.append((h, value))
+
+
+# ----------------------------------------------------------------------------
+
+
+def imap_bounded(fn: Callable, iterable: Iterable, num_workers: int, max_pending: Optional[int] = None) -> Iterator:
+    """Like map(fn, iterable), but on num_workers threads and with at most max_pending items in flight."""
+    if num_workers <= 1:
+        yield from map(fn, iterable)
+        return
+    max_pending = max_pending or num_workers * 4
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iterate_chunks(iterable: Iterable, chunk_size: int) -> Iterator[List]:
+    """Split an iterable into lists of up to chunk_size items."""
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+# ----------------------------------------------------------------------------
+
+
+def open_dataset(source, force_channels, *, max_images: Optional[int], subfolders_as_labels: Optional[bool] = False,
+                 draft_size: Optional[Tuple[int, int]] = None):
     if os.path.isdir(source):
         if source.rstrip('/').endswith('_lmdb'):
             return open_lmdb(source, max_images=max_images)
         else:
-            return open_image_folder(source, force_channels, max_images=max_images, subfolders_as_labels=subfolders_as_labels)
+            return open_image_folder(source, force_channels, max_images=max_images, subfolders_as_labels=subfolders_as_labels, draft_size=draft_size)
     elif os.path.isfile(source):
         if os.path.basename(source) == 'cifar-10-python.tar.gz':
             return open_cifar10(source, max_images=max_images)
         elif os.path.basename(source) == 'train-images-idx3-ubyte.gz':
             return open_mnist(source, max_images=max_images)
         elif file_ext(source) == 'zip':
-            return open_image_zip(source, force_channels, max_images=max_images)
+            return open_image_zip(source, force_channels, max_images=max_images, draft_size=draft_size)
         else:
             assert False, 'unknown archive type'
     else:
@@ -409,6 +553,12 @@ def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None],
 @click.option('--subfolders-as-labels', help='Use the folder names as the labels, to avoid setting up `dataset.json`', is_flag=True)
 @click.option('--transform', help='Input crop/resize mode', type=click.Choice(['center-crop', 'center-crop-wide', 'center-crop-tall']))
 @click.option('--resolution', help='Output resolution (e.g., \'512x512\')', metavar='WxH', type=parse_tuple)
+@click.option('--resize-backend', help='Resampler for --resolution; torch resizes same-size images in batches', type=click.Choice(['pil', 'torch']), default='pil', show_default=True)
+@click.option('--jpeg-draft', help='Decode JPEGs at a reduced size when they are much larger than --resolution (faster, slightly different pixels)', type=bool, default=False, show_default=True)
+@click.option('--workers', help='Number of threads for transforming and hashing the images', type=click.IntRange(min=1), default=min(os.cpu_count() or 1, 8), show_default=True)
+@click.option('--dedup', help='Drop duplicate and near-duplicate images (after crop and resize)', is_flag=True)
+@click.option('--dedup-dist', help='Max. Hamming distance between the 64-bit perceptual hashes of near-duplicates', type=click.IntRange(min=0, max=32), default=4, show_default=True)
+@click.option('--dedup-report', help='Save the list of dropped images and what they duplicate to this JSON file', metavar='PATH', default=None)
 def convert_dataset(
     ctx: click.Context,
     source: str,
@@ -417,7 +567,13 @@ def convert_dataset(
     force_channels: Optional[int],
     subfolders_as_labels: Optional[bool],
     transform: Optional[str],
-    resolution: Optional[Tuple[int, int]]
+    resolution: Optional[Tuple[int, int]],
+    resize_backend: str,
+    jpeg_draft: bool,
+    workers: int,
+    dedup: bool,
+    dedup_dist: int,
+    dedup_report: Optional[str]
 ):
     """Convert an image dataset into a dataset archive usable with StyleGAN2 ADA PyTorch.
 
@@ -476,6 +632,15 @@ def convert_dataset(
     \b
     python dataset_tool.py --source LSUN/raw/cat_lmdb --dest /tmp/lsun_cat \\
         --transform=center-crop-wide --resolution=512x384
+
+    Images are resized with Lanczos filtering, either with PIL or, with --resize-backend=torch,
+    in batches of same-size images.  With --jpeg-draft=true, JPEGs much larger than --resolution
+    are decoded at a reduced size (at least twice the output resolution); this is faster, but the
+    output pixels differ slightly from a full decode.
+
+    Use --dedup to drop exact and near-duplicate images, as determined by a perceptual
+    hash of the transformed images. The first occurrence of each image is kept, and
+    --dedup-report lists every dropped image along with the image it duplicates.
     """
 
     PIL.Image.init() # type: ignore
@@ -483,21 +648,38 @@ def convert_dataset(
     if dest == '':
         ctx.fail('--dest output filename or directory must not be an empty string')
 
-    num_files, input_iter = open_dataset(source, force_channels, max_images=max_images, subfolders_as_labels=subfolders_as_labels)
+    if resolution is None: resolution = (None, None)
+    # JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale; keep twice the output resolution so quality is unaffected.
+    draft_size = (2 * resolution[0], 2 * resolution[1]) if jpeg_draft and None not in resolution else None
+
+    num_files, input_iter = open_dataset(source, force_channels, max_images=max_images, subfolders_as_labels=subfolders_as_labels, draft_size=draft_size)
     archive_root_dir, save_bytes, close_dest = open_dest(dest)
 
-    if resolution is None: resolution = (None, None)
-    transform_image = make_transform(transform, *resolution)
+    transform_images = make_transform(transform, *resolution, resize=dict(pil=pil_resize, torch=torch_resize)[resize_backend])
+
+    def process_chunk(images: List[Dict]) -> List[Dict]:
+        # Apply crop and resize, and hash the result for dedup (in the worker threads).
+        for image, img in zip(images, transform_images([image['img'] for image in images])):
+            image['img'] = img
+            if dedup and img is not None:
+                image['phash'], image['ac_rms'] = image_phash(img)
+                image['mean_color'] = img.reshape(-1, img.shape[2] if img.ndim == 3 else 1).mean(axis=0)
+                image['md5'] = hashlib.md5(img.tobytes()).hexdigest()
+        return images
 
     dataset_attrs = None
+    dedup_index = HashIndex(max_dist=dedup_dist) if dedup else None
+    dedup_exact = {}  # md5 -> source name
+    dedup_min_ac_rms = 1.0  # Below this, an image is flat and only exact duplicates are dropped
+    dedup_max_color_diff = 8.0  # Max. difference of near-duplicates' mean color, per channel
+    duplicates = []
+    num_kept = 0
 
     labels = []
-    for idx, image in tqdm(enumerate(input_iter), total=num_files):
-        idx_str = f'{idx:08d}'
-        archive_fname = f'{idx_str[:5]}/img{idx_str}.png'
-
-        # Apply crop and resize.
-        img = transform_image(image['img'])
+    processed_iter = itertools.chain.from_iterable(imap_bounded(process_chunk, iterate_chunks(input_iter, 16), num_workers=workers))
+    for idx, image in tqdm(enumerate(processed_iter), total=num_files):
+        source_name = image.get('name', f'#{idx}')
+        img = image['img']
 
         # Transform may drop images.
         if img is None:
@@ -523,9 +705,29 @@ def convert_dataset(
                 error('Image width/height after scale and crop are required to be power-of-two')
         elif dataset_attrs != cur_image_attrs:
             err = [f'  dataset {k}/cur image {k}: {dataset_attrs[k]}/{cur_image_attrs[k]}' for k in dataset_attrs.keys()]  # pylint: disable=unsubscriptable-object
-            error(f'Image {archive_fname} attributes must be equal across all images of the dataset.  Got:\n' + '\n'.join(err))
+            error(f'Image {source_name} attributes must be equal across all images of the dataset.  Got:\n' + '\n'.join(err))
 
-        # Save the image as an uncompressed PNG.
+        # Drop duplicates before encoding them.  Near-duplicates are only matched between textured images
+        # (the hash of a flat image is noise) and must also agree on the mean color (the hash ignores it).
+        if dedup:
+            if image['md5'] in dedup_exact:
+                duplicates.append(dict(dropped=source_name, duplicate_of=dedup_exact[image['md5']], distance=0, exact=True))
+                continue
+            textured = image['ac_rms'] >= dedup_min_ac_rms
+            if textured:
+                accept = lambda kept, color=image['mean_color']: np.abs(kept[1] - color).max() <= dedup_max_color_diff
+                match = dedup_index.query(image['phash'], accept=accept)
+                if match is not None:
+                    dist, (kept_name, _kept_color) = match
+                    duplicates.append(dict(dropped=source_name, duplicate_of=kept_name, distance=dist, exact=False))
+                    continue
+                dedup_index.add(image['phash'], (source_name, image['mean_color']))
+            dedup_exact[image['md5']] = source_name
+
+        # Save the image as an uncompressed PNG, numbered by the images kept so far so there are no gaps.
+        idx_str = f'{num_kept:08d}'
+        archive_fname = f'{idx_str[:5]}/img{idx_str}.png'
+        num_kept += 1
         img = PIL.Image.fromarray(img, gen_utils.channels_dict[channels])
         image_bits = io.BytesIO()
         img.save(image_bits, format='png', compress_level=0, optimize=False)
@@ -533,11 +735,20 @@ def convert_dataset(
         labels.append([archive_fname, image['label']] if image['label'] is not None else None)
 
     metadata = {
-        'labels': labels if all(x is not None for x in labels) else None
+        'labels': labels if all(x is not None for x in labels) else None,
+        'image_shape': [dataset_attrs['channels'], dataset_attrs['height'], dataset_attrs['width']] if dataset_attrs is not None else None
     }
     save_bytes(os.path.join(archive_root_dir, 'dataset.json'), json.dumps(metadata))
     close_dest()
 
+    if dedup:
+        num_exact = sum(1 for d in duplicates if d['exact'])
+        print(f'Dropped {len(duplicates)} duplicates ({num_exact} exact, {len(duplicates) - num_exact} near-duplicates) '
+              f'and kept {num_kept} images.')
+        if dedup_report is not None:
+            with open(dedup_report, 'w') as f:
+                json.dump(dict(max_dist=dedup_dist, num_kept=num_kept, duplicates=duplicates), f, indent=2)
+
 # ----------------------------------------------------------------------------
 
 
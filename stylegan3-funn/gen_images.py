@@ -19,6 +19,7 @@ import PIL.Image
 import torch
 
 import legacy
+from training.networks_stylegan3 import synthesis_with_transform
 
 #----------------------------------------------------------------------------
 
@@ -130,9 +131,10 @@ def generate_images(
         if hasattr(G.synthesis, 'input'):
             m = make_transform(translate, rotate)
             m = np.linalg.inv(m)
-            G.synthesis.input.transform.copy_(torch.from_numpy(m))
-
-        img = G(z, label, truncation_psi=truncation_psi, noise_mode=noise_mode)
+            ws = G.mapping(z, label, truncation_psi=truncation_psi)
+            img = synthesis_with_transform(G.synthesis, ws, transform=torch.from_numpy(m).to(device), noise_mode=noise_mode)
+        else:
+            img = G(z, label, truncation_psi=truncation_psi, noise_mode=noise_mode)
         img = (img.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8)
         PIL.Image.fromarray(img[0].cpu().numpy(), 'RGB').save(f'{outdir}/seed{seed:04d}.png')
 
@@ -23,6 +23,7 @@ from tqdm import tqdm
 
 import legacy
 from torch_utils import gen_utils
+from training.networks_stylegan3 import synthesis_with_transform
 
 
 # ----------------------------------------------------------------------------
@@ -104,7 +105,7 @@ def gen_interp_video(G,
             G.synthesis.input.affine.weight.data.zero_()
 
     # Get the Generator's transform
-    m = G.synthesis.input.transform if hasattr(G.synthesis, 'input') else None
+    m = G.synthesis.input.transform.clone() if hasattr(G.synthesis, 'input') else None
 
     if num_keyframes is None:
         if len(seeds) % (grid_w*grid_h) != 0:
@@ -138,7 +139,6 @@ def gen_interp_video(G,
     # Render video.
     video_out = imageio.get_writer(mp4, mode='I', fps=60, codec='libx264', **video_kwargs)
     for frame_idx in tqdm(range(num_keyframes * w_frames)):
-        imgs = []
         # Construct an inverse affine matrix and pass to the generator. The generator expects 
         # this matrix as an inverse to avoid potentially failing numerical operations in the network.
         if hasattr(G.synthesis, 'input'):
@@ -160,22 +160,19 @@ def gen_interp_video(G,
             # total_shear_y = 2*np.sin(2*np.pi*frame_idx/(num_keyframes * w_frames))  # will oscillate between -2 and 2
 
             # We then use these values to construct the affine matrix
-            m = gen_utils.make_affine_transform(m, angle=total_rotation, translate_x=total_translation_x,
-                                                translate_y=total_translation_y, scale_x=total_scale_x,
-                                                scale_y=total_scale_y, shear_x=total_shear_x, shear_y=total_shear_y,
-                                                mirror_x=mirror_x, mirror_y=mirror_y)
-            m = np.linalg.inv(m)
-            # Finally, we pass the matrix to the generator
-            G.synthesis.input.transform.copy_(torch.from_numpy(m))
-
-        # The rest stays the same, for all you gen_video.py lovers out there
-        for yi in range(grid_h):
-            for xi in range(grid_w):
-                interp = grid[yi][xi]
-                w = torch.from_numpy(interp(frame_idx / w_frames)).to(device)
-                img = G.synthesis(ws=w.unsqueeze(0), noise_mode='const')[0]
-                imgs.append(img)
-        video_out.append_data(layout_grid(torch.stack(imgs), grid_w=grid_w, grid_h=grid_h))
+            frame_m = gen_utils.make_affine_transform(m, angle=total_rotation, translate_x=total_translation_x,
+                                                      translate_y=total_translation_y, scale_x=total_scale_x,
+                                                      scale_y=total_scale_y, shear_x=total_shear_x, shear_y=total_shear_y,
+                                                      mirror_x=mirror_x, mirror_y=mirror_y)
+            frame_m = np.linalg.inv(frame_m)
+
+        # Render the whole grid in one batch; the matrix is passed per call, leaving the Generator untouched
+        ws_frame = torch.stack([torch.from_numpy(grid[yi][xi](frame_idx / w_frames)) for yi in range(grid_h) for xi in range(grid_w)]).to(device)
+        if hasattr(G.synthesis, 'input'):
+            imgs = synthesis_with_transform(G.synthesis, ws_frame, transform=torch.from_numpy(frame_m).to(device), noise_mode='const')
+        else:
+            imgs = G.synthesis(ws=ws_frame, noise_mode='const')
+        video_out.append_data(layout_grid(imgs, grid_w=grid_w, grid_h=grid_h))
     video_out.close()
 
 
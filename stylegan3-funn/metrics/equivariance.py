@@ -10,10 +10,12 @@
 "Alias-Free Generative Adversarial Networks"."""
 
 import copy
+import collections
 import numpy as np
 import torch
 import torch.fft
 from torch_utils.ops import upfirdn2d
+from training.networks_stylegan3 import synthesis_with_transform
 from . import metric_utils
 
 #----------------------------------------------------------------------------
@@ -129,6 +131,27 @@ def construct_affine_bandlimit_filter(mat, a=3, amax=16, aflt=64, up=4, cutoff_i
     f = f.reshape(amax * 2 * up, amax * 2 * up)[:-1, :-1]
     return f
 
+#----------------------------------------------------------------------------
+# Cached version of construct_affine_bandlimit_filter(). The filters only
+# depend on the 2x2 part of the matrix, so quantizing the rotation angles
+# makes repeated transformations hit the cache instead of redoing the FFTs.
+
+_filter_cache = collections.OrderedDict() # key => torch.Tensor
+_filter_cache_size = 4096
+
+def get_affine_bandlimit_filter(mat, **filter_kwargs):
+    mat = torch.as_tensor(mat).to(torch.float32)
+    key = (tuple(mat[:2, :2].flatten().tolist()), str(mat.device), tuple(sorted(filter_kwargs.items())))
+    f = _filter_cache.get(key, None)
+    if f is None:
+        f = construct_affine_bandlimit_filter(mat, **filter_kwargs)
+        _filter_cache[key] = f
+        if len(_filter_cache) > _filter_cache_size:
+            _filter_cache.popitem(last=False)
+    else:
+        _filter_cache.move_to_end(key)
+    return f
+
 #----------------------------------------------------------------------------
 # Apply the given affine transformation to a batch of 2D images.
 
@@ -137,7 +160,7 @@ def apply_affine_transformation(x, mat, up=4, **filter_kwargs):
     mat = torch.as_tensor(mat).to(dtype=torch.float32, device=x.device)
 
     # Construct filter.
-    f = construct_affine_bandlimit_filter(mat, up=up, **filter_kwargs)
+    f = get_affine_bandlimit_filter(mat, up=up, **filter_kwargs)
     assert f.ndim == 2 and f.shape[0] == f.shape[1] and f.shape[0] % 2 == 1
     p = f.shape[0] // 2
 
@@ -179,7 +202,7 @@ def apply_fractional_rotation(x, angle, a=3, **filter_kwargs):
 def apply_fractional_pseudo_rotation(x, angle, a=3, **filter_kwargs):
     angle = torch.as_tensor(angle).to(dtype=torch.float32, device=x.device)
     mat = rotation_matrix(-angle)
-    f = construct_affine_bandlimit_filter(mat, a=a, amax=a*2, up=1, **filter_kwargs)
+    f = get_affine_bandlimit_filter(mat, a=a, amax=a*2, up=1, **filter_kwargs)
     y = upfirdn2d.filter2d(x=x, f=f)
     m = torch.zeros_like(y)
     c = f.shape[0] // 2
@@ -187,71 +210,99 @@ def apply_fractional_pseudo_rotation(x, angle, a=3, **filter_kwargs):
     return y, m
 
 #----------------------------------------------------------------------------
-# Compute the selected equivariance metrics for the given generator.
+# Apply one of the above operators to each image of a batch with its own
+# parameters, e.g. apply_per_sample(apply_integer_translation, x, tx, ty).
+
+def apply_per_sample(op, x, *params):
+    results = [op(x[i:i+1], *[p[i] for p in params]) for i in range(x.shape[0])]
+    return tuple(torch.cat(ys) for ys in zip(*results))
 
-def compute_equivariance_metrics(opts, num_samples, batch_size, translate_max=0.125, rotate_max=1, compute_eqt_int=False, compute_eqt_frac=False, compute_eqr=False):
+#----------------------------------------------------------------------------
+# Compute the selected equivariance metrics for the given generator. Every
+# sample gets its own random transformations, and the reference image and
+# all transformed images of a batch are rendered by a single synthesis call.
+# Rotation angles are quantized to num_angles levels so that their filters
+# can be cached.
+
+def compute_equivariance_metrics(opts, num_samples, batch_size=None, max_batch_size=16, translate_max=0.125, rotate_max=1, num_angles=1024,
+        compute_eqt_int=False, compute_eqt_frac=False, compute_eqr=False):
     assert compute_eqt_int or compute_eqt_frac or compute_eqr
 
-    # Setup generator and labels.
+    # Setup generator.
     G = copy.deepcopy(opts.G).eval().requires_grad_(False).to(opts.device)
     I = torch.eye(3, device=opts.device)
     M = getattr(getattr(getattr(G, 'synthesis', None), 'input', None), 'transform', None)
     if M is None:
         raise ValueError('Cannot compute equivariance metrics; the given generator does not support user-specified image transformations')
-    c_iter = metric_utils.iterate_random_labels(opts=opts, batch_size=batch_size)
+    num_renders = 1 + int(compute_eqt_int) + int(compute_eqt_frac) + int(compute_eqr)
 
-    # Sampling loop.
-    sums = None
-    progress = opts.progress.sub(tag='eq sampling', num_items=num_samples)
-    for batch_start in range(0, num_samples, batch_size * opts.num_gpus):
-        progress.update(batch_start)
+    def run_batch(c):
+        n = c.shape[0]
         s = []
 
-        # Randomize noise buffers, if any.
-        for name, buf in G.named_buffers():
-            if name.endswith('.noise_const'):
-                buf.copy_(torch.randn_like(buf))
+        # Randomize noise buffers per sample, if any, shared between all renders of each sample.
+        for module in G.modules():
+            buf = getattr(module, 'noise_const', None)
+            if isinstance(buf, torch.Tensor):
+                noise = torch.randn([n, 1, *buf.shape[-2:]], device=buf.device)
+                module.noise_const = noise.repeat([num_renders, 1, 1, 1])
 
         # Run mapping network.
-        z = torch.randn([batch_size, G.z_dim], device=opts.device)
-        c = next(c_iter)
+        z = torch.randn([n, G.z_dim], device=opts.device)
         ws = G.mapping(z=z, c=c)
 
-        # Generate reference image.
-        M[:] = I
-        orig = G.synthesis(ws=ws, noise_mode='const', **opts.G_kwargs)
+        # Draw the transformations.
+        transforms = [I.repeat([n, 1, 1])] # reference image
+        if compute_eqt_int:
+            t_int = (torch.rand([n, 2], device=opts.device) * 2 - 1) * translate_max
+            t_int = (t_int * G.img_resolution).round() / G.img_resolution
+            transforms.append(I.repeat([n, 1, 1]))
+            transforms[-1][:, :2, 2] = -t_int
+        if compute_eqt_frac:
+            t_frac = (torch.rand([n, 2], device=opts.device) * 2 - 1) * translate_max
+            transforms.append(I.repeat([n, 1, 1]))
+            transforms[-1][:, :2, 2] = -t_frac
+        if compute_eqr:
+            angle = ((torch.rand([n], device=opts.device) * 2 - 1) * (num_angles // 2)).round() * (rotate_max * np.pi / (num_angles // 2))
+            transforms.append(torch.stack([rotation_matrix(-a) for a in angle]))
+
+        # Render the reference and transformed images at once.
+        imgs = synthesis_with_transform(G.synthesis, ws.repeat([num_renders, 1, 1]), torch.cat(transforms), noise_mode='const', **opts.G_kwargs)
+        orig, *imgs = imgs.split(n)
 
         # Integer translation (EQ-T).
         if compute_eqt_int:
-            t = (torch.rand(2, device=opts.device) * 2 - 1) * translate_max
-            t = (t * G.img_resolution).round() / G.img_resolution
-            M[:] = I
-            M[:2, 2] = -t
-            img = G.synthesis(ws=ws, noise_mode='const', **opts.G_kwargs)
-            ref, mask = apply_integer_translation(orig, t[0], t[1])
+            img = imgs.pop(0)
+            ref, mask = apply_per_sample(apply_integer_translation, orig, t_int[:, 0], t_int[:, 1])
             s += [(ref - img).square() * mask, mask]
 
         # Fractional translation (EQ-T_frac).
         if compute_eqt_frac:
-            t = (torch.rand(2, device=opts.device) * 2 - 1) * translate_max
-            M[:] = I
-            M[:2, 2] = -t
-            img = G.synthesis(ws=ws, noise_mode='const', **opts.G_kwargs)
-            ref, mask = apply_fractional_translation(orig, t[0], t[1])
+            img = imgs.pop(0)
+            ref, mask = apply_per_sample(apply_fractional_translation, orig, t_frac[:, 0], t_frac[:, 1])
             s += [(ref - img).square() * mask, mask]
 
         # Rotation (EQ-R).
         if compute_eqr:
-            angle = (torch.rand([], device=opts.device) * 2 - 1) * (rotate_max * np.pi)
-            M[:] = rotation_matrix(-angle)
-            img = G.synthesis(ws=ws, noise_mode='const', **opts.G_kwargs)
-            ref, ref_mask = apply_fractional_rotation(orig, angle)
-            pseudo, pseudo_mask = apply_fractional_pseudo_rotation(img, angle)
+            img = imgs.pop(0)
+            ref, ref_mask = apply_per_sample(apply_fractional_rotation, orig, angle)
+            pseudo, pseudo_mask = apply_per_sample(apply_fractional_pseudo_rotation, img, angle)
             mask = ref_mask * pseudo_mask
             s += [(ref - pseudo).square() * mask, mask]
 
-        # Accumulate results.
-        s = torch.stack([x.to(torch.float64).sum() for x in s])
+        return torch.stack([x.to(torch.float64).sum() for x in s])
+
+    # Setup batch size and labels.
+    if batch_size is None:
+        batch_size = metric_utils.find_batch_size(lambda n: run_batch(torch.zeros([n, G.c_dim], device=opts.device)), opts, max_batch_size=max_batch_size)
+    c_iter = metric_utils.iterate_random_labels(opts=opts, batch_size=batch_size)
+
+    # Sampling loop.
+    sums = None
+    progress = opts.progress.sub(tag='eq sampling', num_items=num_samples)
+    for batch_start in range(0, num_samples, batch_size * opts.num_gpus):
+        progress.update(batch_start)
+        s = run_batch(next(c_iter))
         sums = sums + s if sums is not None else s
     progress.update(num_samples)
 
@@ -12,16 +12,24 @@ equilibrium". Matches the original implementation by Heusel et al. at
 https://github.com/bioinf-jku/TTUR/blob/master/fid.py"""
 
 import numpy as np
+import torch
 import scipy.linalg
+import scipy.stats
 from . import metric_utils
 
 #----------------------------------------------------------------------------
 
-def compute_fid(opts, max_real, num_gen):
-    # Direct TorchScript translation of http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
-    detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/inception-2015-12-05.pkl'
-    detector_kwargs = dict(return_features=True) # Return raw features before the softmax layer.
+# Direct TorchScript translation of http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
+detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/inception-2015-12-05.pkl'
+detector_kwargs = dict(return_features=True) # Return raw features before the softmax layer.
+
+def gen_feature_requests(num_gen, num_splits=0, report_at=()):
+    return [metric_utils.gen_feature_request(detector_url=detector_url, detector_kwargs=detector_kwargs, capture_mean_cov=True,
+        max_items=num_gen, num_splits=num_splits, report_at=report_at)]
 
+#----------------------------------------------------------------------------
+
+def compute_fid(opts, max_real, num_gen):
     mu_real, sigma_real = metric_utils.compute_feature_stats_for_dataset(
         opts=opts, detector_url=detector_url, detector_kwargs=detector_kwargs,
         rel_lo=0, rel_hi=0, capture_mean_cov=True, max_items=max_real).get_mean_cov()
@@ -32,10 +40,105 @@ def compute_fid(opts, max_real, num_gen):
 
     if opts.rank != 0:
         return float('nan')
+    return fid_from_mean_cov(mu_gen, sigma_gen, mu_real, sigma_real, device=opts.device)
 
-    m = np.square(mu_gen - mu_real).sum()
-    s, _ = scipy.linalg.sqrtm(np.dot(sigma_gen, sigma_real), disp=False) # pylint: disable=no-member
-    fid = np.real(m + np.trace(sigma_gen + sigma_real - s * 2))
+#----------------------------------------------------------------------------
+# Frechet distance between two Gaussians. The default method avoids the
+# general matrix square root of sigma_gen @ sigma_real: that product has the
+# same eigenvalues as the symmetric PSD matrix sqrt(sigma_real) @ sigma_gen @
+# sqrt(sigma_real), so the trace of its square root is the sum of the square
+# roots of the eigenvalues of the latter. Both eigendecompositions are
+# symmetric and run in float64 on the given device. method='sqrtm' uses
+# scipy.linalg.sqrtm on the host instead, as in the original implementation.
+
+def sqrt_psd(sigma, device=None): # Symmetric square root of a PSD matrix, as a float64 tensor.
+    sigma = torch.as_tensor(sigma, dtype=torch.float64, device=device)
+    eigval, eigvec = torch.linalg.eigh((sigma + sigma.T) / 2)
+    return (eigvec * eigval.clamp(min=0).sqrt()) @ eigvec.T
+
+def fid_from_mean_cov(mu_gen, sigma_gen, mu_real, sigma_real, device=None, method='eigh', sqrt_sigma_real=None):
+    if method == 'sqrtm':
+        mu_gen, sigma_gen, mu_real, sigma_real = [np.asarray(torch.as_tensor(x).cpu(), dtype=np.float64) for x in [mu_gen, sigma_gen, mu_real, sigma_real]]
+        m = np.square(mu_gen - mu_real).sum()
+        s, _ = scipy.linalg.sqrtm(np.dot(sigma_gen, sigma_real), disp=False) # pylint: disable=no-member
+        fid = np.real(m + np.trace(sigma_gen + sigma_real - s * 2))
+        return float(fid)
+
+    assert method == 'eigh'
+    mu_gen, sigma_gen, mu_real, sigma_real = [torch.as_tensor(x, dtype=torch.float64, device=device) for x in [mu_gen, sigma_gen, mu_real, sigma_real]]
+    if sqrt_sigma_real is None:
+        sqrt_sigma_real = sqrt_psd(sigma_real, device=device)
+    prod = sqrt_sigma_real @ sigma_gen @ sqrt_sigma_real
+    eigval = torch.linalg.eigvalsh((prod + prod.T) / 2)
+    m = (mu_gen - mu_real).square().sum()
+    fid = m + sigma_gen.trace() + sigma_real.trace() - eigval.clamp(min=0).sqrt().sum() * 2
     return float(fid)
 
 #----------------------------------------------------------------------------
+# FID at several sample counts from a single generator pass, with a grouped
+# jackknife confidence interval. The generated samples are dealt round-robin
+# into num_splits disjoint groups, and the FID is recomputed with each group
+# left out in turn, from moments that cover all but n/num_splits samples.
+# Unlike the FIDs of the individual groups, these are not dominated by the
+# small-sample bias of the 2048-d covariance. Returns {num_items: (fid, ci95,
+# fid_unbiased)} for the report_at points reached and num_gen itself, where
+# ci95 is the half-width of the 95% confidence interval and fid_unbiased is
+# the jackknife estimate with the O(1/n) bias removed, along with the number
+# of samples at which the pass stopped early, or None. If stop_above is given,
+# the pass ends as soon as fid_unbiased exceeds it by more than ci95; the FID
+# at any larger sample count would be higher still.
+
+def _leave_one_out(mean, cov, num_items, splits, device=None): # Yields (mean, cov) of the samples outside each split.
+    mean, cov = [torch.as_tensor(x, dtype=torch.float64, device=device) for x in [mean, cov]]
+    for split_idx, (mean_k, cov_k) in enumerate(splits):
+        n_k = num_items // len(splits) + (1 if split_idx < num_items % len(splits) else 0) # round-robin, see FeatureStats.append()
+        n_c = num_items - n_k
+        mean_k, cov_k = [torch.as_tensor(x, dtype=torch.float64, device=device) for x in [mean_k, cov_k]]
+        mean_c = (mean * num_items - mean_k * n_k) / n_c
+        delta = mean_k - mean_c
+        m2_c = cov * num_items - cov_k * n_k - delta.outer(delta) * (n_k * n_c / num_items) # inverse of the pairwise merge
+        yield mean_c, m2_c / n_c
+
+def compute_fid_progressive(opts, max_real, num_gen, report_at, num_splits=10, stop_above=None):
+    assert num_splits >= 2
+    mu_real, sigma_real = metric_utils.compute_feature_stats_for_dataset(
+        opts=opts, detector_url=detector_url, detector_kwargs=detector_kwargs,
+        rel_lo=0, rel_hi=0, capture_mean_cov=True, max_items=max_real).get_mean_cov()
+
+    results = dict()
+    sqrt_sigma_real = sqrt_psd(sigma_real, device=opts.device) if opts.rank == 0 else None
+    t95 = float(scipy.stats.t.ppf(0.975, num_splits - 1))
+    def evaluate(stats, num_items):
+        if num_items not in results:
+            (mu_gen, sigma_gen), splits = stats.get_report(num_items)
+            fid = fid_from_mean_cov(mu_gen, sigma_gen, mu_real, sigma_real, device=opts.device, sqrt_sigma_real=sqrt_sigma_real)
+            loo_fids = np.array([fid_from_mean_cov(mu, sigma, mu_real, sigma_real, device=opts.device, sqrt_sigma_real=sqrt_sigma_real)
+                for mu, sigma in _leave_one_out(mu_gen, sigma_gen, num_items, splits, device=opts.device)])
+            ci95 = t95 * float(np.sqrt((num_splits - 1) / num_splits * np.square(loo_fids - loo_fids.mean()).sum()))
+            fid_unbiased = float(num_splits * fid - (num_splits - 1) * loo_fids.mean())
+            results[num_items] = (fid, ci95, fid_unbiased)
+        return results[num_items]
+
+    def stop_fn(stats):
+        if stop_above is None:
+            return False
+        flag = False
+        if opts.rank == 0:
+            _fid, ci95, fid_unbiased = evaluate(stats, max(stats.reports))
+            flag = (fid_unbiased - ci95 > stop_above)
+        if opts.num_gpus > 1:
+            flag = torch.as_tensor(flag, dtype=torch.float32, device=opts.device)
+            torch.distributed.broadcast(tensor=flag, src=0)
+            flag = (float(flag.cpu()) != 0)
+        return flag
+
+    stats = metric_utils.compute_feature_stats_for_generator(
+        opts=opts, detector_url=detector_url, detector_kwargs=detector_kwargs, rel_lo=0, rel_hi=1, stop_fn=stop_fn,
+        capture_mean_cov=True, max_items=num_gen, num_splits=num_splits, report_at=[n for n in report_at if n < num_gen])
+    stopped_at = stats.num_items if stats.num_items < num_gen else None
+    all_items = sorted(set(stats.reports) | ({num_gen} if stopped_at is None else set()))
+    if opts.rank != 0:
+        return {num_items: (float('nan'), float('nan'), float('nan')) for num_items in all_items}, stopped_at
+    return {num_items: evaluate(stats, num_items) for num_items in all_items}, stopped_at
+
+#----------------------------------------------------------------------------
@@ -15,11 +15,16 @@ from . import metric_utils
 
 #----------------------------------------------------------------------------
 
-def compute_is(opts, num_gen, num_splits):
-    # Direct TorchScript translation of http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
-    detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/inception-2015-12-05.pkl'
-    detector_kwargs = dict(no_output_bias=True) # Match the original implementation by not applying bias in the softmax layer.
+# Direct TorchScript translation of http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
+detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/inception-2015-12-05.pkl'
+detector_kwargs = dict(no_output_bias=True) # Match the original implementation by not applying bias in the softmax layer.
+
+def gen_feature_requests(num_gen):
+    return [metric_utils.gen_feature_request(detector_url=detector_url, detector_kwargs=detector_kwargs, capture_all=True, max_items=num_gen)]
 
+#----------------------------------------------------------------------------
+
+def compute_is(opts, num_gen, num_splits):
     gen_probs = metric_utils.compute_feature_stats_for_generator(
         opts=opts, detector_url=detector_url, detector_kwargs=detector_kwargs,
         capture_all=True, max_items=num_gen).get_all()
@@ -11,35 +11,67 @@ GANs". Matches the original implementation by Binkowski et al. at
 https://github.com/mbinkowski/MMD-GAN/blob/master/gan/compute_scores.py"""
 
 import numpy as np
+import torch
 from . import metric_utils
 
 #----------------------------------------------------------------------------
 
-def compute_kid(opts, max_real, num_gen, num_subsets, max_subset_size):
-    # Direct TorchScript translation of http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
-    detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/inception-2015-12-05.pkl'
-    detector_kwargs = dict(return_features=True) # Return raw features before the softmax layer.
+# Direct TorchScript translation of http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
+detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/inception-2015-12-05.pkl'
+detector_kwargs = dict(return_features=True) # Return raw features before the softmax layer.
+
+def gen_feature_requests(num_gen):
+    return [metric_utils.gen_feature_request(detector_url=detector_url, detector_kwargs=detector_kwargs, capture_all=True, keep_on_device=True, max_items=num_gen)]
 
+#----------------------------------------------------------------------------
+
+def compute_kid(opts, max_real, num_gen, num_subsets, max_subset_size):
     real_features = metric_utils.compute_feature_stats_for_dataset(
         opts=opts, detector_url=detector_url, detector_kwargs=detector_kwargs,
-        rel_lo=0, rel_hi=0, capture_all=True, max_items=max_real).get_all()
+        rel_lo=0, rel_hi=0, capture_all=True, max_items=max_real).get_all_torch()
 
     gen_features = metric_utils.compute_feature_stats_for_generator(
         opts=opts, detector_url=detector_url, detector_kwargs=detector_kwargs,
-        rel_lo=0, rel_hi=1, capture_all=True, max_items=num_gen).get_all()
+        rel_lo=0, rel_hi=1, capture_all=True, keep_on_device=True, max_items=num_gen).get_all_torch()
 
+    kid = compute_kid_from_features(gen_features, real_features, num_subsets=num_subsets, max_subset_size=max_subset_size,
+        num_gpus=opts.num_gpus, rank=opts.rank, device=opts.device)
     if opts.rank != 0:
         return float('nan')
+    return kid
 
+#----------------------------------------------------------------------------
+# Unbiased MMD^2 with a cubic polynomial kernel, averaged over random subsets.
+# The subsets are split between the ranks and evaluated subsets_per_chunk at a
+# time as batched matrix products on the device. The rows of each chunk are
+# gathered on the device that holds the features, so only the selected real
+# features are copied when the full set lives on the host. The kernels are
+# summed in float64.
+
+def compute_kid_from_features(gen_features, real_features, num_subsets, max_subset_size, num_gpus=1, rank=0, device=torch.device('cpu'), subsets_per_chunk=10):
     n = real_features.shape[1]
     m = min(min(real_features.shape[0], gen_features.shape[0]), max_subset_size)
-    t = 0
-    for _subset_idx in range(num_subsets):
-        x = gen_features[np.random.choice(gen_features.shape[0], m, replace=False)]
-        y = real_features[np.random.choice(real_features.shape[0], m, replace=False)]
-        a = (x @ x.T / n + 1) ** 3 + (y @ y.T / n + 1) ** 3
-        b = (x @ y.T / n + 1) ** 3
-        t += (a.sum() - np.diag(a).sum()) / (m - 1) - b.sum() * 2 / m
+
+    # Choose the subsets on rank 0, in the same order as the original implementation.
+    subsets = torch.zeros([num_subsets, 2, m], dtype=torch.int64, device=device)
+    if rank == 0:
+        for subset_idx in range(num_subsets):
+            subsets[subset_idx, 0] = torch.from_numpy(np.random.choice(gen_features.shape[0], m, replace=False))
+            subsets[subset_idx, 1] = torch.from_numpy(np.random.choice(real_features.shape[0], m, replace=False))
+    if num_gpus > 1:
+        torch.distributed.broadcast(subsets, src=0)
+
+    t = torch.zeros([], dtype=torch.float64, device=device)
+    for chunk in subsets[rank::num_gpus].split(subsets_per_chunk):
+        x = gen_features[chunk[:, 0].to(gen_features.device)].to(device, torch.float32)
+        y = real_features[chunk[:, 1].to(real_features.device)].to(device, torch.float32)
+        kxx = (torch.bmm(x, x.transpose(1, 2)).to(torch.float64) / n + 1) ** 3
+        kyy = (torch.bmm(y, y.transpose(1, 2)).to(torch.float64) / n + 1) ** 3
+        kxy = (torch.bmm(x, y.transpose(1, 2)).to(torch.float64) / n + 1) ** 3
+        a = kxx.sum() + kyy.sum() - kxx.diagonal(dim1=1, dim2=2).sum() - kyy.diagonal(dim1=1, dim2=2).sum()
+        t += a / (m - 1) - kxy.sum() * 2 / m
+    if num_gpus > 1:
+        torch.distributed.all_reduce(t)
     kid = t / num_subsets / m
     return float(kid)
 
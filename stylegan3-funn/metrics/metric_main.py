@@ -25,12 +25,19 @@ from . import equivariance
 #----------------------------------------------------------------------------
 
 _metric_dict = dict() # name => fn
+_metric_gen_features = dict() # name => [metric_utils.gen_feature_request(), ...]
 
 def register_metric(fn):
     assert callable(fn)
     _metric_dict[fn.__name__] = fn
     return fn
 
+def gen_features(requests): # Declare the generator features that a metric will ask for, see calc_metrics().
+    def decorator(fn):
+        _metric_gen_features[fn.__name__] = list(requests)
+        return fn
+    return decorator
+
 def is_valid_metric(metric):
     return metric in _metric_dict
 
@@ -65,6 +72,34 @@ def calc_metric(metric, **kwargs): # See metric_utils.MetricOptions for the full
         num_gpus        = opts.num_gpus,
     )
 
+#----------------------------------------------------------------------------
+# Like calc_metric(), but for several metrics at once. Metrics that consume
+# generator features of the same length share a single generator pass, e.g.,
+# fid50k_full and kid50k_full generate their 50k images only once.
+
+def calc_metrics(metrics, progress=None, **kwargs): # Yields one result dict per metric, see calc_metric().
+    assert all(is_valid_metric(metric) for metric in metrics)
+    opts = metric_utils.MetricOptions(progress=progress, gen_stats_cache=dict(), **kwargs)
+    verbose = (opts.rank == 0 and progress is not None and progress.verbose)
+
+    # Group the declared generator feature requests by the number of images.
+    groups = dict() # max_items => [request, ...]
+    for metric in metrics:
+        for request in _metric_gen_features.get(metric, []):
+            groups.setdefault(request.max_items, []).append(request)
+
+    # Run the shared passes. A lone request is left for its metric to compute as usual.
+    for max_items, requests in groups.items():
+        if len(requests) > 1:
+            if verbose:
+                print(f'Calculating shared generator features for {len(requests)} requests ({max_items} images)...')
+            metric_utils.compute_feature_stats_for_generator_multi(opts, requests)
+
+    for metric in metrics:
+        if verbose:
+            print(f'Calculating {metric}...')
+        yield calc_metric(metric, progress=progress, gen_stats_cache=opts.gen_stats_cache, **kwargs)
+
 #----------------------------------------------------------------------------
 
 def report_metric(result_dict, run_dir=None, snapshot_pkl=None):
@@ -83,68 +118,103 @@ def report_metric(result_dict, run_dir=None, snapshot_pkl=None):
 # Recommended metrics.
 
 @register_metric
+@gen_features(frechet_inception_distance.gen_feature_requests(num_gen=50000))
 def fid50k_full(opts):
     opts.dataset_kwargs.update(max_size=None, xflip=False)
     fid = frechet_inception_distance.compute_fid(opts, max_real=None, num_gen=50000)
     return dict(fid50k_full=fid)
 
 @register_metric
+@gen_features(frechet_inception_distance.gen_feature_requests(num_gen=50000, num_splits=10, report_at=[10000, 25000]))
+def fid50k_full_prog(opts): # fid50k_full, plus estimates and confidence intervals at 10k and 25k samples. Stops early if opts.fid_stop_above is exceeded.
+    opts.dataset_kwargs.update(max_size=None, xflip=False)
+    results = dict(fid50k_full_prog=float('nan'), fid50k_full_prog_ci95=float('nan'), fid50k_full_prog_unbiased=float('nan')) # NaN if stopped early
+    progressive, stopped_at = frechet_inception_distance.compute_fid_progressive(opts, max_real=None, num_gen=50000, report_at=[10000, 25000], num_splits=10, stop_above=opts.fid_stop_above)
+    if stopped_at is not None:
+        results['fid50k_full_prog_stopped_at'] = stopped_at
+    for num_items, (fid, ci95, fid_unbiased) in progressive.items():
+        suffix = '' if num_items == 50000 else f'_{num_items//1000}k'
+        results[f'fid50k_full_prog{suffix}'] = fid
+        results[f'fid50k_full_prog{suffix}_ci95'] = ci95
+        results[f'fid50k_full_prog{suffix}_unbiased'] = fid_unbiased
+    return results
+
+@register_metric
+@gen_features(kernel_inception_distance.gen_feature_requests(num_gen=50000))
 def kid50k_full(opts):
     opts.dataset_kwargs.update(max_size=None, xflip=False)
     kid = kernel_inception_distance.compute_kid(opts, max_real=1000000, num_gen=50000, num_subsets=100, max_subset_size=1000)
     return dict(kid50k_full=kid)
 
 @register_metric
+@gen_features(precision_recall.gen_feature_requests(num_gen=50000))
 def pr50k3_full(opts):
     opts.dataset_kwargs.update(max_size=None, xflip=False)
     precision, recall = precision_recall.compute_pr(opts, max_real=200000, num_gen=50000, nhood_size=3, row_batch_size=10000, col_batch_size=10000)
     return dict(pr50k3_full_precision=precision, pr50k3_full_recall=recall)
 
+@register_metric
+@gen_features(precision_recall.gen_feature_requests(num_gen=50000))
+def pr50k3_full_approx(opts): # pr50k3_full with approximate neighbour search, plus agreement of the k-th neighbour radii with exact search.
+    opts.dataset_kwargs.update(max_size=None, xflip=False)
+    results = precision_recall.compute_pr_approx(opts, max_real=200000, num_gen=50000, nhood_size=3)
+    return {f'pr50k3_full_approx_{key}': value for key, value in results.items()}
+
 @register_metric
 def ppl2_wend(opts):
-    ppl = perceptual_path_length.compute_ppl(opts, num_samples=50000, epsilon=1e-4, space='w', sampling='end', crop=False, batch_size=2)
+    ppl = perceptual_path_length.compute_ppl(opts, num_samples=50000, epsilon=1e-4, space='w', sampling='end', crop=False)
     return dict(ppl2_wend=ppl)
 
 @register_metric
 def eqt50k_int(opts):
     opts.G_kwargs.update(force_fp32=True)
-    psnr = equivariance.compute_equivariance_metrics(opts, num_samples=50000, batch_size=4, compute_eqt_int=True)
+    psnr = equivariance.compute_equivariance_metrics(opts, num_samples=50000, compute_eqt_int=True)
     return dict(eqt50k_int=psnr)
 
 @register_metric
 def eqt50k_frac(opts):
     opts.G_kwargs.update(force_fp32=True)
-    psnr = equivariance.compute_equivariance_metrics(opts, num_samples=50000, batch_size=4, compute_eqt_frac=True)
+    psnr = equivariance.compute_equivariance_metrics(opts, num_samples=50000, compute_eqt_frac=True)
     return dict(eqt50k_frac=psnr)
 
 @register_metric
 def eqr50k(opts):
     opts.G_kwargs.update(force_fp32=True)
-    psnr = equivariance.compute_equivariance_metrics(opts, num_samples=50000, batch_size=4, compute_eqr=True)
+    psnr = equivariance.compute_equivariance_metrics(opts, num_samples=50000, compute_eqr=True)
     return dict(eqr50k=psnr)
 
+@register_metric
+def eq50k(opts): # EQ-T, EQ-T_frac, and EQ-R from the same reference images.
+    opts.G_kwargs.update(force_fp32=True)
+    eqt_int, eqt_frac, eqr = equivariance.compute_equivariance_metrics(opts, num_samples=50000, compute_eqt_int=True, compute_eqt_frac=True, compute_eqr=True)
+    return dict(eqt50k_int=eqt_int, eqt50k_frac=eqt_frac, eqr50k=eqr)
+
 #----------------------------------------------------------------------------
 # Legacy metrics.
 
 @register_metric
+@gen_features(frechet_inception_distance.gen_feature_requests(num_gen=50000))
 def fid50k(opts):
     opts.dataset_kwargs.update(max_size=None)
     fid = frechet_inception_distance.compute_fid(opts, max_real=50000, num_gen=50000)
     return dict(fid50k=fid)
 
 @register_metric
+@gen_features(kernel_inception_distance.gen_feature_requests(num_gen=50000))
 def kid50k(opts):
     opts.dataset_kwargs.update(max_size=None)
     kid = kernel_inception_distance.compute_kid(opts, max_real=50000, num_gen=50000, num_subsets=100, max_subset_size=1000)
     return dict(kid50k=kid)
 
 @register_metric
+@gen_features(precision_recall.gen_feature_requests(num_gen=50000))
 def pr50k3(opts):
     opts.dataset_kwargs.update(max_size=None)
     precision, recall = precision_recall.compute_pr(opts, max_real=50000, num_gen=50000, nhood_size=3, row_batch_size=10000, col_batch_size=10000)
     return dict(pr50k3_precision=precision, pr50k3_recall=recall)
 
 @register_metric
+@gen_features(inception_score.gen_feature_requests(num_gen=50000))
 def is50k(opts):
     opts.dataset_kwargs.update(max_size=None, xflip=False)
     mean, std = inception_score.compute_is(opts, num_gen=50000, num_splits=10)
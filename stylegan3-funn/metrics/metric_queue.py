@@ -0,0 +1,158 @@
+# Copyright (c) 2021, NVIDIA CORPORATION & AFFILIATES.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+"""File-based queue for evaluating quality metrics of network snapshots in a
+separate worker process while training continues. The worker may run on a
+different device, or on a different host that shares the run directory."""
+
+import os
+import sys
+import glob
+import json
+import time
+import uuid
+import socket
+import traceback
+import subprocess
+import dnnlib
+import legacy
+
+from . import metric_main
+from . import metric_utils
+
+#----------------------------------------------------------------------------
+
+def _queue_dir(run_dir):
+    return os.path.join(run_dir, 'metric-queue')
+
+def _done_file(run_dir):
+    return os.path.join(_queue_dir(run_dir), 'done')
+
+def _write_json_atomic(fname, data):
+    temp_file = fname + '.' + uuid.uuid4().hex
+    with open(temp_file, 'wt') as f:
+        json.dump(data, f)
+    os.replace(temp_file, fname) # atomic
+
+#----------------------------------------------------------------------------
+# Producer side, called by the training loop on rank 0.
+
+def enqueue_snapshot(run_dir, snapshot_pkl, metrics, kimg, max_pending=2):
+    os.makedirs(_queue_dir(run_dir), exist_ok=True)
+    name = os.path.splitext(os.path.basename(snapshot_pkl))[0]
+    job = dict(snapshot_pkl=os.path.relpath(snapshot_pkl, run_dir), metrics=list(metrics), kimg=kimg, max_pending=max_pending)
+    _write_json_atomic(os.path.join(_queue_dir(run_dir), name + '.json'), job)
+    _drop_stale_jobs(run_dir, max_pending)
+
+def enqueue_done(run_dir):
+    os.makedirs(_queue_dir(run_dir), exist_ok=True)
+    with open(_done_file(run_dir), 'wt') as f:
+        f.write(f'{time.time()}\n')
+
+# The worker exits once the queue is empty and either enqueue_done() has been
+# called or this process is gone. Call wait() on the result before exiting.
+def launch_worker(run_dir, device):
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'calc_metrics.py')
+    with open(os.path.join(run_dir, 'log-metrics.txt'), 'at') as log: # the worker keeps its own handle
+        return subprocess.Popen([sys.executable, script, f'--watch={run_dir}', f'--device={device}', f'--parent-pid={os.getpid()}'],
+            stdout=log, stderr=subprocess.STDOUT)
+
+#----------------------------------------------------------------------------
+# Consumer side.
+
+def _pending_jobs(run_dir):
+    return sorted(glob.glob(os.path.join(_queue_dir(run_dir), '*.json'))) # oldest first
+
+def _drop_stale_jobs(run_dir, max_pending):
+    for job_file in _pending_jobs(run_dir)[:-max_pending]:
+        try:
+            os.remove(job_file)
+            print(f'Skipping stale snapshot: {os.path.basename(job_file)}')
+        except FileNotFoundError:
+            pass # claimed by a worker in the meantime
+
+def _claim_next_job(run_dir):
+    for job_file in _pending_jobs(run_dir):
+        claimed_file = f'{job_file}.{socket.gethostname()}-{os.getpid()}.running'
+        try:
+            os.rename(job_file, claimed_file) # atomic; fails if another worker got there first or the job was dropped
+        except FileNotFoundError:
+            continue
+        with open(claimed_file, 'rt') as f:
+            job = json.load(f)
+        if len(_pending_jobs(run_dir)) >= job['max_pending']: # the claimed job is older than all pending ones
+            os.remove(claimed_file)
+            print(f'Skipping stale snapshot: {os.path.basename(job_file)}')
+            continue
+        _drop_stale_jobs(run_dir, job['max_pending']) # only after the claim, so that this job is not among them
+        return job, claimed_file
+    return None, None
+
+def evaluate_snapshot(run_dir, job, device, verbose=True):
+    snapshot_pkl = os.path.join(run_dir, job['snapshot_pkl'])
+    with dnnlib.util.open_url(snapshot_pkl, verbose=verbose) as f:
+        network_dict = legacy.load_network_pkl(f)
+    results = dict()
+    if verbose:
+        print(f'Evaluating {job["snapshot_pkl"]}...')
+    progress = metric_utils.ProgressMonitor(verbose=verbose)
+    for result_dict in metric_main.calc_metrics(metrics=job['metrics'], G=network_dict['G_ema'], dataset_kwargs=network_dict['training_set_kwargs'],
+            num_gpus=1, rank=0, device=device, progress=progress):
+        metric_main.report_metric(result_dict, run_dir=run_dir, snapshot_pkl=snapshot_pkl)
+        results.update(result_dict.results)
+    return results
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # exists, but owned by someone else
+    return True
+
+def _record_failure(claimed_file, job, err):
+    failed_file = claimed_file[:-len('.running')] + '.failed'
+    _write_json_atomic(failed_file, dict(job, error=''.join(traceback.format_exception(type(err), err, err.__traceback__))))
+    os.remove(claimed_file)
+
+def run_worker(run_dir, device, verbose=True, poll_interval=10, parent_pid=None):
+    stats_tfevents = None
+    try:
+        import torch.utils.tensorboard as tensorboard
+        stats_tfevents = tensorboard.SummaryWriter(run_dir, filename_suffix='.metrics')
+    except ImportError as err:
+        print('Skipping tfevents export:', err)
+
+    while True:
+        job, claimed_file = _claim_next_job(run_dir)
+        if job is None:
+            if os.path.isfile(_done_file(run_dir)):
+                break
+            if parent_pid is not None and not _is_process_alive(parent_pid):
+                print(f'Training process {parent_pid} is gone and the metric queue is empty; exiting...')
+                return
+            time.sleep(poll_interval)
+            continue
+        try:
+            results = evaluate_snapshot(run_dir=run_dir, job=job, device=device, verbose=verbose)
+        except Exception as err: # pylint: disable=broad-except
+            print(f'Failed to evaluate {job["snapshot_pkl"]}:')
+            traceback.print_exc()
+            _record_failure(claimed_file, job, err)
+            continue
+        if stats_tfevents is not None:
+            for name, value in results.items():
+                stats_tfevents.add_scalar(f'Metrics/{name}', value, global_step=job['kimg'], walltime=time.time())
+            stats_tfevents.flush()
+        os.remove(claimed_file)
+
+    if verbose:
+        print('Training is done and the metric queue is empty; exiting...')
+
+#----------------------------------------------------------------------------
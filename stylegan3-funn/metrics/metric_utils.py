@@ -9,7 +9,9 @@
 """Miscellaneous utilities used internally by the quality metrics."""
 
 import os
+import glob
 import time
+import json
 import hashlib
 import pickle
 import copy
@@ -21,16 +23,18 @@ import dnnlib
 #----------------------------------------------------------------------------
 
 class MetricOptions:
-    def __init__(self, G=None, G_kwargs={}, dataset_kwargs={}, num_gpus=1, rank=0, device=None, progress=None, cache=True):
+    def __init__(self, G=None, G_kwargs={}, dataset_kwargs={}, num_gpus=1, rank=0, device=None, progress=None, cache=True, gen_stats_cache=None, fid_stop_above=None):
         assert 0 <= rank < num_gpus
-        self.G              = G
-        self.G_kwargs       = dnnlib.EasyDict(G_kwargs)
-        self.dataset_kwargs = dnnlib.EasyDict(dataset_kwargs)
-        self.num_gpus       = num_gpus
-        self.rank           = rank
-        self.device         = device if device is not None else torch.device('cuda', rank)
-        self.progress       = progress.sub() if progress is not None and rank == 0 else ProgressMonitor()
-        self.cache          = cache
+        self.G               = G
+        self.G_kwargs        = dnnlib.EasyDict(G_kwargs)
+        self.dataset_kwargs  = dnnlib.EasyDict(dataset_kwargs)
+        self.num_gpus        = num_gpus
+        self.rank            = rank
+        self.device          = device if device is not None else torch.device('cuda', rank)
+        self.progress        = progress.sub() if progress is not None and rank == 0 else ProgressMonitor()
+        self.cache           = cache
+        self.gen_stats_cache = gen_stats_cache # dict shared between metrics to reuse generator features, or None
+        self.fid_stop_above  = fid_stop_above  # fid50k_full_prog stops generating once the FID is above this with 95% confidence, or None
 
 #----------------------------------------------------------------------------
 
@@ -54,59 +58,114 @@ def get_feature_detector(url, device=torch.device('cpu'), num_gpus=1, rank=0, ve
 
 #----------------------------------------------------------------------------
 
+_label_dataset_cache = dict()
+
+def get_label_dataset(opts):
+    key = repr(sorted(opts.dataset_kwargs.items()))
+    if key not in _label_dataset_cache:
+        _label_dataset_cache[key] = dnnlib.util.construct_class_by_name(**opts.dataset_kwargs)
+    return _label_dataset_cache[key]
+
 def iterate_random_labels(opts, batch_size):
     if opts.G.c_dim == 0:
         c = torch.zeros([batch_size, opts.G.c_dim], device=opts.device)
         while True:
             yield c
     else:
-        dataset = dnnlib.util.construct_class_by_name(**opts.dataset_kwargs)
+        dataset = get_label_dataset(opts)
         while True:
-            c = [dataset.get_label(np.random.randint(len(dataset))) for _i in range(batch_size)]
-            c = torch.from_numpy(np.stack(c)).pin_memory().to(opts.device)
-            yield c
+            yield dataset.sample_labels(batch_size, device=opts.device)
 
 #----------------------------------------------------------------------------
 
+# Largest power-of-two batch size up to max_batch_size for which run_fn(batch_size)
+# fits in memory, agreed upon by all ranks.
+
+def find_batch_size(run_fn, opts, max_batch_size):
+    batch_size = max_batch_size
+    while batch_size > 1:
+        try:
+            run_fn(batch_size)
+            break
+        except RuntimeError as err: # torch.cuda.OutOfMemoryError is a RuntimeError
+            if 'out of memory' not in str(err):
+                raise
+            torch.cuda.empty_cache()
+            batch_size //= 2
+    if opts.num_gpus > 1:
+        batch_size = torch.as_tensor(batch_size, device=opts.device)
+        torch.distributed.all_reduce(batch_size, op=torch.distributed.ReduceOp.MIN)
+        batch_size = int(batch_size.cpu())
+    return batch_size
+
+#----------------------------------------------------------------------------
+
+# Streaming feature statistics. The mean and covariance are accumulated on
+# the device of the incoming features by merging the centered moments of each
+# batch (Chan et al.), which stays accurate in float64 regardless of the
+# feature magnitudes. With keep_on_device=True, the captured features stay
+# on their device too, so that metrics can reuse them without a round trip
+# through the host. Optionally keeps num_splits disjoint accumulators for
+# estimating the spread of derived metrics, and records the moments whenever
+# num_items reaches one of report_at, so that metrics can be evaluated at
+# several sample counts from a single pass.
+
 class FeatureStats:
-    def __init__(self, capture_all=False, capture_mean_cov=False, max_items=None):
+    def __init__(self, capture_all=False, capture_mean_cov=False, max_items=None, num_splits=0, report_at=(), keep_on_device=False):
         self.capture_all = capture_all
+        self.keep_on_device = keep_on_device
         self.capture_mean_cov = capture_mean_cov
         self.max_items = max_items
+        self.num_splits = num_splits
+        self.report_at = tuple(sorted(report_at))
         self.num_items = 0
         self.num_features = None
         self.all_features = None
-        self.raw_mean = None
-        self.raw_cov = None
+        self.mean = None # torch.float64 [num_features]
+        self.m2 = None   # torch.float64 [num_features, num_features], sum of squared deviations from the mean
+        self.splits = [FeatureStats(capture_mean_cov=True) for _ in range(num_splits)] if capture_mean_cov else []
+        self.reports = dict() # num_items => dnnlib.EasyDict(mean_cov, splits)
 
-    def set_num_features(self, num_features):
+    def set_num_features(self, num_features, device=torch.device('cpu')):
         if self.num_features is not None:
             assert num_features == self.num_features
         else:
             self.num_features = num_features
             self.all_features = []
-            self.raw_mean = np.zeros([num_features], dtype=np.float64)
-            self.raw_cov = np.zeros([num_features, num_features], dtype=np.float64)
+            self.mean = torch.zeros([num_features], dtype=torch.float64, device=device)
+            self.m2 = torch.zeros([num_features, num_features], dtype=torch.float64, device=device)
 
     def is_full(self):
         return (self.max_items is not None) and (self.num_items >= self.max_items)
 
     def append(self, x):
-        x = np.asarray(x, dtype=np.float32)
+        x = torch.as_tensor(x)
         assert x.ndim == 2
         if (self.max_items is not None) and (self.num_items + x.shape[0] > self.max_items):
             if self.num_items >= self.max_items:
                 return
             x = x[:self.max_items - self.num_items]
 
-        self.set_num_features(x.shape[1])
-        self.num_items += x.shape[0]
+        # Cut the batch at the next report point.
+        for num_items in self.report_at:
+            if self.num_items < num_items < self.num_items + x.shape[0]:
+                cut = num_items - self.num_items
+                self.append(x[:cut])
+                self.append(x[cut:])
+                return
+
+        self.set_num_features(x.shape[1], device=x.device)
         if self.capture_all:
-            self.all_features.append(x)
+            x32 = x.to(torch.float32)
+            self.all_features.append(x32 if self.keep_on_device else x32.cpu().numpy())
         if self.capture_mean_cov:
-            x64 = x.astype(np.float64)
-            self.raw_mean += x64.sum(axis=0)
-            self.raw_cov += x64.T @ x64
+            x64 = x.to(torch.float64)
+            self.mean, self.m2 = _merge_moments(self.num_items, self.mean.to(x.device), self.m2.to(x.device), x64)
+            for split_idx, split in enumerate(self.splits):
+                split.append(x64[(split_idx - self.num_items) % len(self.splits) :: len(self.splits)])
+        self.num_items += x.shape[0]
+        if self.capture_mean_cov and self.num_items in self.report_at:
+            self.reports[self.num_items] = dnnlib.EasyDict(mean_cov=self.get_mean_cov(), splits=[split.get_mean_cov() for split in self.splits])
 
     def append_torch(self, x, num_gpus=1, rank=0):
         assert isinstance(x, torch.Tensor) and x.ndim == 2
@@ -118,34 +177,69 @@ class FeatureStats:
                 torch.distributed.broadcast(y, src=src)
                 ys.append(y)
             x = torch.stack(ys, dim=1).flatten(0, 1) # interleave samples
-        self.append(x.cpu().numpy())
+        self.append(x)
 
     def get_all(self):
+        return self.get_all_torch().cpu().numpy()
+
+    def get_all_torch(self): # On the device of the features if keep_on_device=True, on the host otherwise.
         assert self.capture_all
-        return np.concatenate(self.all_features, axis=0)
+        return torch.cat([torch.as_tensor(x) for x in self.all_features])
 
-    def get_all_torch(self):
-        return torch.from_numpy(self.get_all())
+    def get_mean_cov_torch(self):
+        assert self.capture_mean_cov
+        return self.mean, self.m2 / self.num_items
 
     def get_mean_cov(self):
-        assert self.capture_mean_cov
-        mean = self.raw_mean / self.num_items
-        cov = self.raw_cov / self.num_items
-        cov = cov - np.outer(mean, mean)
-        return mean, cov
+        mean, cov = self.get_mean_cov_torch()
+        return mean.cpu().numpy(), cov.cpu().numpy()
+
+    def get_report(self, num_items): # Returns (mean, cov) and [(mean, cov), ...] for the splits as of num_items.
+        if num_items == self.num_items:
+            return self.get_mean_cov(), [split.get_mean_cov() for split in self.splits]
+        report = self.reports[num_items]
+        return report.mean_cov, report.splits
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ['mean', 'm2']:
+            if state[name] is not None:
+                state[name] = state[name].cpu()
+        if state['all_features'] is not None:
+            state['all_features'] = [np.asarray(torch.as_tensor(x).cpu()) for x in state['all_features']]
+        return state
 
     def save(self, pkl_file):
         with open(pkl_file, 'wb') as f:
-            pickle.dump(self.__dict__, f)
+            pickle.dump(self.__getstate__(), f)
 
     @staticmethod
     def load(pkl_file):
         with open(pkl_file, 'rb') as f:
             s = dnnlib.EasyDict(pickle.load(f))
         obj = FeatureStats(capture_all=s.capture_all, max_items=s.max_items)
+        if 'raw_mean' in s: # saved by an earlier version that accumulated raw moments
+            raw_mean, raw_cov = s.pop('raw_mean'), s.pop('raw_cov')
+            if raw_mean is not None:
+                s.mean = torch.from_numpy(raw_mean / max(s.num_items, 1))
+                s.m2 = torch.from_numpy(raw_cov) - s.num_items * torch.outer(s.mean, s.mean)
+            else:
+                s.mean = s.m2 = None
         obj.__dict__.update(s)
         return obj
 
+def _merge_moments(num_items, mean, m2, x): # Returns the moments after appending the rows of x.
+    num_new = x.shape[0]
+    if num_new == 0:
+        return mean, m2
+    x_mean = x.mean(dim=0)
+    x_dev = x - x_mean
+    delta = x_mean - mean
+    total = num_items + num_new
+    mean = mean + delta * (num_new / total)
+    m2 = m2 + x_dev.T @ x_dev + torch.outer(delta, delta) * (num_items * num_new / total)
+    return mean, m2
+
 #----------------------------------------------------------------------------
 
 class ProgressMonitor:
@@ -193,16 +287,93 @@ class ProgressMonitor:
 
 #----------------------------------------------------------------------------
 
+# Features of individual dataset items, stored as shard files under the cache
+# directory and looked up by the content-based item ids of the dataset (see
+# Dataset.get_item_ids()). Each computation that finds new items adds a shard,
+# so growing a dataset only computes the features of the added images. A shard
+# is a .npy file of features, memory-mapped on load, plus a .json file listing
+# its item ids, written last; only the rows that are gathered are read.
+
+class FeatureShards:
+    def __init__(self, detector_url, detector_kwargs, image_shape):
+        args = dict(detector_url=detector_url, detector_kwargs=detector_kwargs, image_shape=list(image_shape))
+        md5 = hashlib.md5(repr(sorted(args.items())).encode('utf-8'))
+        self.shard_dir = dnnlib.make_cache_dir_path('gan-metrics', 'features', f'{get_feature_detector_name(detector_url)}-{md5.hexdigest()}')
+        self.shards = [] # [features, ...]
+        self.index = dict() # item_id => (shard_idx, row)
+
+    def add(self, item_ids, features):
+        assert len(item_ids) == features.shape[0]
+        shard_idx = len(self.shards)
+        self.shards.append(features)
+        self.index.update((item_id, (shard_idx, row)) for row, item_id in enumerate(item_ids))
+
+    def load(self):
+        for ids_file in sorted(glob.glob(os.path.join(self.shard_dir, 'shard-*.json'))):
+            with open(ids_file, 'rt') as f:
+                item_ids = json.load(f)
+            self.add(item_ids, np.load(ids_file[:-len('.json')] + '.npy', mmap_mode='r'))
+
+    def gather(self, item_ids): # Returns [len(item_ids), num_features].
+        locs = np.array([self.index[item_id] for item_id in item_ids], dtype=np.int64).reshape(-1, 2)
+        features = np.empty([len(item_ids), self.shards[locs[0, 0]].shape[1]], dtype=np.float32)
+        for shard_idx in np.unique(locs[:, 0]):
+            mask = (locs[:, 0] == shard_idx)
+            rows = locs[mask, 1]
+            order = np.argsort(rows) # read each shard sequentially
+            features[np.flatnonzero(mask)[order]] = self.shards[shard_idx][rows[order]]
+        return features
+
+    def save(self, item_ids, features):
+        assert len(item_ids) == features.shape[0]
+        os.makedirs(self.shard_dir, exist_ok=True)
+        base = os.path.join(self.shard_dir, f'shard-{uuid.uuid4().hex}')
+        np.save(base + '.tmp.npy', np.asarray(features, dtype=np.float32))
+        os.replace(base + '.tmp.npy', base + '.npy')
+        with open(base + '.json.tmp', 'wt') as f:
+            json.dump(list(item_ids), f)
+        os.replace(base + '.json.tmp', base + '.json') # atomic; the shard becomes visible
+
+#----------------------------------------------------------------------------
+
+def _get_item_ids(dataset):
+    try:
+        return dataset.get_item_ids()
+    except (AttributeError, NotImplementedError): # dataset class without content-based ids
+        return None
+
+def _append_dataset_features(opts, dataset, detector, detector_kwargs, items, stats, progress, batch_size, data_loader_kwargs):
+    item_subset = [items[(i * opts.num_gpus + opts.rank) % len(items)] for i in range((len(items) - 1) // opts.num_gpus + 1)]
+    for images, _labels in torch.utils.data.DataLoader(dataset=dataset, sampler=item_subset, batch_size=batch_size, **data_loader_kwargs):
+        if images.shape[1] == 1:
+            images = images.repeat([1, 3, 1, 1])
+        features = detector(images.to(opts.device), **detector_kwargs)
+        stats.append_torch(features, num_gpus=opts.num_gpus, rank=opts.rank)
+        progress.update(stats.num_items)
+
 def compute_feature_stats_for_dataset(opts, detector_url, detector_kwargs, rel_lo=0, rel_hi=1, batch_size=64, data_loader_kwargs=None, max_items=None, **stats_kwargs):
     dataset = dnnlib.util.construct_class_by_name(**opts.dataset_kwargs)
     if data_loader_kwargs is None:
         data_loader_kwargs = dict(pin_memory=True, num_workers=3, prefetch_factor=2)
+    num_items = len(dataset)
+    if max_items is not None:
+        num_items = min(num_items, max_items)
+
+    # Identify the items by their contents, so that the cache survives moving
+    # the dataset and notices files being replaced.
+    item_ids = _get_item_ids(dataset) if opts.cache else None
+    if item_ids is not None:
+        item_ids = item_ids[:num_items]
 
     # Try to lookup from cache.
     cache_file = None
     if opts.cache:
         # Choose cache file name.
-        args = dict(dataset_kwargs=opts.dataset_kwargs, detector_url=detector_url, detector_kwargs=detector_kwargs, stats_kwargs=stats_kwargs)
+        if item_ids is not None:
+            fingerprint = hashlib.md5('\n'.join(item_ids).encode('utf-8')).hexdigest()
+            args = dict(fingerprint=fingerprint, image_shape=dataset.image_shape, detector_url=detector_url, detector_kwargs=detector_kwargs, stats_kwargs=stats_kwargs)
+        else:
+            args = dict(dataset_kwargs=opts.dataset_kwargs, detector_url=detector_url, detector_kwargs=detector_kwargs, stats_kwargs=stats_kwargs)
         md5 = hashlib.md5(repr(sorted(args.items())).encode('utf-8'))
         cache_tag = f'{dataset.name}-{get_feature_detector_name(detector_url)}-{md5.hexdigest()}'
         cache_file = dnnlib.make_cache_dir_path('gan-metrics', cache_tag + '.pkl')
@@ -219,21 +390,32 @@ def compute_feature_stats_for_dataset(opts, detector_url, detector_kwargs, rel_l
             return FeatureStats.load(cache_file)
 
     # Initialize.
-    num_items = len(dataset)
-    if max_items is not None:
-        num_items = min(num_items, max_items)
     stats = FeatureStats(max_items=num_items, **stats_kwargs)
     progress = opts.progress.sub(tag='dataset features', num_items=num_items, rel_lo=rel_lo, rel_hi=rel_hi)
     detector = get_feature_detector(url=detector_url, device=opts.device, num_gpus=opts.num_gpus, rank=opts.rank, verbose=progress.verbose)
 
     # Main loop.
-    item_subset = [(i * opts.num_gpus + opts.rank) % num_items for i in range((num_items - 1) // opts.num_gpus + 1)]
-    for images, _labels in torch.utils.data.DataLoader(dataset=dataset, sampler=item_subset, batch_size=batch_size, **data_loader_kwargs):
-        if images.shape[1] == 1:
-            images = images.repeat([1, 3, 1, 1])
-        features = detector(images.to(opts.device), **detector_kwargs)
-        stats.append_torch(features, num_gpus=opts.num_gpus, rank=opts.rank)
-        progress.update(stats.num_items)
+    if item_ids is None:
+        _append_dataset_features(opts, dataset, detector, detector_kwargs, list(range(num_items)), stats, progress, batch_size, data_loader_kwargs)
+    else:
+        # Compute the features of the items that are not in the shards yet.
+        shards = FeatureShards(detector_url=detector_url, detector_kwargs=detector_kwargs, image_shape=dataset.image_shape)
+        shards.load()
+        missing = [idx for idx in range(num_items) if item_ids[idx] not in shards.index]
+        if len(missing) > 0:
+            progress = opts.progress.sub(tag='dataset features', num_items=len(missing), rel_lo=rel_lo, rel_hi=rel_hi)
+            new_stats = FeatureStats(capture_all=True, max_items=len(missing))
+            _append_dataset_features(opts, dataset, detector, detector_kwargs, missing, new_stats, progress, batch_size, data_loader_kwargs)
+            new_features = new_stats.get_all()
+            if opts.rank == 0:
+                shards.save([item_ids[idx] for idx in missing], new_features)
+            shards.add([item_ids[idx] for idx in missing], new_features)
+
+        # Accumulate the stats in dataset order. Each rank gathers the features of its interleaved
+        # subset of the items from the shards, and append_torch() puts them back in order.
+        rank_ids = [item_ids[(i * opts.num_gpus + opts.rank) % num_items] for i in range((num_items - 1) // opts.num_gpus + 1)]
+        for batch_ids in (rank_ids[i : i + 4096] for i in range(0, len(rank_ids), 4096)):
+            stats.append_torch(torch.from_numpy(shards.gather(batch_ids)).to(opts.device), num_gpus=opts.num_gpus, rank=opts.rank)
 
     # Save to cache.
     if cache_file is not None and opts.rank == 0:
@@ -245,23 +427,74 @@ def compute_feature_stats_for_dataset(opts, detector_url, detector_kwargs, rel_l
 
 #----------------------------------------------------------------------------
 
-def compute_feature_stats_for_generator(opts, detector_url, detector_kwargs, rel_lo=0, rel_hi=1, batch_size=64, batch_gen=None, **stats_kwargs):
+def gen_feature_request(detector_url, detector_kwargs, max_items, capture_all=False, capture_mean_cov=False, num_splits=0, report_at=(), keep_on_device=False):
+    return dnnlib.EasyDict(detector_url=detector_url, detector_kwargs=dict(detector_kwargs), max_items=max_items, capture_all=capture_all,
+        capture_mean_cov=capture_mean_cov, num_splits=num_splits, report_at=tuple(report_at), keep_on_device=keep_on_device)
+
+def _gen_stats_key(opts, request):
+    return (request.detector_url, repr(sorted(request.detector_kwargs.items())), request.max_items, repr(sorted(opts.G_kwargs.items())))
+
+def _gen_stats_satisfy(stats, request):
+    if request.capture_all and not stats.capture_all:
+        return False
+    if request.capture_mean_cov and not (stats.capture_mean_cov and len(stats.splits) >= request.num_splits and set(request.report_at) <= set(stats.report_at)):
+        return False
+    return True
+
+# stop_fn(stats) is called whenever num_items reaches one of report_at and
+# may return True to end the pass early. It is called on all ranks, which
+# must agree on the result.
+def compute_feature_stats_for_generator(opts, detector_url, detector_kwargs, rel_lo=0, rel_hi=1, batch_size=64, batch_gen=None, stop_fn=None, **stats_kwargs):
+    request = gen_feature_request(detector_url=detector_url, detector_kwargs=detector_kwargs, **stats_kwargs)
+
+    # Try to lookup from the stats gathered by a shared generator pass.
+    if opts.gen_stats_cache is not None:
+        stats = opts.gen_stats_cache.get(_gen_stats_key(opts, request), None)
+        if stats is not None and _gen_stats_satisfy(stats, request):
+            return stats
+
+    return compute_feature_stats_for_generator_multi(opts, [request], rel_lo=rel_lo, rel_hi=rel_hi, batch_size=batch_size, batch_gen=batch_gen, stop_fn=stop_fn)[0]
+
+#----------------------------------------------------------------------------
+# Generates max_items images once and feeds them to every feature detector
+# requested by the given list of gen_feature_request(). Requests for the same
+# detector are merged into a single FeatureStats that captures the union of
+# what they ask for. Returns one FeatureStats per request, and records them
+# in opts.gen_stats_cache if present and all max_items were generated.
+
+def compute_feature_stats_for_generator_multi(opts, requests, rel_lo=0, rel_hi=1, batch_size=64, batch_gen=None, stop_fn=None):
     if batch_gen is None:
         batch_gen = min(batch_size, 4)
     assert batch_size % batch_gen == 0
+    assert len(requests) > 0
+    max_items = requests[0].max_items
+    assert max_items is not None and all(request.max_items == max_items for request in requests)
 
     # Setup generator and labels.
     G = copy.deepcopy(opts.G).eval().requires_grad_(False).to(opts.device)
     c_iter = iterate_random_labels(opts=opts, batch_size=batch_gen)
 
     # Initialize.
-    stats = FeatureStats(**stats_kwargs)
-    assert stats.max_items is not None
-    progress = opts.progress.sub(tag='generator features', num_items=stats.max_items, rel_lo=rel_lo, rel_hi=rel_hi)
-    detector = get_feature_detector(url=detector_url, device=opts.device, num_gpus=opts.num_gpus, rank=opts.rank, verbose=progress.verbose)
+    all_stats = dict() # key => FeatureStats
+    for request in requests:
+        key = _gen_stats_key(opts, request)
+        prev = all_stats.get(key, FeatureStats(max_items=max_items))
+        all_stats[key] = FeatureStats(max_items=max_items,
+            capture_all=(prev.capture_all or request.capture_all),
+            capture_mean_cov=(prev.capture_mean_cov or request.capture_mean_cov),
+            num_splits=max(prev.num_splits, request.num_splits),
+            report_at=set(prev.report_at) | set(request.report_at),
+            keep_on_device=(prev.keep_on_device or request.keep_on_device))
+    progress = opts.progress.sub(tag='generator features', num_items=max_items, rel_lo=rel_lo, rel_hi=rel_hi)
+    detectors = dict() # key => (detector, detector_kwargs)
+    for request in requests:
+        detector = get_feature_detector(url=request.detector_url, device=opts.device, num_gpus=opts.num_gpus, rank=opts.rank, verbose=progress.verbose)
+        detectors[_gen_stats_key(opts, request)] = (detector, request.detector_kwargs)
 
     # Main loop.
-    while not stats.is_full():
+    num_items = 0
+    prev_reports = 0
+    while num_items < max_items:
         images = []
         for _i in range(batch_size // batch_gen):
             z = torch.randn([batch_gen, G.z_dim], device=opts.device)
@@ -271,9 +504,19 @@ def compute_feature_stats_for_generator(opts, detector_url, detector_kwargs, rel
         images = torch.cat(images)
         if images.shape[1] == 1:
             images = images.repeat([1, 3, 1, 1])
-        features = detector(images, **detector_kwargs)
-        stats.append_torch(features, num_gpus=opts.num_gpus, rank=opts.rank)
-        progress.update(stats.num_items)
-    return stats
+        for key, (detector, detector_kwargs) in detectors.items():
+            features = detector(images, **detector_kwargs)
+            all_stats[key].append_torch(features, num_gpus=opts.num_gpus, rank=opts.rank)
+        num_items = min(num_items + images.shape[0] * opts.num_gpus, max_items)
+        num_reports = sum(len(stats.reports) for stats in all_stats.values())
+        progress.update(num_items)
+        if stop_fn is not None and num_reports > prev_reports and stop_fn(*all_stats.values()):
+            break
+        prev_reports = num_reports
+
+    # Share only complete stats; a pass ended early by stop_fn must not stand in for a full one.
+    if opts.gen_stats_cache is not None and num_items >= max_items:
+        opts.gen_stats_cache.update(all_stats)
+    return [all_stats[_gen_stats_key(opts, request)] for request in requests]
 
 #----------------------------------------------------------------------------
@@ -43,7 +43,7 @@ class PPLSampler(torch.nn.Module):
         self.space = space
         self.sampling = sampling
         self.crop = crop
-        self.vgg16 = copy.deepcopy(vgg16)
+        self.vgg16 = vgg16 # shared with the feature detector cache, not modified
 
     def forward(self, c):
         # Generate random latents and interpolation t-values.
@@ -60,10 +60,12 @@ class PPLSampler(torch.nn.Module):
             zt1 = slerp(z0, z1, t.unsqueeze(1) + self.epsilon)
             wt0, wt1 = self.G.mapping(z=torch.cat([zt0,zt1]), c=torch.cat([c,c])).chunk(2)
 
-        # Randomize noise buffers.
-        for name, buf in self.G.named_buffers():
-            if name.endswith('.noise_const'):
-                buf.copy_(torch.randn_like(buf))
+        # Randomize noise buffers per sample, shared between the two ends of each pair.
+        for module in self.G.modules():
+            buf = getattr(module, 'noise_const', None)
+            if isinstance(buf, torch.Tensor):
+                noise = torch.randn([c.shape[0], 1, *buf.shape[-2:]], device=buf.device)
+                module.noise_const = torch.cat([noise, noise])
 
         # Generate images.
         img = self.G.synthesis(ws=torch.cat([wt0,wt1]), noise_mode='const', force_fp32=True, **self.G_kwargs)
@@ -91,13 +93,15 @@ class PPLSampler(torch.nn.Module):
 
 #----------------------------------------------------------------------------
 
-def compute_ppl(opts, num_samples, epsilon, space, sampling, crop, batch_size):
+def compute_ppl(opts, num_samples, epsilon, space, sampling, crop, batch_size=None, max_batch_size=32):
     vgg16_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/vgg16.pkl'
-    vgg16 = metric_utils.get_feature_detector(vgg16_url, num_gpus=opts.num_gpus, rank=opts.rank, verbose=opts.progress.verbose)
+    vgg16 = metric_utils.get_feature_detector(vgg16_url, device=opts.device, num_gpus=opts.num_gpus, rank=opts.rank, verbose=opts.progress.verbose)
 
     # Setup sampler and labels.
     sampler = PPLSampler(G=opts.G, G_kwargs=opts.G_kwargs, epsilon=epsilon, space=space, sampling=sampling, crop=crop, vgg16=vgg16)
     sampler.eval().requires_grad_(False).to(opts.device)
+    if batch_size is None:
+        batch_size = metric_utils.find_batch_size(lambda n: sampler(torch.zeros([n, opts.G.c_dim], device=opts.device)), opts, max_batch_size=max_batch_size)
     c_iter = metric_utils.iterate_random_labels(opts=opts, batch_size=batch_size)
 
     # Sampling loop.
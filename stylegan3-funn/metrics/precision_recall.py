@@ -11,6 +11,7 @@ Metric for Assessing Generative Models". Matches the original implementation
 by Kynkaanniemi et al. at
 https://github.com/kynkaat/improved-precision-and-recall-metric/blob/master/precision_recall.py"""
 
+import numpy as np
 import torch
 from . import metric_utils
 
@@ -33,10 +34,15 @@ def compute_distances(row_features, col_features, num_gpus, rank, col_batch_size
 
 #----------------------------------------------------------------------------
 
-def compute_pr(opts, max_real, num_gen, nhood_size, row_batch_size, col_batch_size):
-    detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/vgg16.pkl'
-    detector_kwargs = dict(return_features=True)
+detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/vgg16.pkl'
+detector_kwargs = dict(return_features=True)
+
+def gen_feature_requests(num_gen):
+    return [metric_utils.gen_feature_request(detector_url=detector_url, detector_kwargs=detector_kwargs, capture_all=True, max_items=num_gen)]
 
+#----------------------------------------------------------------------------
+
+def _get_features(opts, max_real, num_gen):
     real_features = metric_utils.compute_feature_stats_for_dataset(
         opts=opts, detector_url=detector_url, detector_kwargs=detector_kwargs,
         rel_lo=0, rel_hi=0, capture_all=True, max_items=max_real).get_all_torch().to(torch.float16).to(opts.device)
@@ -44,6 +50,10 @@ def compute_pr(opts, max_real, num_gen, nhood_size, row_batch_size, col_batch_si
     gen_features = metric_utils.compute_feature_stats_for_generator(
         opts=opts, detector_url=detector_url, detector_kwargs=detector_kwargs,
         rel_lo=0, rel_hi=1, capture_all=True, max_items=num_gen).get_all_torch().to(torch.float16).to(opts.device)
+    return real_features, gen_features
+
+def compute_pr(opts, max_real, num_gen, nhood_size, row_batch_size, col_batch_size):
+    real_features, gen_features = _get_features(opts, max_real=max_real, num_gen=num_gen)
 
     results = dict()
     for name, manifold, probes in [('precision', real_features, gen_features), ('recall', gen_features, real_features)]:
@@ -60,3 +70,67 @@ def compute_pr(opts, max_real, num_gen, nhood_size, row_batch_size, col_batch_si
     return results['precision'], results['recall']
 
 #----------------------------------------------------------------------------
+# Approximate backend. Candidate neighbours are found by comparing random
+# projections of the features, and re-ranked with exact distances. Each rank
+# processes a contiguous share of the rows and keeps its distances on the
+# device; only the per-row results are exchanged. A k-th neighbour radius
+# found among the candidates can only overestimate the exact one, so the
+# radii are compared against exact search on a random sample of rows.
+# Returns a dict with precision, recall, and the agreement for both.
+
+def _all_gather_rows(x, num_rows, num_gpus, rank):
+    if num_gpus == 1:
+        return x
+    result = []
+    for src, rows in enumerate(torch.arange(num_rows).tensor_split(num_gpus)):
+        y = x.clone() if src == rank else torch.empty([len(rows), *x.shape[1:]], dtype=x.dtype, device=x.device)
+        torch.distributed.broadcast(y, src=src)
+        result.append(y)
+    return torch.cat(result)
+
+def _exact_dist(rows, cols):
+    return torch.cdist(rows.to(torch.float32), cols.to(torch.float32), compute_mode='donot_use_mm_for_euclid_dist')
+
+def _approx_search(rows, rows_proj, manifold, manifold_proj, num_candidates, radii=None, max_batch_elems=2**27):
+    num_candidates = min(num_candidates, manifold.shape[0])
+    batch_size = max(max_batch_elems // manifold.shape[0], 1)
+    result = []
+    for row_batch, row_proj_batch in zip(rows.split(batch_size), rows_proj.split(batch_size)):
+        score = torch.cdist(row_proj_batch, manifold_proj)
+        if radii is not None:
+            score = score - radii # a probe is in the manifold if it is within the radius of any sample
+        cand = score.topk(num_candidates, dim=1, largest=False).indices
+        dist = _exact_dist(row_batch.unsqueeze(1), manifold[cand]).squeeze(1)
+        result.append(dist if radii is None else (dist <= radii[cand]).any(dim=1))
+    return torch.cat(result)
+
+def compute_pr_approx(opts, max_real, num_gen, nhood_size, proj_dim=128, num_candidates=64, num_check=1000, seed=0):
+    real_features, gen_features = _get_features(opts, max_real=max_real, num_gen=num_gen)
+    generator = torch.Generator(device=opts.device).manual_seed(seed)
+    proj = torch.randn([real_features.shape[1], proj_dim], generator=generator, device=opts.device) / np.sqrt(proj_dim)
+
+    results = dict()
+    for name, manifold, probes in [('precision', real_features, gen_features), ('recall', gen_features, real_features)]:
+        manifold_proj = manifold.to(torch.float32) @ proj
+        probes_proj = probes.to(torch.float32) @ proj
+
+        # k-th neighbour radii of the manifold samples.
+        rows = torch.arange(manifold.shape[0], device=opts.device).tensor_split(opts.num_gpus)[opts.rank]
+        dist = _approx_search(manifold[rows], manifold_proj[rows], manifold, manifold_proj, num_candidates)
+        kth = _all_gather_rows(dist.kthvalue(nhood_size + 1, dim=1).values, manifold.shape[0], opts.num_gpus, opts.rank)
+
+        # Manifold membership of the probes.
+        rows = torch.arange(probes.shape[0], device=opts.device).tensor_split(opts.num_gpus)[opts.rank]
+        pred = _approx_search(probes[rows], probes_proj[rows], manifold, manifold_proj, num_candidates, radii=kth)
+        pred = _all_gather_rows(pred.to(torch.uint8), probes.shape[0], opts.num_gpus, opts.rank)
+        results[name] = float(pred.to(torch.float32).mean())
+
+        # Agreement with the exact radii.
+        check = torch.randperm(manifold.shape[0], generator=generator, device=opts.device)[:num_check]
+        exact = torch.cat([torch.cat([_exact_dist(row_batch, manifold_batch) for manifold_batch in manifold.split(16384)], dim=1).kthvalue(nhood_size + 1, dim=1).values
+            for row_batch in manifold[check].split(256)])
+        results[f'{name}_kth_agreement'] = float(torch.isclose(kth[check], exact, rtol=1e-3).to(torch.float32).mean())
+        results[f'{name}_kth_rel_error'] = float((kth[check] / exact.clamp(min=1e-8) - 1).mean())
+    return results
+
+#----------------------------------------------------------------------------
@@ -9,12 +9,10 @@ import numpy as np
 import PIL.Image
 import scipy
 import torch
+import imageio
 
 import legacy
 
-os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
-import moviepy.editor
-
 # ----------------------------------------------------------------------------
 
 
@@ -86,6 +84,35 @@ def _parse_cols(s: str, G, device: torch.device, truncation_psi: float) -> List[
     return w
 
 
+def _mix_styles(base_w: torch.Tensor, style_w: torch.Tensor, col_styles: List[int]) -> torch.Tensor:
+    """
+    Style-mix every base dlatent with every style dlatent at once: base_w is [A, num_ws, w_dim], style_w
+    is [B, num_ws, w_dim], and the result is [A, B, num_ws, w_dim], taking col_styles from style_w.
+    """
+    mask = torch.zeros(base_w.shape[1], dtype=torch.bool, device=base_w.device)
+    mask[col_styles] = True
+    return torch.where(mask[None, None, :, None], style_w.unsqueeze(0), base_w.unsqueeze(1))
+
+
+def _synthesize(G, ws: torch.Tensor, noise_mode: str, batch_size: int, prefix_keys: Optional[List] = None, **w_to_img_kwargs) -> np.ndarray:
+    """
+    Synthesize the dlatents ws [N, num_ws, w_dim] in batches of batch_size, returning [N, H, W, C] images.
+    With a prefix_cache, prefix_keys holds the N keys of the dlatents' cached prefixes (e.g., their base seeds).
+    """
+    batches = []
+    for start in range(0, ws.shape[0], batch_size):
+        if prefix_keys is not None:
+            w_to_img_kwargs['prefix_keys'] = prefix_keys[start:start + batch_size]
+        batches.append(gen_utils.w_to_img(G, ws[start:start + batch_size], noise_mode, **w_to_img_kwargs))
+    return np.concatenate(batches)
+
+
+def _tile(images: np.ndarray) -> np.ndarray:
+    """Lay out images of shape [rows, cols, H, W, C] as a single [rows * H, cols * W, C] canvas."""
+    rows, cols, H, W, C = images.shape
+    return images.transpose(0, 2, 1, 3, 4).reshape(rows * H, cols * W, C)
+
+
 # ----------------------------------------------------------------------------
 
 
@@ -110,6 +137,7 @@ def main():
 @click.option('--trunc', 'truncation_psi', type=float, help='Truncation psi', default=1, show_default=True)
 @click.option('--noise-mode', help='Noise mode', type=click.Choice(['const', 'random', 'none']), default='const', show_default=True)
 @click.option('--anchor-latent-space', '-anchor', is_flag=True, help='Anchor the latent space to w_avg to stabilize the video')
+@click.option('--batch-size', type=click.IntRange(min=1), help='Number of images to synthesize at once', default=8, show_default=True)
 # Extra parameters for saving the results
 @click.option('--outdir', type=click.Path(file_okay=False), help='Directory path to save the results', default=os.path.join(os.getcwd(), 'out', 'images'), show_default=True, metavar='DIR')
 @click.option('--description', '-desc', type=str, help='Description name for the directory path to save results', default='', show_default=True)
@@ -124,6 +152,7 @@ def generate_style_mix(
         truncation_psi: float,
         noise_mode: str,
         anchor_latent_space: bool,
+        batch_size: int,
         outdir: str,
         description: str,
 ):
@@ -166,16 +195,21 @@ def generate_style_mix(
     w_dict = {seed: w for seed, w in zip(all_seeds, list(all_w))}
 
     print('Generating images...')
-    all_images = gen_utils.w_to_img(G, all_w, noise_mode)
+    all_images = _synthesize(G, all_w, noise_mode, batch_size)
     image_dict = {(seed, seed): image for seed, image in zip(all_seeds, list(all_images))}
 
     print('Generating style-mixed images...')
-    for row_seed in row_seeds:
-        for col_seed in col_seeds:
-            w = w_dict[row_seed].clone()
-            w[col_styles] = w_dict[col_seed][col_styles]
-            image = gen_utils.w_to_img(G, w, noise_mode)[0]
-            image_dict[(row_seed, col_seed)] = image
+    row_w = torch.stack([w_dict[seed] for seed in row_seeds])
+    col_w = torch.stack([w_dict[seed] for seed in col_seeds])
+    mixed_w = _mix_styles(row_w, col_w, col_styles).flatten(0, 1)  # [rows * cols, num_ws, w_dim]
+    # Every row shares its styles before min(col_styles), so their activations are computed once per row
+    prefix_cache = gen_utils.SynthesisPrefixCache(G.synthesis)
+    prefix_keys = [row_seed for row_seed in row_seeds for _col_seed in col_seeds]
+    mixed_images = _synthesize(G, mixed_w, noise_mode, batch_size, prefix_cache=prefix_cache, prefix_len=min(col_styles), prefix_keys=prefix_keys)
+    mixed_images = mixed_images.reshape(len(row_seeds), len(col_seeds), *mixed_images.shape[1:])
+    for row_idx, row_seed in enumerate(row_seeds):
+        for col_idx, col_seed in enumerate(col_seeds):
+            image_dict[(row_seed, col_seed)] = mixed_images[row_idx, col_idx]
 
     # Name of grid and run directory
     grid_name = 'grid'
@@ -186,23 +220,12 @@ def generate_style_mix(
     run_dir = gen_utils.make_run_dir(outdir, description)
 
     print('Saving image grid...')
-    W = G.img_resolution
-    H = G.img_resolution
-    canvas = PIL.Image.new(gen_utils.channels_dict[G.synthesis.img_channels],  # Handle RGBA case
-                           (W * (len(col_seeds) + 1), H * (len(row_seeds) + 1)), 'black')
-    for row_idx, row_seed in enumerate([0] + row_seeds):
-        for col_idx, col_seed in enumerate([0] + col_seeds):
-            if row_idx == 0 and col_idx == 0:
-                continue
-            key = (row_seed, col_seed)
-            if row_idx == 0:
-                key = (col_seed, col_seed)
-            if col_idx == 0:
-                key = (row_seed, row_seed)
-            canvas.paste(PIL.Image.fromarray(image_dict[key],
-                                             gen_utils.channels_dict[G.synthesis.img_channels]),
-                         (W * col_idx, H * row_idx))
-    canvas.save(os.path.join(run_dir, f'{grid_name}.png'))
+    grid = np.zeros([len(row_seeds) + 1, len(col_seeds) + 1, *mixed_images.shape[2:]], dtype=np.uint8)  # black corner
+    grid[0, 1:] = np.stack([image_dict[(seed, seed)] for seed in col_seeds])
+    grid[1:, 0] = np.stack([image_dict[(seed, seed)] for seed in row_seeds])
+    grid[1:, 1:] = mixed_images
+    PIL.Image.fromarray(_tile(grid), gen_utils.channels_dict[G.synthesis.img_channels]).save(  # Handle RGBA case
+        os.path.join(run_dir, f'{grid_name}.png'))
 
     print('Saving individual images...')
     for (row_seed, col_seed), image in image_dict.items():
@@ -217,6 +240,7 @@ def generate_style_mix(
         'col_styles': col_styles,
         'truncation_psi': truncation_psi,
         'noise_mode': noise_mode,
+        'batch_size': batch_size,
         'run_dir': run_dir,
         'description': description,
     }
@@ -238,6 +262,7 @@ def generate_style_mix(
 @click.option('--columns', '-cols', 'columns', type=str, help='Path to dlatents (.npy/.npz) or seeds to use ("a", "b-c", "e,f-g,h,i", etc.), or a combination of both', required=True)
 @click.option('--styles', 'col_styles', type=parse_styles, help='Style layers to use; can pass "coarse", "middle", "fine", or a list or range of ints', default='0-6', show_default=True)
 @click.option('--only-stylemix', is_flag=True, help='Add flag to only show the style-mixed images in the video')
+@click.option('--batch-size', type=click.IntRange(min=1), help='Number of images to synthesize at once', default=8, show_default=True)
 # Video options
 @click.option('--compress', is_flag=True, help='Add flag to compress the final mp4 file via ffmpeg-python (same resolution, lower file size)')
 @click.option('--duration-sec', type=float, help='Duration of the video in seconds', default=30, show_default=True)
@@ -253,6 +278,7 @@ def random_stylemix_video(
         columns: str,
         col_styles: List[int],
         only_stylemix: bool,
+        batch_size: int,
         compress: bool,
         truncation_psi: float,
         noise_mode: str,
@@ -316,85 +342,48 @@ def random_stylemix_video(
     # dst_w = G.mapping(torch.from_numpy(dst_z).to(device), None)
     # dst_w = w_avg + (dst_w - w_avg) * truncation_psi
 
-    # Width and height of the generated image
-    W = G.img_resolution
-    H = G.img_resolution
-
     # Video name
     mp4_name = f'{len(dst_w)}x1'
     # Run dir name
     description = 'stylemix-video' if len(description) == 0 else description
     # Add to the name the styles (from the StyleGAN paper) if they are being used to both file and run dir
     mp4_name, description = style_names(max_style, mp4_name, description, col_styles)
+    mp4_name = f'{mp4_name}-only-stylemix' if only_stylemix else f'{mp4_name}-style-mixing'
     # Create the run dir with the description
     run_dir = gen_utils.make_run_dir(outdir, description)
 
-    # If user wishes to only show the style-transferred images (nice for 1x1 case)
+    # The column styles before min(col_styles) are static, so their activations are computed only once
+    prefix_cache = gen_utils.SynthesisPrefixCache(G.synthesis)
+
     if only_stylemix:
+        # If user wishes to only show the style-transferred images (nice for 1x1 case)
         print('Generating style-mixing video (saving only the style-transferred images)...')
-        # We generate a canvas where we will paste all the generated images
-        canvas = PIL.Image.new('RGB', (W * len(dst_w), H * len([row_seed])), 'black')  # use any color you want
-
-        def make_frame(t):
-            # Get the frame number according to time t
-            frame_idx = int(np.clip(np.round(t * fps), 0, num_frames - 1))
-            # For each of the column images
-            for col, _ in enumerate(dst_w):
-                # Select the pertinent latent w column
-                w_col = dst_w[col].unsqueeze(0)  # [18, 512] -> [1, 18, 512]
-                # Replace the values defined by col_styles
-                w_col[:, col_styles] = src_w[frame_idx, col_styles]
-                # Generate the style-mixed images
-                col_images = gen_utils.w_to_img(G, w_col, noise_mode)
-                # Paste them in their respective spot in the grid
-                for row, image in enumerate(list(col_images)):
-                    canvas.paste(PIL.Image.fromarray(image, 'RGB'), (col * H, row * W))
-
-            return np.array(canvas)
-
-        mp4_name = f'{mp4_name}-only-stylemix'
+        frames_per_batch = max(batch_size // len(dst_w), 1)
     else:
         print('Generating style-mixing video (saving the whole grid)...')
-        # Generate an empty canvas where we will paste all the generated images
-        canvas = PIL.Image.new('RGB', (W * (len(dst_w) + 1), H * (len([row_seed]) + 1)), 'black')
-
-        # Generate all destination images (first row; static images)
-        dst_images = gen_utils.w_to_img(G, dst_w, noise_mode)
-        # Paste them in the canvas
-        for col, dst_image in enumerate(list(dst_images)):
-            canvas.paste(PIL.Image.fromarray(dst_image, 'RGB'), ((col + 1) * H, 0))
-
-        def make_frame(t):
-            # Get the frame number according to time t
-            frame_idx = int(np.clip(np.round(t * fps), 0, num_frames - 1))
-            # Get the image at this frame (first column; video)
-            src_image = gen_utils.w_to_img(G, src_w[frame_idx], noise_mode)[0]
-            # Paste it to the lower left
-            canvas.paste(PIL.Image.fromarray(src_image, 'RGB'), (0, H))
-
-            # For each of the column images (destination images)
-            for col, _ in enumerate(list(dst_images)):
-                # Select pertinent latent w column
-                w_col = dst_w[col].unsqueeze(0)  # [18, 512] -> [1, 18, 512]
-                # Replace the values defined by col_styles
-                w_col[:, col_styles] = src_w[frame_idx, col_styles]
-                # Generate these style-mixed images
-                col_images = gen_utils.w_to_img(G, w_col, noise_mode)
-                # Paste them in their respective spot in the grid
-                for row, image in enumerate(list(col_images)):
-                    canvas.paste(PIL.Image.fromarray(image, 'RGB'), ((col + 1) * H, (row + 1) * W))
-
-            return np.array(canvas)
-
-        mp4_name = f'{mp4_name}-style-mixing'
-
-    # Generate video using the respective make_frame function
-    videoclip = moviepy.editor.VideoClip(make_frame, duration=duration_sec)
-    videoclip.set_duration(duration_sec)
-
-    # Change the video parameters (codec, bitrate) if you so desire
+        frames_per_batch = max(batch_size // (len(dst_w) + 1), 1)
+        # Generate all destination images (first row; static images), with a black upper left corner
+        dst_images = _synthesize(G, dst_w, noise_mode, batch_size)
+        dst_row = np.concatenate([np.zeros_like(dst_images[:1]), dst_images])[np.newaxis]  # [1, cols + 1, H, W, C]
+
+    # Synthesize several frames at once and stream them to the encoder as they are done
     final_video = os.path.join(run_dir, f'{mp4_name}.mp4')
-    videoclip.write_videofile(final_video, fps=fps, codec='libx264', bitrate='16M')
+    video_out = imageio.get_writer(final_video, mode='I', fps=fps, codec='libx264', bitrate='16M')
+    for frame_idx in range(0, num_frames, frames_per_batch):
+        frame_w = src_w[frame_idx:frame_idx + frames_per_batch]
+        # Replace the values defined by col_styles in each column with those of each frame
+        mixed_w = _mix_styles(dst_w, frame_w, col_styles).transpose(0, 1).flatten(0, 1)  # [frames * cols, num_ws, w_dim]
+        prefix_keys = [col_idx for _frame in range(len(frame_w)) for col_idx in range(len(dst_w))]
+        mixed_images = _synthesize(G, mixed_w, noise_mode, batch_size, prefix_cache=prefix_cache, prefix_len=min(col_styles), prefix_keys=prefix_keys)
+        mixed_images = mixed_images.reshape(len(frame_w), len(dst_w), *mixed_images.shape[1:])
+        if not only_stylemix:
+            # Prepend the image of each frame (first column; video)
+            src_images = _synthesize(G, frame_w, noise_mode, batch_size)
+            mixed_images = np.concatenate([src_images[:, np.newaxis], mixed_images], axis=1)
+        for images in mixed_images:
+            grid = images[np.newaxis] if only_stylemix else np.concatenate([dst_row, images[np.newaxis]])
+            video_out.append_data(_tile(grid))
+    video_out.close()
 
     # Save the configuration used for the experiment
     ctx.obj = {
@@ -403,6 +392,7 @@ def random_stylemix_video(
         'columns': columns,
         'col_styles': col_styles,
         'only_stylemix': only_stylemix,
+        'batch_size': batch_size,
         'compress': compress,
         'truncation_psi': truncation_psi,
         'noise_mode': noise_mode,
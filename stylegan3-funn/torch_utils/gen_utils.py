@@ -2,7 +2,7 @@ import os
 import re
 import json
 
-from typing import List, Tuple, Union, Optional, Type
+from typing import List, Tuple, Union, Optional, Type, Sequence, Hashable
 from collections import OrderedDict
 from locale import atof
 
@@ -636,13 +636,18 @@ resume_specs = {
 def w_to_img(G, dlatents: Union[List[torch.Tensor], torch.Tensor],
              noise_mode: str = 'const',
              new_w_avg: torch.Tensor = None,
-             truncation_psi: float = 1.0) -> np.ndarray:
+             truncation_psi: float = 1.0,
+             prefix_cache: Optional['SynthesisPrefixCache'] = None,
+             prefix_len: int = 0,
+             prefix_keys: Optional[Sequence[Hashable]] = None) -> np.ndarray:
     """
     Get an image/np.ndarray from a dlatent W using G and the selected noise_mode. The final shape of the
     returned image will be [len(dlatents), G.img_resolution, G.img_resolution, G.img_channels].
         Note: this function should be used after doing the truncation trick!
         Note: Optionally, you can also pass a new_w_avg to use instead of the one in G, with a reverse
               truncation trick
+        Note: Optionally, pass a SynthesisPrefixCache of G.synthesis to reuse the activations that only
+              depend on the first prefix_len styles, identified per dlatent by prefix_keys (see below)
     """
     # If we have a single dlatent, we need to add a batch dimension
     assert isinstance(dlatents, torch.Tensor), f'dlatents should be a torch.Tensor!: "{type(dlatents)}"'
@@ -651,12 +656,111 @@ def w_to_img(G, dlatents: Union[List[torch.Tensor], torch.Tensor],
     if new_w_avg is not None:
         new_w_avg = new_w_avg.to(next(G.parameters()).device)
         dlatents = (dlatents - new_w_avg) * (1 - truncation_psi) + new_w_avg
-    synth_image = G.synthesis(dlatents, noise_mode=noise_mode)
+    if prefix_cache is not None:
+        synth_image = prefix_cache(dlatents, prefix_len, keys=prefix_keys, noise_mode=noise_mode)
+    else:
+        synth_image = G.synthesis(dlatents, noise_mode=noise_mode)
     synth_image = (synth_image + 1) * 255/2  # [-1.0, 1.0] -> [0.0, 255.0]
     synth_image = synth_image.permute(0, 2, 3, 1).clamp(0, 255).to(torch.uint8).cpu().numpy()  # NCWH => NWHC
     return synth_image
 
 
+class SynthesisPrefixCache:
+    """
+    Incremental synthesis for sweeps where only the late styles change, e.g., style mixing with fine col_styles.
+    The activations after the last layer (StyleGAN3) or block (StyleGAN2) that depends only on the first prefix_len
+    styles are cached per sample, keyed by a caller-supplied host value that identifies those styles (e.g., the seed
+    they were generated from) and any per-sample input transform, together with the remaining synthesis kwargs; the
+    tensors themselves are never read back. Later calls with the same prefix then only run the layers after it.
+    Call clear() if the network or its transform buffer change. The cache holds at most max_bytes of activations
+    and evicts the least recently used entries first. noise_mode='random' bypasses the cache.
+    """
+    def __init__(self, synthesis, max_bytes: int = 2 ** 30):
+        self.synthesis = synthesis
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()  # key => tuple of [1, ...] tensors (or None)
+        self._num_bytes = 0
+        self._stages, self._finish = self._build_stages()  # [(fn(state, ws, **kwargs) -> state, ws_end), ...]
+
+    def _build_stages(self):
+        synthesis = self.synthesis
+        stages = []
+        if hasattr(synthesis, 'layer_names'):  # StyleGAN3: input, then one layer per style
+            def run_input(state, ws, transform=None, **_kwargs):
+                return (synthesis.input(ws[:, 0]) if transform is None else synthesis.input(ws[:, 0], transform=transform),)
+            stages.append((run_input, 1))
+            for idx, name in enumerate(synthesis.layer_names):
+                def run_layer(state, ws, transform=None, _layer=getattr(synthesis, name), _idx=idx + 1, **kwargs):
+                    return (_layer(state[0], ws[:, _idx], **kwargs),)
+                stages.append((run_layer, idx + 2))
+
+            def finish(state):
+                x = state[0] * synthesis.output_scale if synthesis.output_scale != 1 else state[0]
+                return x.to(torch.float32)
+        else:  # StyleGAN2: blocks sharing one style between consecutive blocks
+            w_idx = 0
+            for res in synthesis.block_resolutions:
+                block = getattr(synthesis, f'b{res}')
+                def run_block(state, ws, _block=block, _start=w_idx, _end=w_idx + block.num_conv + block.num_torgb, **kwargs):
+                    return _block(state[0], state[1], ws[:, _start:_end], **kwargs)
+                stages.append((run_block, w_idx + block.num_conv + block.num_torgb))
+                w_idx += block.num_conv
+
+            def finish(state):
+                return state[1]
+        return stages, finish
+
+    def _run(self, state, ws, stages, **synthesis_kwargs):
+        for fn, _ws_end in stages:
+            state = fn(state, ws, **synthesis_kwargs)
+        return state
+
+    def _insert(self, key: tuple, entry: tuple) -> None:
+        self._cache[key] = entry
+        self._num_bytes += sum(t.numel() * t.element_size() for t in entry if t is not None)
+        while self._num_bytes > self.max_bytes and len(self._cache) > 0:
+            _key, old = self._cache.popitem(last=False)
+            self._num_bytes -= sum(t.numel() * t.element_size() for t in old if t is not None)
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._num_bytes = 0
+
+    def __call__(self, ws: torch.Tensor, prefix_len: int, keys: Sequence[Hashable], **synthesis_kwargs) -> torch.Tensor:
+        """
+        Equivalent to synthesis(ws, **synthesis_kwargs), given that ws[:, :prefix_len] is often repeated.
+        keys[i] must be equal for two samples iff their first prefix_len styles (and input transforms) are.
+        """
+        assert len(keys) == ws.shape[0]
+        ws = ws.to(torch.float32)
+        num_prefix = sum(1 for _fn, ws_end in self._stages if ws_end <= prefix_len)
+        if num_prefix == 0 or synthesis_kwargs.get('noise_mode', 'random') == 'random':
+            return self._finish(self._run((None, None), ws, self._stages, **synthesis_kwargs))
+        kwargs_repr = repr(sorted((k, v) for k, v in synthesis_kwargs.items() if k != 'transform'))
+        keys = [(key, num_prefix, kwargs_repr) for key in keys]
+
+        # Compute the missing prefixes in one batch.
+        entries = dict()
+        for i, key in enumerate(keys):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                entries[key] = self._cache[key]
+        missing = [i for i, key in enumerate(keys) if key not in entries and keys.index(key) == i]
+        if len(missing) > 0:
+            kwargs = dict(synthesis_kwargs)
+            if 'transform' in kwargs and kwargs['transform'].ndim == 3:
+                kwargs['transform'] = kwargs['transform'][missing]
+            state = self._run((None, None), ws[missing], self._stages[:num_prefix], **kwargs)
+            for j, i in enumerate(missing):
+                entries[keys[i]] = tuple(t[j:j+1].clone() if t is not None else None for t in state)
+                self._insert(keys[i], entries[keys[i]])
+
+        # Run the remaining layers on the gathered activations.
+        state = tuple(torch.cat([entries[key][k] for key in keys]) if entries[keys[0]][k] is not None else None
+                      for k in range(len(entries[keys[0]])))
+        return self._finish(self._run(state, ws, self._stages[num_prefix:], **synthesis_kwargs))
+
+
 def z_to_dlatent(G, latents: torch.Tensor, label: torch.Tensor, truncation_psi: float = 1.0) -> torch.Tensor:
     """Get the dlatent from the given latent, class label and truncation psi"""
     assert isinstance(latents, torch.Tensor), f'latents should be a torch.Tensor!: "{type(latents)}"'
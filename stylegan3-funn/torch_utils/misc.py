@@ -106,14 +106,22 @@ def profiled_function(fn):
 
 #----------------------------------------------------------------------------
 # Sampler for torch.utils.data.DataLoader that loops over the dataset
-# indefinitely, shuffling items as it goes.
+# indefinitely, shuffling items as it goes. The global index stream, shared
+# by all replicas, is produced one pass over the dataset at a time: the first
+# pass is a full shuffle, and each subsequent pass perturbs the previous order
+# locally by sorting the positions jittered by up to window_size * len(dataset).
+# Each replica only slices its own stride out of every pass, in NumPy blocks.
+# start_idx is a position in the global stream, e.g. for resuming training;
+# state_dict()/load_state_dict() make resuming from that position O(1).
 
 class InfiniteSampler(torch.utils.data.Sampler):
-    def __init__(self, dataset, rank=0, num_replicas=1, shuffle=True, seed=0, window_size=0.5):
+    def __init__(self, dataset, rank=0, num_replicas=1, shuffle=True, seed=0, window_size=0.5, start_idx=0, block_size=4096):
         assert len(dataset) > 0
         assert num_replicas > 0
         assert 0 <= rank < num_replicas
         assert 0 <= window_size <= 1
+        assert start_idx >= 0
+        assert block_size > 0
         super().__init__(dataset)
         self.dataset = dataset
         self.rank = rank
@@ -121,25 +129,58 @@ class InfiniteSampler(torch.utils.data.Sampler):
         self.shuffle = shuffle
         self.seed = seed
         self.window_size = window_size
+        self.start_idx = start_idx
+        self.block_size = block_size
+        self._pass_orders = dict() # pass index => order of the global stream during that pass
+
+    def _next_order(self, order, pass_idx):
+        window = int(np.rint(order.size * self.window_size))
+        if (not self.shuffle) or (window < 2):
+            return order
+        rnd = np.random.RandomState([self.seed, pass_idx])
+        keys = np.arange(order.size) + rnd.uniform(0, window, size=order.size)
+        return order[np.argsort(keys, kind='stable')]
+
+    def _get_order(self, pass_idx):
+        known = [q for q in list(self._pass_orders.keys()) if q <= pass_idx]
+        if len(known) > 0:
+            q = max(known)
+            order = self._pass_orders[q]
+        else:
+            q = 0
+            order = np.arange(len(self.dataset))
+            if self.shuffle:
+                np.random.RandomState(self.seed).shuffle(order)
+        while q < pass_idx:
+            q += 1
+            order = self._next_order(order, q)
+        return order
 
     def __iter__(self):
-        order = np.arange(len(self.dataset))
-        rnd = None
-        window = 0
-        if self.shuffle:
-            rnd = np.random.RandomState(self.seed)
-            rnd.shuffle(order)
-            window = int(np.rint(order.size * self.window_size))
-
-        idx = 0
+        num_items = len(self.dataset)
+        pass_idx = self.start_idx // num_items
+        pos = self.start_idx % num_items
+        order = self._get_order(pass_idx)
+        stride = self.num_replicas
         while True:
-            i = idx % order.size
-            if idx % self.num_replicas == self.rank:
-                yield order[i]
-            if window >= 2:
-                j = (i - rnd.randint(window)) % order.size
-                order[i], order[j] = order[j], order[i]
-            idx += 1
+            self._pass_orders[pass_idx] = order
+            self._pass_orders.pop(pass_idx - 2, None) # keep the pass that the training loop may still be consuming
+            first = pos + (self.rank - pass_idx * num_items - pos) % stride
+            for block_start in range(first, num_items, self.block_size * stride):
+                yield from order[block_start : block_start + self.block_size * stride : stride].tolist()
+            pass_idx += 1
+            pos = 0
+            order = self._next_order(order, pass_idx)
+
+    def state_dict(self, idx): # idx = position in the global stream consumed so far.
+        pass_idx = idx // len(self.dataset)
+        return dict(idx=idx, order=torch.from_numpy(np.array(self._get_order(pass_idx), dtype=np.int64)))
+
+    def load_state_dict(self, state):
+        order = np.asarray(state['order'], dtype=np.int64)
+        assert order.shape == (len(self.dataset),)
+        self.start_idx = int(state['idx'])
+        self._pass_orders = {self.start_idx // len(self.dataset): order}
 
 #----------------------------------------------------------------------------
 # Utilities for operating with torch.nn.Module parameters and buffers.
@@ -161,6 +202,138 @@ def copy_params_and_buffers(src_module, dst_module, require_all=False):
         if name in src_tensors:
             tensor.copy_(src_tensors[name].detach()).requires_grad_(tensor.requires_grad)
 
+#----------------------------------------------------------------------------
+# Multi-tensor in-place updates over lists of parameters or buffers, using
+# the fused torch._foreach_* kernels when available.
+
+def lerp_multi_(dst_tensors, src_tensors, weight): # dst = dst.lerp(src, weight)
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(dst_tensors, src_tensors, weight)
+    else:
+        for dst, src in zip(dst_tensors, src_tensors):
+            dst.lerp_(src, weight)
+
+def copy_multi_(dst_tensors, src_tensors):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst_tensors, src_tensors)
+    else:
+        for dst, src in zip(dst_tensors, src_tensors):
+            dst.copy_(src)
+
+#----------------------------------------------------------------------------
+# Bucketed all-reduce of gradients across processes, followed by averaging
+# and nan_to_num(). Call begin() before every round of gradient accumulation
+# and finish() before the optimizer step. During the final round, each bucket
+# is reduced asynchronously as soon as backward() has produced all of its
+# gradients, overlapping communication with the rest of the backward pass.
+# How many times each parameter receives a gradient during the final round is
+# learned per key, since a single round may run several backward passes. The
+# counts are re-checked by finish() on every step: buckets are only launched
+# early once the counts of a key have been seen twice in a row, and if a step
+# delivers different counts, all buckets are reduced again in finish() from
+# the complete gradients. The counts follow the training schedule, which is
+# the same on every process, so all processes take the same path. Buckets are
+# always launched in the same order so that every process issues the same
+# sequence of collectives.
+
+class GradientReducer:
+    def __init__(self, params, num_gpus=1, bucket_cap_mb=25):
+        self.num_gpus = num_gpus
+        self.params = [param for param in params]
+        self.buckets = [] # [[param_idx, ...], ...]
+        bucket = []
+        bucket_bytes = 0
+        for param_idx in reversed(range(len(self.params))): # backward() visits parameters roughly in reverse order
+            bucket.append(param_idx)
+            bucket_bytes += self.params[param_idx].numel() * self.params[param_idx].element_size()
+            if bucket_bytes >= bucket_cap_mb * 2**20:
+                self.buckets.append(bucket)
+                bucket = []
+                bucket_bytes = 0
+        if len(bucket) > 0:
+            self.buckets.append(bucket)
+        self.param_bucket = {param_idx: bucket_idx for bucket_idx, bucket in enumerate(self.buckets) for param_idx in bucket}
+        self.expected = dict() # key => [num_grads, ...]
+        self.verified = set() # keys whose counts matched on the previous step
+        self.key = None
+        self.final = False
+        self.mismatch = False
+        self.received = None
+        self.launched = None
+        self.next_bucket = 0
+        self.hooks = []
+        if num_gpus > 1 and hasattr(torch.Tensor, 'register_post_accumulate_grad_hook'): # 2.1.0
+            for param_idx, param in enumerate(self.params):
+                self.hooks.append(param.register_post_accumulate_grad_hook(lambda _param, param_idx=param_idx: self._hook(param_idx)))
+
+    def begin(self, key, final):
+        self.key = key
+        self.final = final
+        if final:
+            self.received = [0] * len(self.params)
+            self.launched = [None] * len(self.buckets)
+            self.next_bucket = 0
+            self.mismatch = False
+
+    def _is_ready(self, bucket_idx):
+        expected = self.expected[self.key]
+        return all(self.received[param_idx] >= expected[param_idx] for param_idx in self.buckets[bucket_idx])
+
+    def _hook(self, param_idx):
+        if not self.final:
+            return
+        self.received[param_idx] += 1
+        if self.key not in self.verified or self.mismatch:
+            return
+        if self.received[param_idx] > self.expected[self.key][param_idx]:
+            self.mismatch = True # its bucket may already be in flight; finish() reduces everything again
+            return
+        while self.next_bucket < len(self.buckets) and self._is_ready(self.next_bucket):
+            self._launch(self.next_bucket)
+            self.next_bucket += 1
+
+    def _launch(self, bucket_idx):
+        params = [self.params[param_idx] for param_idx in self.buckets[bucket_idx] if self.params[param_idx].grad is not None]
+        flat = None
+        handle = None
+        if len(params) > 0:
+            flat = torch.cat([param.grad.flatten() for param in params])
+            if self.num_gpus > 1:
+                handle = torch.distributed.all_reduce(flat, async_op=True)
+        self.launched[bucket_idx] = (params, flat, handle)
+
+    def _discard_launched(self):
+        for launched in self.launched:
+            if launched is not None and launched[2] is not None:
+                launched[2].wait()
+        self.launched = [None] * len(self.buckets)
+        self.next_bucket = 0
+
+    def finish(self):
+        assert self.final
+        if self.mismatch or self.expected.get(self.key) != self.received:
+            self._discard_launched()
+            self.expected[self.key] = list(self.received)
+            self.verified.discard(self.key)
+        else:
+            self.verified.add(self.key)
+        while self.next_bucket < len(self.buckets):
+            self._launch(self.next_bucket)
+            self.next_bucket += 1
+        for params, flat, handle in self.launched:
+            if flat is None:
+                continue
+            if handle is not None:
+                handle.wait()
+            if self.num_gpus > 1:
+                flat /= self.num_gpus
+            nan_to_num(flat, nan=0, posinf=1e5, neginf=-1e5, out=flat)
+            grads = flat.split([param.numel() for param in params])
+            for param, grad in zip(params, grads):
+                param.grad = grad.reshape(param.shape)
+        self.final = False
+        self.launched = None
+
 #----------------------------------------------------------------------------
 # Context manager for easily enabling/disabling DistributedDataParallel
 # synchronization.
@@ -229,6 +229,27 @@ class Collector:
         """
         return self.mean(name)
 
+    def state_dict(self):
+        r"""Returns the user-visible averages and the scalars collected since
+        the last `update()`, for resuming with `load_state_dict()`.
+
+        Like `update()`, this performs one `torch.distributed.all_reduce()`
+        and must be called by all processes.
+        """
+        pending = dict()
+        for name, cumulative in _sync(self.names()):
+            pending[name] = cumulative - self._cumulative.get(name, torch.zeros([_num_moments], dtype=_counter_dtype))
+        return dict(moments={name: delta.clone() for name, delta in self._moments.items()}, pending=pending)
+
+    def load_state_dict(self, state):
+        r"""Restores the state returned by `state_dict()`. The scalars that
+        were pending at the time are included in the next `update()`. Must be
+        called before any matching statistics are reported in this process.
+        """
+        self._moments = {name: delta.clone() for name, delta in state['moments'].items()}
+        for name, delta in state['pending'].items():
+            self._cumulative[name] = _cumulative.get(name, torch.zeros([_num_moments], dtype=_counter_dtype)) - delta
+
 #----------------------------------------------------------------------------
 
 def _sync(names):
@@ -13,11 +13,13 @@ import os
 import click
 import re
 import json
+import signal
 import tempfile
 import torch
 
 import dnnlib
 from training import training_loop
+from training import augment
 from metrics import metric_main
 from torch_utils import training_stats
 from torch_utils import custom_ops
@@ -91,15 +93,27 @@ def launch_training(c, desc, outdir, dry_run):
         if c.num_gpus == 1:
             subprocess_fn(rank=0, c=c, temp_dir=temp_dir)
         else:
-            torch.multiprocessing.spawn(fn=subprocess_fn, args=(c, temp_dir), nprocs=c.num_gpus)
+            context = torch.multiprocessing.spawn(fn=subprocess_fn, args=(c, temp_dir), nprocs=c.num_gpus, join=False)
+            if c.checkpoint_on_sigterm:
+                # Forward SIGTERM to every rank, so that they agree to save the training state and exit.
+                def forward_signal(signum, _frame):
+                    for process in context.processes:
+                        if process.is_alive():
+                            os.kill(process.pid, signum)
+                signal.signal(signal.SIGTERM, forward_signal)
+            while not context.join():
+                pass
 
 
 # ----------------------------------------------------------------------------
 
 
-def init_dataset_kwargs(data):
+def init_dataset_kwargs(data, resolution=None, mip_cache=None):
     try:
         dataset_kwargs = dnnlib.EasyDict(class_name='training.dataset.ImageFolderDataset', path=data, use_labels=True, max_size=None, xflip=False, yflip=False)
+        if resolution is not None:
+            dataset_kwargs.resolution = resolution
+            dataset_kwargs.mip_cache = mip_cache
         dataset_obj = dnnlib.util.construct_class_by_name(**dataset_kwargs) # Subclass of training.dataset.Dataset.
         dataset_kwargs.resolution = dataset_obj.resolution # Be explicit about resolution.
         dataset_kwargs.use_labels = dataset_obj.has_labels # Be explicit about labels.
@@ -133,9 +147,12 @@ def parse_comma_separated_list(s):
 @click.option('--cond',         help='Train conditional model', metavar='BOOL',                 type=bool, default=False, show_default=True)
 @click.option('--mirror',       help='Enable dataset x-flips', metavar='BOOL',                  type=bool, default=False, show_default=True)
 @click.option('--mirror-y',     help='Enable dataset y-flips', metavar='BOOL',                  type=bool, default=False, show_default=True)
+@click.option('--data-res',     help='Downscale the dataset on the fly', metavar='INT',         type=click.IntRange(min=4))
+@click.option('--data-mip-cache', help='Keep the downscaled images on disk', metavar='BOOL',    type=bool, default=False, show_default=True)
 @click.option('--aug',          help='Augmentation mode',                                       type=click.Choice(['noaug', 'ada', 'fixed']), default='ada', show_default=True)
 @click.option('--augpipe',      help='Augmentation pipeline',                                   type=click.Choice(['blit', 'geom', 'color', 'filter', 'noise', 'cutout', 'bg', 'bgc', 'bgcf', 'bgcfn', 'bgcfnc']), default='bgc', show_default=True)
 @click.option('--resume',       help='Resume from given network pickle', metavar='[PATH|URL]',  type=str)
+@click.option('--resume-state', help='Resume exactly from a full training state checkpoint',    metavar='PATH', type=click.Path(exists=True, dir_okay=False))
 @click.option('--initstrength', help='Override ADA augment strength at the beginning',          type=click.FloatRange(min=0.0), )
 @click.option('--freezeD',      help='Freeze first layers of D', metavar='INT',                 type=click.IntRange(min=0), default=0, show_default=True)
 # Experimental features.
@@ -153,20 +170,27 @@ def parse_comma_separated_list(s):
 @click.option('--dlr',          help='D learning rate', metavar='FLOAT',                        type=click.FloatRange(min=0), default=0.002, show_default=True)
 @click.option('--map-depth',    help='Mapping network depth  [default: varies]', metavar='INT', type=click.IntRange(min=1))
 @click.option('--mbstd-group',  help='Minibatch std group size', metavar='INT',                 type=click.IntRange(min=1), default=4, show_default=True)
+@click.option('--ema-interval', help='How often to update G_ema', metavar='ITERS',              type=click.IntRange(min=1), default=1, show_default=True)
 # Misc settings.
 @click.option('--outdir',       help='Where to save the results', metavar='DIR',                type=click.Path(file_okay=False), default=os.path.join(os.getcwd(), 'training-runs'))
 @click.option('--desc',         help='String to include in result dir name', metavar='STR',     type=str)
 @click.option('--metrics',      help='Quality metrics', metavar='[NAME|A,B,C|none]',            type=parse_comma_separated_list, default='none', show_default=True)
+@click.option('--metrics-async', help='Evaluate metrics in a separate worker', metavar='BOOL',  type=bool, default=False, show_default=True)
+@click.option('--metrics-device', help='Device for the local metric worker  [default: first GPU not used for training]', metavar='[DEVICE|none]', type=str, default=None)
+@click.option('--metrics-queue', help='Max. snapshots waiting for the worker', metavar='INT',   type=click.IntRange(min=1), default=2, show_default=True)
 @click.option('--kimg',         help='Total training duration', metavar='KIMG',                 type=click.IntRange(min=1), default=25000, show_default=True)
 @click.option('--resume-kimg',  help='Number of kimg images to resume from', metavar='RKIMG',   type=click.IntRange(min=0), default=0, show_default=True)
 @click.option('--tick',         help='How often to print progress', metavar='KIMG',             type=click.IntRange(min=1), default=4, show_default=True)
 @click.option('--snap',         help='How often to save model snapshots', metavar='TICKS',      type=click.IntRange(min=1), default=50, show_default=True)
 @click.option('--img-snap',     help='How often to save image snapshots', metavar='INT',        type=click.IntRange(min=1), default=50, show_default=True)
+@click.option('--ckpt',         help='How often to save full training state', metavar='TICKS',  type=click.IntRange(min=1))
+@click.option('--ckpt-sigterm', help='Save full training state and exit upon SIGTERM',          metavar='BOOL', type=bool, default=False, show_default=True)
 @click.option('--snap-res',     help='Screen resolution to save image snapshot',                type=click.Choice(['1080p', '4k', '8k']), default='4k', show_default=True)
 @click.option('--seed',         help='Random seed', metavar='INT',                              type=click.IntRange(min=0), default=0, show_default=True)
 @click.option('--fp32',         help='Disable mixed-precision', metavar='BOOL',                 type=bool, default=False, show_default=True)
 @click.option('--nobench',      help='Disable cuDNN benchmarking', metavar='BOOL',              type=bool, default=False, show_default=True)
 @click.option('--workers',      help='DataLoader worker processes', metavar='INT',              type=click.IntRange(min=1), default=3, show_default=True)
+@click.option('--prefetch',     help='Batches to keep staged on the GPU', metavar='INT',        type=click.IntRange(min=1), default=2, show_default=True)
 @click.option('-n','--dry-run', help='Print training options and exit',                         is_flag=True)
 def main(**kwargs):
     """Train a GAN using the techniques described in the paper
@@ -202,7 +226,10 @@ def main(**kwargs):
     c.data_loader_kwargs = dnnlib.EasyDict(pin_memory=True, prefetch_factor=2)
 
     # Training set.
-    c.training_set_kwargs, dataset_name = init_dataset_kwargs(data=opts.data)
+    if opts.data_mip_cache and opts.data_res is None:
+        raise click.ClickException('--data-mip-cache requires --data-res')
+    mip_cache = dnnlib.make_cache_dir_path('mip-cache') if opts.data_mip_cache else None
+    c.training_set_kwargs, dataset_name = init_dataset_kwargs(data=opts.data, resolution=opts.data_res, mip_cache=mip_cache)
     if opts.cond and not c.training_set_kwargs.use_labels:
         raise click.ClickException('--cond=True requires labels specified in dataset.json')
     c.training_set_kwargs.use_labels = opts.cond
@@ -229,14 +256,24 @@ def main(**kwargs):
     c.G_opt_kwargs.lr = (0.002 if opts.cfg == 'stylegan2' else 0.0025) if opts.glr is None else opts.glr
     c.D_opt_kwargs.lr = opts.dlr
     c.metrics = opts.metrics
+    c.metrics_async = opts.metrics_async
+    c.metrics_device = None if (opts.metrics_device or '').lower() == 'none' else opts.metrics_device
+    if opts.metrics_async and len(opts.metrics) > 0 and opts.metrics_device is None:
+        if torch.cuda.device_count() <= opts.gpus:
+            raise click.ClickException('--metrics-async needs a GPU that is not used for training; specify --metrics-device, or --metrics-device=none and run calc_metrics.py --watch elsewhere')
+        c.metrics_device = f'cuda:{opts.gpus}' # training uses cuda:0 ... cuda:{gpus-1}
+    c.metrics_queue = opts.metrics_queue
     c.total_kimg = opts.kimg
     c.resume_kimg = opts.resume_kimg
     c.kimg_per_tick = opts.tick
     c.network_snapshot_ticks = opts.snap
     c.image_snapshot_ticks = opts.img_snap
+    c.checkpoint_ticks = opts.ckpt
+    c.checkpoint_on_sigterm = opts.ckpt_sigterm
     c.snap_res = opts.snap_res
     c.random_seed = c.training_set_kwargs.random_seed = opts.seed
     c.data_loader_kwargs.num_workers = opts.workers
+    c.prefetch_batches = opts.prefetch
 
     # Sanity checks.
     if c.batch_size % c.num_gpus != 0:
@@ -250,6 +287,7 @@ def main(**kwargs):
 
     # Base configuration.
     c.ema_kimg = c.batch_size * 10 / 32
+    c.ema_interval = opts.ema_interval
     if opts.cfg == 'stylegan2':
         c.G_kwargs.class_name = 'training.networks_stylegan2.Generator'
         c.loss_kwargs.style_mixing_prob = 0.9 # Enable style mixing regularization.
@@ -306,22 +344,8 @@ def main(**kwargs):
         c.loss_kwargs.blur_fade_kimg = (opts.blur_percent / 100.0) * total_kimg
 
     # Augmentation.
-    augpipe_specs = {
-        'blit': dict(xflip=1, rotate90=1, xint=1),
-        'geom': dict(scale=1, rotate=1, aniso=1, xfrac=1),
-        'color': dict(brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1),
-        'filter': dict(imgfilter=1),
-        'noise': dict(noise=1),
-        'cutout': dict(cutout=1),
-        'bg': dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1),
-        'bgc': dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1, brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1),
-        'bgcf': dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1, brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1, imgfilter=1),
-        'bgcfn': dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1, brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1, imgfilter=1, noise=1),
-        'bgcfnc': dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1, brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1, imgfilter=1, noise=1, cutout=1)
-    }
-
     if opts.aug != 'noaug':
-        c.augment_kwargs = dnnlib.EasyDict(class_name='training.augment.AugmentPipe', **augpipe_specs[opts.augpipe])
+        c.augment_kwargs = dnnlib.EasyDict(class_name='training.augment.AugmentPipe', **augment.augpipe_specs[opts.augpipe])
         if opts.aug == 'ada':
             c.ada_target = opts.target
         if opts.aug == 'fixed':
@@ -333,7 +357,10 @@ def main(**kwargs):
 
     # Resume.
 
-    if opts.resume is None:
+    if opts.resume_state is not None:
+        c.resume_state = opts.resume_state
+        resume_desc = 'resume_state'
+    elif opts.resume is None:
         resume_desc = 'no_resume'
     else:
         if opts.resume in gen_utils.resume_specs[opts.cfg]:
@@ -42,6 +42,23 @@ wavelets = {
     'sym8': [-0.0033824159510061256, -0.0005421323317911481, 0.03169508781149298, 0.007607487324917605, -0.1432942383508097, -0.061273359067658524, 0.4813596512583722, 0.7771857517005235, 0.3644418948353314, -0.05194583810770904, -0.027219029917056003, 0.049137179673607506, 0.003808752013890615, -0.01495225833704823, -0.0003029205147213668, 0.0018899503327594609],
 }
 
+#----------------------------------------------------------------------------
+# Augmentation pipeline presets, see train.py --augpipe.
+
+augpipe_specs = {
+    'blit':   dict(xflip=1, rotate90=1, xint=1),
+    'geom':   dict(scale=1, rotate=1, aniso=1, xfrac=1),
+    'color':  dict(brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1),
+    'filter': dict(imgfilter=1),
+    'noise':  dict(noise=1),
+    'cutout': dict(cutout=1),
+    'bg':     dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1),
+    'bgc':    dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1, brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1),
+    'bgcf':   dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1, brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1, imgfilter=1),
+    'bgcfn':  dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1, brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1, imgfilter=1, noise=1),
+    'bgcfnc': dict(xflip=1, rotate90=1, xint=1, scale=1, rotate=1, aniso=1, xfrac=1, brightness=1, contrast=1, lumaflip=1, hue=1, saturation=1, imgfilter=1, noise=1, cutout=1),
+}
+
 #----------------------------------------------------------------------------
 # Helpers for constructing transformation matrices.
 
@@ -117,6 +134,12 @@ def rotate2d_inv(theta, **kwargs):
 #
 # All augmentations are disabled by default; individual augmentations can
 # be enabled by setting their probability multipliers to 1.
+#
+# With fused=True, the geometric transformations are only executed for the
+# samples whose transform is not the identity, and the color transformation
+# is applied as a single batched multiply-add. fused=False runs the original
+# implementation, e.g. for benchmarking; both produce the same images up to
+# floating point rounding.
 
 @persistence.persistent_class
 class AugmentPipe(torch.nn.Module):
@@ -126,9 +149,11 @@ class AugmentPipe(torch.nn.Module):
         brightness=0, contrast=0, lumaflip=0, hue=0, saturation=0, brightness_std=0.2, contrast_std=0.5, hue_max=1, saturation_std=1,
         imgfilter=0, imgfilter_bands=[1,1,1,1], imgfilter_std=1,
         noise=0, cutout=0, noise_std=0.1, cutout_size=0.5,
+        fused=True,
     ):
         super().__init__()
         self.register_buffer('p', torch.ones([]))       # Overall multiplier for augmentation probability.
+        self.fused            = bool(fused)             # Skip identity transforms and fuse the color transform?
 
         # Pixel blitting.
         self.xflip            = float(xflip)            # Probability multiplier for x-flip.
@@ -183,6 +208,55 @@ class AugmentPipe(torch.nn.Module):
             Hz_fbank[i, (Hz_fbank.shape[1] - Hz_hi2.size) // 2 : (Hz_fbank.shape[1] + Hz_hi2.size) // 2] += Hz_hi2
         self.register_buffer('Hz_fbank', torch.as_tensor(Hz_fbank, dtype=torch.float32))
 
+    # Calculate the padding [x0, y0, x1, y1] needed by the geometric transformations G_inv, on the device.
+    # Samples where mask is False are ignored.
+    def _geom_margin(self, G_inv, width, height, mask=None):
+        device = G_inv.device
+        cx = (width - 1) / 2
+        cy = (height - 1) / 2
+        cp = matrix([-cx, -cy, 1], [cx, -cy, 1], [cx, cy, 1], [-cx, cy, 1], device=device) # [idx, xyz]
+        cp = G_inv @ cp.t() # [batch, xyz, idx]
+        if mask is not None:
+            cp = cp * mask.reshape(-1, 1, 1) # margin of zero, i.e., no padding
+        Hz_pad = self.Hz_geom.shape[0] // 4
+        margin = cp[:, :2, :].permute(1, 0, 2).flatten(1) # [xy, batch * idx]
+        margin = torch.cat([-margin, margin]).max(dim=1).values # [x0, y0, x1, y1]
+        margin = margin + misc.constant([Hz_pad * 2 - cx, Hz_pad * 2 - cy] * 2, device=device)
+        margin = margin.max(misc.constant([0, 0] * 2, device=device))
+        margin = margin.min(misc.constant([width-1, height-1] * 2, device=device))
+        return margin.ceil().to(torch.int32)
+
+    # Execute the geometric transformations G_inv for a batch of images.
+    # The padding is read back to the host unless it is given as a list of ints.
+    def _execute_geom(self, images, G_inv, margin=None):
+        batch_size, num_channels, height, width = images.shape
+        device = images.device
+
+        # Calculate padding.
+        if margin is None:
+            margin = self._geom_margin(G_inv, width, height).tolist()
+        mx0, my0, mx1, my1 = margin
+        Hz_pad = self.Hz_geom.shape[0] // 4
+
+        # Pad image and upsample.
+        images = torch.nn.functional.pad(input=images, pad=[mx0,mx1,my0,my1], mode='reflect')
+        images = upfirdn2d.upsample2d(x=images, f=self.Hz_geom, up=2)
+        shape = [batch_size, num_channels, (height + Hz_pad * 2) * 2, (width + Hz_pad * 2) * 2]
+
+        # Adjust the origin for the padding, the scale and pixel centers for the upsampling, and normalize to [-1,1].
+        # The constant parts of the transform are composed first, so only two batched matmuls remain.
+        pre = scale2d(2 / images.shape[3], 2 / images.shape[2], device=device) @ translate2d(-0.5, -0.5, device=device) @ scale2d(2, 2, device=device) @ translate2d((mx0 - mx1) / 2, (my0 - my1) / 2)
+        post = scale2d_inv(2, 2, device=device) @ translate2d_inv(-0.5, -0.5, device=device) @ scale2d_inv(2 / shape[3], 2 / shape[2], device=device)
+        G_inv = pre @ G_inv @ post
+
+        # Execute transformation.
+        grid = torch.nn.functional.affine_grid(theta=G_inv[:,:2,:], size=shape, align_corners=False)
+        images = grid_sample_gradfix.grid_sample(images, grid)
+
+        # Downsample and crop.
+        images = upfirdn2d.downsample2d(x=images, f=self.Hz_geom, down=2, padding=-Hz_pad*2, flip_filter=True)
+        return images
+
     def forward(self, images, debug_percentile=None):
         assert isinstance(images, torch.Tensor) and images.ndim == 4
         batch_size, num_channels, height, width = images.shape
@@ -273,37 +347,20 @@ class AugmentPipe(torch.nn.Module):
 
         # Execute if the transform is not identity.
         if G_inv is not I_3:
-
-            # Calculate padding.
-            cx = (width - 1) / 2
-            cy = (height - 1) / 2
-            cp = matrix([-cx, -cy, 1], [cx, -cy, 1], [cx, cy, 1], [-cx, cy, 1], device=device) # [idx, xyz]
-            cp = G_inv @ cp.t() # [batch, xyz, idx]
-            Hz_pad = self.Hz_geom.shape[0] // 4
-            margin = cp[:, :2, :].permute(1, 0, 2).flatten(1) # [xy, batch * idx]
-            margin = torch.cat([-margin, margin]).max(dim=1).values # [x0, y0, x1, y1]
-            margin = margin + misc.constant([Hz_pad * 2 - cx, Hz_pad * 2 - cy] * 2, device=device)
-            margin = margin.max(misc.constant([0, 0] * 2, device=device))
-            margin = margin.min(misc.constant([width-1, height-1] * 2, device=device))
-            mx0, my0, mx1, my1 = margin.ceil().to(torch.int32)
-
-            # Pad image and adjust origin.
-            images = torch.nn.functional.pad(input=images, pad=[mx0,mx1,my0,my1], mode='reflect')
-            G_inv = translate2d((mx0 - mx1) / 2, (my0 - my1) / 2) @ G_inv
-
-            # Upsample.
-            images = upfirdn2d.upsample2d(x=images, f=self.Hz_geom, up=2)
-            G_inv = scale2d(2, 2, device=device) @ G_inv @ scale2d_inv(2, 2, device=device)
-            G_inv = translate2d(-0.5, -0.5, device=device) @ G_inv @ translate2d_inv(-0.5, -0.5, device=device)
-
-            # Execute transformation.
-            shape = [batch_size, num_channels, (height + Hz_pad * 2) * 2, (width + Hz_pad * 2) * 2]
-            G_inv = scale2d(2 / images.shape[3], 2 / images.shape[2], device=device) @ G_inv @ scale2d_inv(2 / shape[3], 2 / shape[2], device=device)
-            grid = torch.nn.functional.affine_grid(theta=G_inv[:,:2,:], size=shape, align_corners=False)
-            images = grid_sample_gradfix.grid_sample(images, grid)
-
-            # Downsample and crop.
-            images = upfirdn2d.downsample2d(x=images, f=self.Hz_geom, down=2, padding=-Hz_pad*2, flip_filter=True)
+            if self.fused:
+                # Only resample the images whose transform is not the identity. Their count is read back
+                # together with the padding, which has to reach the host anyway, so there is a single sync.
+                mask = (G_inv != I_3).flatten(1).any(dim=1)
+                idx = torch.sort(mask.to(torch.uint8), descending=True, stable=True).indices # non-identity first
+                margin = self._geom_margin(G_inv, width, height, mask=mask)
+                *margin, num = torch.cat([margin, mask.sum(dtype=torch.int32).reshape(1)]).tolist()
+                if num == batch_size:
+                    images = self._execute_geom(images, G_inv, margin)
+                elif num > 0:
+                    idx = idx[:num]
+                    images = images.index_copy(0, idx, self._execute_geom(images[idx], G_inv[idx], margin))
+            else:
+                images = self._execute_geom(images, G_inv)
 
         # --------------------------------------------
         # Select parameters for color transformations.
@@ -359,7 +416,21 @@ class AugmentPipe(torch.nn.Module):
         # ------------------------------
 
         # Execute if the transform is not identity.
-        if C is not I_4:
+        if C is not I_4 and self.fused:
+            images = images.reshape([batch_size, num_channels, height * width])
+            if num_channels == 3:
+                images = torch.baddbmm(C[:, :3, 3:], C[:, :3, :3], images)
+            elif num_channels == 4: # Only augment the RGB channels; alpha passes through.
+                A = torch.nn.functional.pad(C[:, :3, :3], [0, 1, 0, 1])
+                A[:, 3, 3] = 1
+                images = torch.baddbmm(torch.nn.functional.pad(C[:, :3, 3:], [0, 0, 0, 1]), A, images)
+            elif num_channels == 1:
+                C = C[:, :3, :].mean(dim=1, keepdims=True)
+                images = torch.addcmul(C[:, :, 3:], images, C[:, :, :3].sum(dim=2, keepdims=True))
+            else:
+                raise ValueError('Image must be RGBA (4 channels), RGB (3 channels), or L (1 channel)')
+            images = images.reshape([batch_size, num_channels, height, width])
+        elif C is not I_4:
             images = images.reshape([batch_size, num_channels, height * width])
             if num_channels == 3:
                 images = C[:, :3, :3] @ images + C[:, :3, 3:]
@@ -0,0 +1,190 @@
+# Copyright (c) 2021, NVIDIA CORPORATION & AFFILIATES.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+"""Network snapshots and full training state checkpoints, written in the
+background without stalling training."""
+
+import os
+import copy
+import contextlib
+import uuid
+import pickle
+import signal
+import threading
+import numpy as np
+import torch
+from torch_utils import misc
+
+#----------------------------------------------------------------------------
+# Write a file via a temporary next to it, fsync, and atomically rename it
+# into place. Readers never observe a partially written file.
+
+def write_file_atomic(fname, write_fn):
+    temp_file = fname + '.' + uuid.uuid4().hex
+    try:
+        with open(temp_file, 'wb') as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, fname) # atomic
+    finally:
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+
+#----------------------------------------------------------------------------
+# Keeps one pinned host replica per snapshotted module and serializes the
+# replicas on a background thread. capture() refreshes the replicas from the
+# live modules, so it first waits for the previous write to finish.
+
+class SnapshotWriter:
+    def __init__(self):
+        self._replicas = dict() # name => torch.nn.Module
+        self._thread = None
+        self._error = None
+
+    def _get_replica(self, name, module):
+        replica = self._replicas.get(name, None)
+        if replica is None:
+            replica = copy.deepcopy(module).eval().requires_grad_(False).cpu()
+            if torch.cuda.is_available():
+                for tensor in misc.params_and_buffers(replica):
+                    tensor.data = tensor.data.pin_memory()
+            self._replicas[name] = replica
+        return replica
+
+    def capture(self, modules, num_gpus=1):
+        self.wait()
+        replicas = dict()
+        for name, module in modules.items():
+            if module is None:
+                replicas[name] = None
+                continue
+            replica = self._get_replica(name, module)
+            for src, dst in zip(misc.params_and_buffers(module), misc.params_and_buffers(replica)):
+                src = src.detach()
+                if num_gpus > 1:
+                    src = src.clone()
+                    torch.distributed.broadcast(src, src=0)
+                dst.copy_(src, non_blocking=True)
+            replicas[name] = replica
+        if torch.cuda.is_available():
+            torch.cuda.synchronize() # replicas must be complete before anyone reads them on the host
+        return replicas
+
+    def _write_main(self, fname, write_fn, on_done):
+        try:
+            write_file_atomic(fname, write_fn)
+            if on_done is not None:
+                on_done()
+        except BaseException as err: # pylint: disable=broad-except
+            self._error = err
+
+    def _start(self, fname, write_fn, on_done=None):
+        self.wait()
+        self._thread = threading.Thread(target=self._write_main, args=(fname, write_fn, on_done), daemon=True)
+        self._thread.start()
+
+    def write(self, fname, data, on_done=None): # on_done() is called on the writer thread once fname is in place.
+        self._start(fname, lambda f: pickle.dump(data, f), on_done=on_done)
+
+    def write_state(self, fname, state): # state must already live on the host, see copy_to_host()
+        self._start(fname, lambda f: torch.save(state, f))
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise err
+
+#----------------------------------------------------------------------------
+# Full training state. Everything is stored as tensors, plain Python values,
+# and containers thereof, so that it can be loaded with weights_only=True.
+
+def copy_to_host(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, copy_to_host(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_host(value) for value in obj)
+    return obj
+
+def load_training_state(fname):
+    with open(fname, 'rb') as f:
+        try:
+            return torch.load(f, map_location='cpu', weights_only=True)
+        except TypeError: # weights_only was added in PyTorch 1.13
+            f.seek(0)
+            return torch.load(f, map_location='cpu')
+
+#----------------------------------------------------------------------------
+# Random number generator states of every rank, gathered on all ranks.
+# The numpy state is packed into float64, which represents its uint32 keys
+# exactly.
+
+def _gather_tensor(tensor, num_gpus, device):
+    if num_gpus == 1:
+        return [tensor]
+    result = []
+    for src in range(num_gpus):
+        y = tensor.to(device).clone()
+        torch.distributed.broadcast(y, src=src)
+        result.append(y.cpu())
+    return result
+
+def get_rng_states(data_generator_state, num_gpus=1, device=torch.device('cuda')):
+    _name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    states = dict(
+        torch  = torch.get_rng_state(),
+        numpy  = torch.as_tensor(np.concatenate([keys, [pos, has_gauss, cached_gaussian]]), dtype=torch.float64),
+        data   = data_generator_state,
+    )
+    if device.type == 'cuda':
+        states['cuda'] = torch.cuda.get_rng_state(device)
+    return {name: _gather_tensor(state, num_gpus=num_gpus, device=device) for name, state in states.items()}
+
+def set_rng_states(states, rank=0, device=torch.device('cuda')): # Returns the state of the data generator.
+    torch.set_rng_state(states['torch'][rank])
+    numpy_state = states['numpy'][rank].numpy()
+    np.random.set_state(('MT19937', numpy_state[:-3].astype(np.uint32), int(numpy_state[-3]), int(numpy_state[-2]), float(numpy_state[-1])))
+    if device.type == 'cuda' and 'cuda' in states:
+        torch.cuda.set_rng_state(states['cuda'][rank], device)
+    return states['data'][rank]
+
+#----------------------------------------------------------------------------
+# Runs the body without advancing the global random number generators, so
+# that work done between steps (e.g. evaluating metrics) does not affect the
+# rest of the training run, which resuming from a checkpoint reproduces.
+
+@contextlib.contextmanager
+def preserve_rng_states(device=torch.device('cuda')):
+    numpy_state = np.random.get_state()
+    try:
+        with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+            yield
+    finally:
+        np.random.set_state(numpy_state)
+
+#----------------------------------------------------------------------------
+# Records the arrival of termination signals (e.g. spot instance preemption)
+# so that the training loop can write a checkpoint and exit cleanly.
+
+class SignalFlag:
+    def __init__(self, signals=(signal.SIGTERM,)):
+        self.received = False
+        for sig in signals:
+            signal.signal(sig, self._handler)
+
+    def _handler(self, signum, _frame):
+        if not self.received:
+            print(f'Received signal {signum}; saving training state at the next opportunity...')
+        self.received = True
+
+#----------------------------------------------------------------------------
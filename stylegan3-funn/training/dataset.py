@@ -9,6 +9,10 @@
 """Streaming images and labels from datasets created with dataset_tool.py."""
 
 import os
+import io
+import uuid
+import struct
+import hashlib
 import numpy as np
 import zipfile
 import PIL.Image
@@ -32,12 +36,20 @@ class Dataset(torch.utils.data.Dataset):
         xflip       = False,    # Artificially double the size of the dataset via x-flips. Applied after max_size.
         yflip       = False,    # Artificially double the size of the dataset via y-flips. Applied after xflip.
         random_seed = 0,        # Random seed to use when applying max_size.
+        defer_flips = False,    # Return raw images plus per-sample flip flags instead of flipping on the CPU?
+        resolution  = None,     # Downscale the images to this resolution on the fly. None = raw resolution.
+        mip_cache   = None,     # Directory for persisting the downscaled images as they are loaded. None = disable.
     ):
         self._name = name
+        self._defer_flips = defer_flips
         self._raw_shape = list(raw_shape)
+        self._resolution = None
+        self._mip_cache_dir = mip_cache
+        self._mip_cache = None
         self._use_labels = use_labels
         self._raw_labels = None
         self._label_shape = None
+        self._label_tensors = dict() # device => torch.Tensor
 
         # Apply max_size.
         self._raw_idx = np.arange(self._raw_shape[0], dtype=np.int64)
@@ -59,6 +71,14 @@ class Dataset(torch.utils.data.Dataset):
             # We then need double the amount of indices for xflip:
             self._xflip = np.tile(self._xflip, 2)
 
+        # Setup downscaled view.
+        if resolution is not None and (self._raw_shape[2] != resolution or self._raw_shape[3] != resolution):
+            if self._raw_shape[2] != self._raw_shape[3]:
+                raise IOError('Image files do not match the specified resolution')
+            if resolution > self._raw_shape[3]:
+                raise IOError(f'Image files are smaller than the specified resolution ({self._raw_shape[3]} < {resolution})')
+            self._resolution = int(resolution)
+
     def _get_raw_labels(self):
         if self._raw_labels is None:
             self._raw_labels = self._load_raw_labels() if self._use_labels else None
@@ -81,8 +101,46 @@ class Dataset(torch.utils.data.Dataset):
     def _load_raw_labels(self): # to be overridden by subclass
         raise NotImplementedError
 
+    def _load_raw_image_ids(self): # to be overridden by subclass
+        raise NotImplementedError
+
+    def _get_fingerprint(self): # may be overridden by subclass with something cheaper
+        return hashlib.md5('\n'.join(self._load_raw_image_ids()).encode('utf-8')).hexdigest()
+
+    def _get_mip_cache(self): # => (images, filled), memory-mapped from the mip cache directory, created on first use
+        if self._mip_cache is None:
+            base = os.path.join(self._mip_cache_dir, f'{self._name}-{self._get_fingerprint()}-{self._resolution}')
+            shape = [self._raw_shape[0], self._raw_shape[1], self._resolution, self._resolution]
+            for suffix, dtype, item_shape in [('images', np.uint8, shape), ('filled', np.uint8, shape[:1])]:
+                fname = f'{base}-{suffix}.npy'
+                if not os.path.isfile(fname):
+                    os.makedirs(self._mip_cache_dir, exist_ok=True)
+                    temp_file = f'{fname}.{uuid.uuid4().hex}.npy'
+                    np.lib.format.open_memmap(temp_file, mode='w+', dtype=dtype, shape=tuple(item_shape)).flush()
+                    try:
+                        os.link(temp_file, fname) # atomic, and never replaces a cache that another worker is already filling
+                    except FileExistsError:
+                        pass
+                    finally:
+                        os.remove(temp_file)
+            self._mip_cache = tuple(np.load(f'{base}-{suffix}.npy', mmap_mode='r+') for suffix in ['images', 'filled'])
+        return self._mip_cache
+
+    def _load_image(self, raw_idx): # Raw image, downscaled to the view resolution if any.
+        if self._resolution is None:
+            return self._load_raw_image(raw_idx)
+        if self._mip_cache_dir is not None:
+            images, filled = self._get_mip_cache()
+            if filled[raw_idx]:
+                return np.array(images[raw_idx])
+        image = downscale_image(self._load_raw_image(raw_idx), self._resolution)
+        if self._mip_cache_dir is not None:
+            images[raw_idx] = image
+            filled[raw_idx] = 1 # after the image, so that readers never see a partial one
+        return image
+
     def __getstate__(self):
-        return dict(self.__dict__, _raw_labels=None)
+        return dict(self.__dict__, _raw_labels=None, _label_tensors=dict(), _mip_cache=None)
 
     def __del__(self):
         try:
@@ -94,15 +152,23 @@ class Dataset(torch.utils.data.Dataset):
         return self._raw_idx.size
 
     def __getitem__(self, idx):
-        image = self._load_raw_image(self._raw_idx[idx])
+        image = self._load_image(self._raw_idx[idx])
         assert isinstance(image, np.ndarray)
         assert list(image.shape) == self.image_shape
         assert image.dtype == np.uint8
+        if self._defer_flips:
+            return image, self.get_label(idx), self.get_flips(idx)
         if self._xflip[idx]:
             assert image.ndim == 3 # CHW
             image = image[:, :, ::-1]
+        if self._yflip[idx]:
+            assert image.ndim == 3 # CHW
+            image = image[:, ::-1, :]
         return image.copy(), self.get_label(idx)
 
+    def get_flips(self, idx):
+        return np.array([self._xflip[idx], self._yflip[idx]], dtype=np.bool_)
+
     def get_label(self, idx):
         label = self._get_raw_labels()[self._raw_idx[idx]]
         if label.dtype == np.int64:
@@ -111,10 +177,35 @@ class Dataset(torch.utils.data.Dataset):
             label = onehot
         return label.copy()
 
+    def get_label_tensor(self, device=torch.device('cpu')):
+        labels = self._label_tensors.get(device, None)
+        if labels is None:
+            raw_labels = self._get_raw_labels()
+            if raw_labels.dtype == np.int64:
+                onehot = np.zeros([raw_labels.shape[0]] + self.label_shape, dtype=np.float32)
+                onehot[np.arange(raw_labels.shape[0]), raw_labels] = 1
+                raw_labels = onehot
+            labels = torch.from_numpy(raw_labels[self._raw_idx]).to(device) # [N, label_dim], indexed like get_label()
+            self._label_tensors[device] = labels
+        return labels
+
+    def sample_labels(self, n, generator=None, device=None):
+        if device is None:
+            device = generator.device if generator is not None else torch.device('cpu')
+        labels = self.get_label_tensor(device)
+        idx = torch.randint(labels.shape[0], [n], generator=generator, device=device)
+        return labels[idx]
+
+    def get_item_ids(self): # Content-based identifier of every item, independent of the dataset location.
+        raw_ids = self._load_raw_image_ids()
+        assert len(raw_ids) == self._raw_shape[0]
+        return [raw_ids[raw_idx] + ('-x' if xflip else '') + ('-y' if yflip else '') for raw_idx, xflip, yflip in zip(self._raw_idx, self._xflip, self._yflip)]
+
     def get_details(self, idx):
         d = dnnlib.EasyDict()
         d.raw_idx = int(self._raw_idx[idx])
         d.xflip = (int(self._xflip[idx]) != 0)
+        d.yflip = (int(self._yflip[idx]) != 0)
         d.raw_label = self._get_raw_labels()[d.raw_idx].copy()
         return d
 
@@ -124,6 +215,8 @@ class Dataset(torch.utils.data.Dataset):
 
     @property
     def image_shape(self):
+        if self._resolution is not None:
+            return [self._raw_shape[1], self._resolution, self._resolution]
         return list(self._raw_shape[1:])
 
     @property
@@ -161,50 +254,168 @@ class Dataset(torch.utils.data.Dataset):
         return self._get_raw_labels().dtype == np.int64
 
 #----------------------------------------------------------------------------
+# Anti-aliased downscaling of a CHW uint8 image, matching dataset_tool.py --resolution.
+
+def downscale_image(image, resolution):
+    img = PIL.Image.fromarray(image[0] if image.shape[0] == 1 else image.transpose(1, 2, 0))
+    img = img.resize((resolution, resolution), PIL.Image.LANCZOS)
+    img = np.asarray(img)
+    return img[np.newaxis] if img.ndim == 2 else img.transpose(2, 0, 1)
+
+#----------------------------------------------------------------------------
+
+_file_index_version = 3
 
 class ImageFolderDataset(Dataset):
     def __init__(self,
         path,                   # Path to directory or zip.
-        resolution      = None, # Ensure specific resolution, None = highest available.
+        resolution      = None, # Ensure specific resolution, downscaling larger images on the fly. None = highest available.
+        use_index       = True, # Persist the file listing next to the dataset as '<path>.index.json' and reuse it while the dataset is unchanged?
         **super_kwargs,         # Additional arguments for the Dataset base class.
     ):
-        self._path = path
+        self._path = os.path.normpath(path)
         self._zipfile = None
+        self._rawfile = None
+        self._stored_members = dict() # fname => (header offset, size) of uncompressed zip members
 
         if os.path.isdir(self._path):
             self._type = 'dir'
-            self._all_fnames = {os.path.relpath(os.path.join(root, fname), start=self._path) for root, _dirs, files in os.walk(self._path) for fname in files}
         elif self._file_ext(self._path) == '.zip':
             self._type = 'zip'
-            self._all_fnames = set(self._get_zipfile().namelist())
         else:
             raise IOError('Path must point to a directory or zip')
 
-        PIL.Image.init()
-        self._image_fnames = sorted(fname for fname in self._all_fnames if self._file_ext(fname) in PIL.Image.EXTENSION)
+        self._index = self._get_file_index(use_index)
+        self._all_fnames = {fname for fname, _size, _offset, _mtime in self._index['files']}
+        if self._type == 'zip':
+            self._stored_members = {fname: (offset, size) for fname, size, offset, _mtime in self._index['files'] if offset is not None}
+        self._image_fnames = self._index['image_fnames']
         if len(self._image_fnames) == 0:
             raise IOError('No image files found in the specified path')
 
         name = os.path.splitext(os.path.basename(self._path))[0]
-        raw_shape = [len(self._image_fnames)] + list(self._load_raw_image(0).shape)
-        if resolution is not None and (raw_shape[2] != resolution or raw_shape[3] != resolution):
-            raise IOError('Image files do not match the specified resolution')
-        super().__init__(name=name, raw_shape=raw_shape, **super_kwargs)
+        raw_shape = [len(self._image_fnames)] + list(self._index['image_shape'])
+        super().__init__(name=name, raw_shape=raw_shape, resolution=resolution, **super_kwargs)
 
     @staticmethod
     def _file_ext(fname):
         return os.path.splitext(fname)[1].lower()
 
+    def _get_zip_key(self):
+        st = os.stat(self._path)
+        return dict(size=st.st_size, mtime=st.st_mtime_ns)
+
+    def _scan_files(self): # => [[fname, size, offset, mtime], ...], {dir: mtime}
+        if self._type == 'zip':
+            return [[info.filename, info.file_size, info.header_offset if info.compress_type == zipfile.ZIP_STORED else None, None]
+                for info in self._get_zipfile().infolist() if not info.is_dir()], dict()
+        files, dirs, todo = [], dict(), ['.']
+        while todo:
+            d = todo.pop()
+            dirs[d] = os.stat(os.path.join(self._path, d)).st_mtime_ns
+            with os.scandir(os.path.join(self._path, d)) as it:
+                for entry in it:
+                    fname = os.path.normpath(os.path.join(d, entry.name))
+                    if entry.is_dir():
+                        todo.append(fname)
+                    elif entry.is_file():
+                        files.append([fname, None, None, None]) # no per-file stat, only readdir
+        return files, dirs
+
+    def _stat_files(self, fnames): # => {fname: [size, mtime]}
+        stats = dict()
+        for fname in fnames:
+            st = os.stat(os.path.join(self._path, fname))
+            stats[fname] = [st.st_size, st.st_mtime_ns]
+        return stats
+
+    # The index is valid while the zip keeps its size and mtime, or while every directory keeps its mtime (no files
+    # added, removed, or renamed) and a small sample of the files keeps its size and mtime. Files rewritten in place
+    # outside the sample are only caught where it matters, by the content hashes in _load_raw_image_ids().
+    def _is_index_valid(self, index):
+        try:
+            if self._type == 'zip':
+                return index['key'] == self._get_zip_key()
+            for d, mtime in index['dirs'].items():
+                if os.stat(os.path.join(self._path, d)).st_mtime_ns != mtime:
+                    return False
+            return self._stat_files(index['sample']) == index['sample']
+        except FileNotFoundError:
+            return False
+
+    def _get_file_index(self, use_index):
+        # Reuse the index if nothing has changed. It is plain JSON, as it lives next to the dataset.
+        self._index_file = (self._path + '.index.json') if use_index else None
+        old_hashes = dict()
+        if use_index and os.path.isfile(self._index_file):
+            try:
+                with open(self._index_file, 'rt') as f:
+                    index = json.load(f)
+                if index['version'] == _file_index_version and index['type'] == self._type:
+                    if self._is_index_valid(index):
+                        return index
+                    old_hashes = index.get('hashes', dict())
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+
+        # Scan the dataset.
+        files, dirs = self._scan_files()
+        PIL.Image.init()
+        self._all_fnames = {fname for fname, _size, _offset, _mtime in files}
+        self._image_fnames = sorted(fname for fname in self._all_fnames if self._file_ext(fname) in PIL.Image.EXTENSION)
+        index = dict(version=_file_index_version, type=self._type, dirs=dirs, files=files, image_fnames=self._image_fnames)
+        index['key'] = self._get_zip_key() if self._type == 'zip' else None
+        index['sample'] = self._stat_files(self._image_fnames[::max(len(self._image_fnames) // 16, 1)][:16]) if self._type == 'dir' else dict()
+        index['image_shape'] = self._load_image_shape() if len(self._image_fnames) > 0 else None
+        index['hashes'] = {fname: h for fname, h in old_hashes.items() if fname in self._all_fnames} # checked against the file on use
+        self._save_file_index(index)
+        return index
+
+    def _save_file_index(self, index): # Next to the dataset, if possible.
+        if self._index_file is None:
+            return
+        temp_file = f'{self._index_file}.{uuid.uuid4().hex}'
+        try:
+            with open(temp_file, 'wt') as f:
+                json.dump(index, f)
+            os.replace(temp_file, self._index_file) # atomic
+        except OSError as err:
+            print(f'Cannot save the file index of {self._path}: {err}')
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+
+    def _load_image_shape(self): # CHW, from dataset.json if recorded there by dataset_tool.py, otherwise from the first image.
+        if 'dataset.json' in self._all_fnames:
+            with self._open_file('dataset.json') as f:
+                shape = json.load(f).get('image_shape', None)
+            if shape is not None:
+                return list(shape)
+        return list(self._load_raw_image(0).shape)
+
     def _get_zipfile(self):
         assert self._type == 'zip'
         if self._zipfile is None:
             self._zipfile = zipfile.ZipFile(self._path)
         return self._zipfile
 
+    # Read a stored zip member directly at its indexed offset, without parsing the central directory.
+    def _read_stored_member(self, fname):
+        offset, size = self._stored_members[fname]
+        if self._rawfile is None:
+            self._rawfile = open(self._path, 'rb')
+        self._rawfile.seek(offset)
+        signature, name_len, extra_len = struct.unpack('<4s22xHH', self._rawfile.read(30)) # local file header
+        if signature != b'PK\x03\x04':
+            raise IOError(f'Bad zip member header: {fname}')
+        self._rawfile.seek(name_len + extra_len, os.SEEK_CUR)
+        return io.BytesIO(self._rawfile.read(size))
+
     def _open_file(self, fname):
         if self._type == 'dir':
             return open(os.path.join(self._path, fname), 'rb')
         if self._type == 'zip':
+            if fname in self._stored_members:
+                return self._read_stored_member(fname)
             return self._get_zipfile().open(fname, 'r')
         return None
 
@@ -212,11 +423,14 @@ class ImageFolderDataset(Dataset):
         try:
             if self._zipfile is not None:
                 self._zipfile.close()
+            if self._rawfile is not None:
+                self._rawfile.close()
         finally:
             self._zipfile = None
+            self._rawfile = None
 
     def __getstate__(self):
-        return dict(super().__getstate__(), _zipfile=None)
+        return dict(super().__getstate__(), _zipfile=None, _rawfile=None)
 
     def _load_raw_image(self, raw_idx):
         fname = self._image_fnames[raw_idx]
@@ -230,6 +444,34 @@ class ImageFolderDataset(Dataset):
         image = image.transpose(2, 0, 1) # HWC => CHW
         return image
 
+    def _load_raw_image_ids(self):
+        # Zip: CRC-32 and size from the central directory, no decompression needed.
+        if self._type == 'zip':
+            infos = [self._get_zipfile().getinfo(fname) for fname in self._image_fnames]
+            return [f'{info.CRC:08x}-{info.file_size}' for info in infos]
+
+        # Directory: hash of the file contents, persisted in the file index along with the size and mtime it belongs to.
+        stats = self._stat_files(self._image_fnames)
+        hashes = self._index.setdefault('hashes', dict()) # fname => [size, mtime, md5]
+        num_new = 0
+        for fname in self._image_fnames:
+            if hashes.get(fname, [None, None])[:2] != stats[fname]:
+                with self._open_file(fname) as f:
+                    hashes[fname] = stats[fname] + [hashlib.md5(f.read()).hexdigest()]
+                num_new += 1
+        if num_new > 0:
+            self._save_file_index(self._index)
+        return [f'{hashes[fname][2]}-{hashes[fname][0]}' for fname in self._image_fnames]
+
+    def _get_fingerprint(self):
+        if self._type == 'zip':
+            return super()._get_fingerprint() # CRC-32 based, cheap
+        stats = self._stat_files(self._image_fnames) # only needed for the mip cache
+        md5 = hashlib.md5()
+        for fname in self._image_fnames:
+            md5.update(f'{fname}:{stats[fname][0]}:{stats[fname][1]}\n'.encode('utf-8'))
+        return md5.hexdigest()
+
     def _load_raw_labels(self):
         fname = 'dataset.json'
         if fname not in self._all_fnames:
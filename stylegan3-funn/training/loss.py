@@ -20,6 +20,12 @@ class Loss:
     def accumulate_gradients(self, phase, real_img, real_c, gen_z, gen_c, gain, cur_nimg): # to be overridden by subclass
         raise NotImplementedError()
 
+    def state_dict(self): # to be overridden by subclass
+        return dict()
+
+    def load_state_dict(self, state): # to be overridden by subclass
+        pass
+
 #----------------------------------------------------------------------------
 
 class StyleGAN2Loss(Loss):
@@ -39,6 +45,12 @@ class StyleGAN2Loss(Loss):
         self.blur_init_sigma    = blur_init_sigma
         self.blur_fade_kimg     = blur_fade_kimg
 
+    def state_dict(self):
+        return dict(pl_mean=self.pl_mean)
+
+    def load_state_dict(self, state):
+        self.pl_mean.copy_(state['pl_mean'])
+
     def run_G(self, z, c, update_emas=False):
         ws = self.G.mapping(z, c, update_emas=update_emas)
         if self.style_mixing_prob > 0:
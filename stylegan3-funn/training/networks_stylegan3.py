@@ -9,6 +9,9 @@
 """Generator architecture from the paper
 "Alias-Free Generative Adversarial Networks"."""
 
+import inspect
+import weakref
+import functools
 import numpy as np
 import scipy.signal
 import scipy.optimize
@@ -219,9 +222,11 @@ class SynthesisInput(torch.nn.Module):
         self.register_buffer('freqs', freqs)        # [self.channels, 2]
         self.register_buffer('phases', phases)      # [self.channels]
 
-    def forward(self, w):
+    def forward(self, w, transform=None): # transform: Optional per-call override of self.transform, [3, 3] or [batch, 3, 3].
         # Introduce batch dimension.
-        transforms = self.transform.unsqueeze(0) # [batch, row, col]
+        transforms = self.transform if transform is None else transform.to(torch.float32)
+        transforms = transforms.unsqueeze(0) if transforms.ndim == 2 else transforms # [batch, row, col]
+        misc.assert_shape(transforms, [None, 3, 3])
         freqs = self.freqs.unsqueeze(0) # [batch, channel, xy]
         phases = self.phases.unsqueeze(0) # [batch, channel]
 
@@ -485,12 +490,12 @@ class SynthesisNetwork(torch.nn.Module):
             setattr(self, name, layer)
             self.layer_names.append(name)
 
-    def forward(self, ws, **layer_kwargs):
+    def forward(self, ws, transform=None, **layer_kwargs):
         misc.assert_shape(ws, [None, self.num_ws, self.w_dim])
         ws = ws.to(torch.float32).unbind(dim=1)
 
         # Execute layers.
-        x = self.input(ws[0])
+        x = self.input(ws[0], transform=transform)
         for name, w in zip(self.layer_names, ws[1:]):
             x = getattr(self, name)(x, w, **layer_kwargs)
         if self.output_scale != 1:
@@ -537,3 +542,58 @@ class Generator(torch.nn.Module):
         return img
 
 #----------------------------------------------------------------------------
+# Render ws with the given input transform(s), [3, 3] or [batch, 3, 3]. Also
+# works for synthesis networks unpickled from snapshots that predate the
+# transform argument. Their input layer is normally the same as ours, so
+# our SynthesisInput.forward() is run on it with the transform, in a single
+# call; this is checked once per network against the reference approach of
+# temporarily overriding the transform buffer, which remains the fallback,
+# once for each distinct transform in the batch.
+
+_legacy_input_ok = weakref.WeakKeyDictionary() # legacy SynthesisInput => does our forward() reproduce it?
+
+def synthesis_with_transform(synthesis, ws, transform, **layer_kwargs):
+    if 'transform' in inspect.signature(synthesis.forward).parameters:
+        return synthesis(ws, transform=transform, **layer_kwargs)
+    if transform is None:
+        return synthesis(ws, **layer_kwargs)
+    if synthesis.input not in _legacy_input_ok:
+        ok = (type(synthesis.input).__name__ == 'SynthesisInput')
+        if ok:
+            with torch.no_grad():
+                check = torch.as_tensor([[0.9, -0.4, 0.05], [0.4, 0.9, -0.1], [0, 0, 1]], dtype=torch.float32, device=ws.device)
+                ref = _synthesis_with_transform_buffer(synthesis, ws[:1], check, **layer_kwargs)
+                ok = torch.allclose(_synthesis_with_input_forward(synthesis, ws[:1], check, **layer_kwargs), ref, atol=1e-3)
+        _legacy_input_ok[synthesis.input] = ok
+    if _legacy_input_ok[synthesis.input]:
+        return _synthesis_with_input_forward(synthesis, ws, transform, **layer_kwargs)
+    return _synthesis_with_transform_buffer(synthesis, ws, transform, **layer_kwargs)
+
+def _synthesis_with_input_forward(synthesis, ws, transform, **layer_kwargs):
+    synthesis.input.forward = functools.partial(SynthesisInput.forward, synthesis.input, transform=transform)
+    try:
+        return synthesis(ws, **layer_kwargs)
+    finally:
+        del synthesis.input.forward
+
+def _synthesis_with_transform_buffer(synthesis, ws, transform, **layer_kwargs):
+    buf = synthesis.input.transform
+    orig = buf.clone()
+    try:
+        if transform.ndim == 2:
+            buf.copy_(transform)
+            return synthesis(ws, **layer_kwargs)
+        distinct, group = np.unique(transform.flatten(1).cpu().numpy(), axis=0, return_inverse=True)
+        group = group.reshape(-1)
+        img = None
+        for group_idx, m in enumerate(distinct):
+            idx = torch.as_tensor(np.flatnonzero(group == group_idx), device=ws.device)
+            buf.copy_(torch.as_tensor(m.reshape(3, 3)))
+            y = synthesis(ws[idx], **layer_kwargs)
+            img = y.new_empty([ws.shape[0], *y.shape[1:]]) if img is None else img
+            img[idx] = y
+        return img
+    finally:
+        buf.copy_(orig)
+
+#----------------------------------------------------------------------------
@@ -12,7 +12,8 @@ import os
 import time
 import copy
 import json
-import pickle
+import functools
+import collections
 import psutil
 import PIL.Image
 import numpy as np
@@ -26,6 +27,8 @@ from torch_utils.ops import grid_sample_gradfix
 
 import legacy
 from metrics import metric_main
+from metrics import metric_queue
+from training import checkpoint
 
 #----------------------------------------------------------------------------
 
@@ -43,15 +46,12 @@ def setup_snapshot_image_grid(training_set,  snap_res='8k', random_seed=0):
 
     else:
         # Group training samples by label.
-        label_groups = dict() # label => [idx, ...]
-        for idx in range(len(training_set)):
-            label = tuple(training_set.get_details(idx).raw_label.flat[::-1])
-            if label not in label_groups:
-                label_groups[label] = []
-            label_groups[label].append(idx)
+        all_labels = training_set.get_label_tensor().numpy()
+        label_order, label_inverse = np.unique(all_labels[:, ::-1], axis=0, return_inverse=True)
+        label_order = [tuple(label) for label in label_order]
+        label_groups = {label: np.flatnonzero(label_inverse.reshape(-1) == i).tolist() for i, label in enumerate(label_order)} # label => [idx, ...]
 
         # Reorder.
-        label_order = sorted(label_groups.keys())
         for label in label_order:
             rnd.shuffle(label_groups[label])
 
@@ -64,8 +64,70 @@ def setup_snapshot_image_grid(training_set,  snap_res='8k', random_seed=0):
             label_groups[label] = [indices[(i + gw) % len(indices)] for i in range(len(indices))]
 
     # Load data.
-    images, labels = zip(*[training_set[i] for i in grid_indices])
-    return (gw, gh), np.stack(images), np.stack(labels)
+    images, labels, flips = zip(*[training_set[i] for i in grid_indices])
+    images = apply_flips(torch.from_numpy(np.stack(images)), torch.from_numpy(np.stack(flips))).numpy()
+    return (gw, gh), images, np.stack(labels)
+
+#----------------------------------------------------------------------------
+# Apply the x/y-flips deferred by the dataset (defer_flips=True) to a batch
+# of uint8 images in NCHW layout, on whichever device the images live.
+
+def apply_flips(images, flips):
+    if flips[:, 0].any():
+        images = torch.where(flips[:, 0].to(images.device).reshape(-1, 1, 1, 1), images.flip(3), images)
+    if flips[:, 1].any():
+        images = torch.where(flips[:, 1].to(images.device).reshape(-1, 1, 1, 1), images.flip(2), images)
+    return images
+
+#----------------------------------------------------------------------------
+# Device-side collate stage for real images: non-blocking copy of the pinned
+# uint8 batch, batched flips, and in-place conversion to [-1,1] float32.
+
+def prepare_real_images(images, flips, device):
+    images = images.to(device, non_blocking=True)
+    images = apply_flips(images, flips).to(torch.float32)
+    return images.div_(127.5).sub_(1)
+
+#----------------------------------------------------------------------------
+# Keeps a fixed number of future batches staged ahead of the training loop.
+# fetch_fn() is issued on a side stream of the CUDA device so that the
+# host=>device copies and latent/label sampling overlap with the previous
+# iteration. If fetch_fn() draws its random numbers from `generator`,
+# generator_state tracks the state that reproduces the batches not yet
+# returned, for exact resume.
+
+class BatchPrefetcher:
+    def __init__(self, fetch_fn, device, depth=2, generator=None):
+        assert depth >= 1 and device.type == 'cuda'
+        self.fetch_fn = fetch_fn
+        self.device = device
+        self.depth = depth
+        self.generator = generator
+        self.generator_state = generator.get_state() if generator is not None else None
+        self.stream = torch.cuda.Stream(device=device)
+        self.staged = collections.deque() # [(batch, event, generator_state), ...]
+
+    def _stage(self):
+        with torch.cuda.stream(self.stream):
+            batch = self.fetch_fn()
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        state = self.generator.get_state() if self.generator is not None else None
+        self.staged.append((batch, event, state))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self.staged) < self.depth:
+            self._stage()
+        batch, event, self.generator_state = self.staged.popleft()
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(event)
+        for tensor in batch:
+            tensor.record_stream(current_stream) # allocated on the side stream, consumed on the current one
+        self._stage() # overlaps with the work that consumes this batch
+        return batch
 
 #----------------------------------------------------------------------------
 
@@ -98,13 +160,18 @@ def training_loop(
     augment_kwargs          = None,     # Options for augmentation pipeline. None = disable.
     loss_kwargs             = {},       # Options for loss function.
     metrics                 = [],       # Metrics to evaluate during training.
+    metrics_async           = False,    # Hand snapshots to a metric worker instead of evaluating them in the training loop?
+    metrics_device          = None,     # Device for a local metric worker launched by rank 0, e.g. 'cuda:1'. None = rely on an external `calc_metrics.py --watch`.
+    metrics_queue           = 2,        # Max. number of snapshots waiting for the metric worker. Older ones are skipped.
     random_seed             = 0,        # Global random seed.
     num_gpus                = 1,        # Number of GPUs participating in the training.
     rank                    = 0,        # Rank of the current process in [0, num_gpus[.
     batch_size              = 4,        # Total batch size for one training iteration. Can be larger than batch_gpu * num_gpus.
     batch_gpu               = 4,        # Number of samples processed at a time by one GPU.
+    prefetch_batches        = 2,        # Number of future batches to keep staged on the device.
     ema_kimg                = 10,       # Half-life of the exponential moving average (EMA) of generator weights.
     ema_rampup              = 0.05,     # EMA ramp-up coefficient. None = no rampup.
+    ema_interval            = 1,        # How often to update G_ema, measured in training iterations.
     G_reg_interval          = None,     # How often to perform regularization for G? None = disable lazy regularization.
     D_reg_interval          = 16,       # How often to perform regularization for D? None = disable lazy regularization.
     augment_p               = 0,        # Initial value of augmentation probability.
@@ -118,6 +185,9 @@ def training_loop(
     snap_res                = '8k',     # Resolution size of the snapshot grid. Choose between [1080p | 4k | 8k]
     resume_pkl              = None,     # Network pickle to resume training from.
     resume_kimg             = 0,        # First kimg to report when resuming training.
+    resume_state            = None,     # Full training state checkpoint to resume training from exactly. Overrides resume_pkl and resume_kimg.
+    checkpoint_ticks        = None,     # How often to save full training state checkpoints? None = disable.
+    checkpoint_on_sigterm   = False,    # Save a full training state checkpoint and exit upon SIGTERM?
     cudnn_benchmark         = True,     # Enable torch.backends.cudnn.benchmark?
     abort_fn                = None,     # Callback function for determining whether to abort training. Must return consistent results across ranks.
     progress_fn             = None,     # Callback function for updating training progress. Called for all ranks.
@@ -133,11 +203,21 @@ def training_loop(
     conv2d_gradfix.enabled = True                       # Improves training speed.
     grid_sample_gradfix.enabled = True                  # Avoids errors with the augmentation pipe.
 
+    # Load training state.
+    state = None
+    if resume_state is not None:
+        if rank == 0:
+            print(f'Resuming training state from "{resume_state}"')
+        state = checkpoint.load_training_state(resume_state)
+
     # Load training set.
     if rank == 0:
         print('Loading training set...')
-    training_set = dnnlib.util.construct_class_by_name(**training_set_kwargs) # subclass of training.dataset.Dataset
-    training_set_sampler = misc.InfiniteSampler(dataset=training_set, rank=rank, num_replicas=num_gpus, seed=random_seed)
+    training_set = dnnlib.util.construct_class_by_name(**training_set_kwargs, defer_flips=True) # subclass of training.dataset.Dataset
+    sampler_idx = state['progress']['sampler_idx'] if state is not None else 0 # Position in the global index stream.
+    training_set_sampler = misc.InfiniteSampler(dataset=training_set, rank=rank, num_replicas=num_gpus, seed=random_seed, start_idx=sampler_idx)
+    if state is not None:
+        training_set_sampler.load_state_dict(state['sampler'])
     training_set_iterator = iter(torch.utils.data.DataLoader(dataset=training_set, sampler=training_set_sampler, batch_size=batch_size//num_gpus, **data_loader_kwargs))
     if rank == 0:
         print()
@@ -179,6 +259,14 @@ def training_loop(
         augment_pipe.p.copy_(torch.as_tensor(augment_p))
         if ada_target is not None:
             ada_stats = training_stats.Collector(regex='Loss/signs/real')
+            if (state is not None) and (state.get('ada_stats', None) is not None):
+                ada_stats.load_state_dict(state['ada_stats'])
+
+    # Resume networks from training state.
+    if (state is not None) and (rank == 0):
+        for name, module in [('G', G), ('D', D), ('G_ema', G_ema), ('augment_pipe', augment_pipe)]:
+            if module is not None:
+                module.load_state_dict(state['modules'][name])
 
     # Distribute across GPUs.
     if rank == 0:
@@ -193,18 +281,25 @@ def training_loop(
         print('Setting up training phases...')
     loss = dnnlib.util.construct_class_by_name(device=device, G=G, D=D, augment_pipe=augment_pipe, **loss_kwargs) # subclass of training.loss.Loss
     phases = []
+    optimizers = dict()
     for name, module, opt_kwargs, reg_interval in [('G', G, G_opt_kwargs, G_reg_interval), ('D', D, D_opt_kwargs, D_reg_interval)]:
+        reducer = misc.GradientReducer(module.parameters(), num_gpus=num_gpus)
         if reg_interval is None:
             opt = dnnlib.util.construct_class_by_name(params=module.parameters(), **opt_kwargs) # subclass of torch.optim.Optimizer
-            phases += [dnnlib.EasyDict(name=name+'both', module=module, opt=opt, interval=1)]
+            phases += [dnnlib.EasyDict(name=name+'both', module=module, opt=opt, reducer=reducer, interval=1)]
         else: # Lazy regularization.
             mb_ratio = reg_interval / (reg_interval + 1)
             opt_kwargs = dnnlib.EasyDict(opt_kwargs)
             opt_kwargs.lr = opt_kwargs.lr * mb_ratio
             opt_kwargs.betas = [beta ** mb_ratio for beta in opt_kwargs.betas]
             opt = dnnlib.util.construct_class_by_name(module.parameters(), **opt_kwargs) # subclass of torch.optim.Optimizer
-            phases += [dnnlib.EasyDict(name=name+'main', module=module, opt=opt, interval=1)]
-            phases += [dnnlib.EasyDict(name=name+'reg', module=module, opt=opt, interval=reg_interval)]
+            phases += [dnnlib.EasyDict(name=name+'main', module=module, opt=opt, reducer=reducer, interval=1)]
+            phases += [dnnlib.EasyDict(name=name+'reg', module=module, opt=opt, reducer=reducer, interval=reg_interval)]
+        optimizers[name] = opt
+    if state is not None:
+        for name, opt in optimizers.items():
+            opt.load_state_dict(state['optimizers'][name])
+        loss.load_state_dict(state['loss'])
     for phase in phases:
         phase.start_event = None
         phase.end_event = None
@@ -231,6 +326,11 @@ def training_loop(
     # Initialize logs.
     if rank == 0:
         print('Initializing logs...')
+    snapshot_writer = checkpoint.SnapshotWriter()
+    metric_worker = None
+    if (rank == 0) and metrics_async and (len(metrics) > 0) and (metrics_device is not None):
+        print(f'Launching metric worker on {metrics_device}...')
+        metric_worker = metric_queue.launch_worker(run_dir=run_dir, device=metrics_device)
     stats_collector = training_stats.Collector(regex='.*')
     stats_metrics = dict()
     stats_jsonl = None
@@ -243,29 +343,55 @@ def training_loop(
         except ImportError as err:
             print('Skipping tfevents export:', err)
 
+    # Setup G_ema updates.
+    ema_params, G_params = list(G_ema.parameters()), list(G.parameters())
+    ema_buffers, G_buffers = list(G_ema.buffers()), list(G.buffers())
+
+    # Setup data prefetching.
+    data_generator = torch.Generator(device=device)
+    data_generator.manual_seed(random_seed * num_gpus + rank)
+    if state is not None:
+        if len(state['rng']['torch']) == num_gpus:
+            data_generator.set_state(checkpoint.set_rng_states(state['rng'], rank=rank, device=device))
+        elif rank == 0:
+            print(f'Not restoring random number generator states saved with {len(state["rng"]["torch"])} GPUs')
+    def fetch_batch():
+        real_img, real_c, real_flips = next(training_set_iterator)
+        real_img = prepare_real_images(real_img, real_flips, device)
+        real_c = real_c.to(device, non_blocking=True)
+        gen_z = torch.randn([len(phases) * batch_size, G.z_dim], device=device, generator=data_generator)
+        gen_c = training_set.sample_labels(len(phases) * batch_size, generator=data_generator)
+        return real_img, real_c, gen_z, gen_c
+    prefetcher = BatchPrefetcher(fetch_fn=fetch_batch, device=device, depth=prefetch_batches, generator=data_generator)
+    sigterm_flag = checkpoint.SignalFlag() if checkpoint_on_sigterm else None
+
     # Train.
     if rank == 0:
         print(f'Training for {total_kimg} kimg...')
         print()
     cur_nimg = resume_kimg * 1000
     cur_tick = 0
+    batch_idx = 0
+    if state is not None:
+        cur_nimg = state['progress']['cur_nimg']
+        cur_tick = state['progress']['cur_tick']
+        batch_idx = state['progress']['batch_idx']
+    del state # conserve memory
     tick_start_nimg = cur_nimg
     tick_start_time = time.time()
     maintenance_time = tick_start_time - start_time
-    batch_idx = 0
+    preempted = False
+    preempt_check = None # (host flag, event) of the all-reduce issued in the previous iteration
     if progress_fn is not None:
         progress_fn(0, total_kimg)
     while True:
 
         # Fetch training data.
         with torch.autograd.profiler.record_function('data_fetch'):
-            phase_real_img, phase_real_c = next(training_set_iterator)
-            phase_real_img = (phase_real_img.to(device).to(torch.float32) / 127.5 - 1).split(batch_gpu)
-            phase_real_c = phase_real_c.to(device).split(batch_gpu)
-            all_gen_z = torch.randn([len(phases) * batch_size, G.z_dim], device=device)
+            phase_real_img, phase_real_c, all_gen_z, all_gen_c = next(prefetcher)
+            phase_real_img = phase_real_img.split(batch_gpu)
+            phase_real_c = phase_real_c.split(batch_gpu)
             all_gen_z = [phase_gen_z.split(batch_gpu) for phase_gen_z in all_gen_z.split(batch_size)]
-            all_gen_c = [training_set.get_label(np.random.randint(len(training_set))) for _ in range(len(phases) * batch_size)]
-            all_gen_c = torch.from_numpy(np.stack(all_gen_c)).pin_memory().to(device)
             all_gen_c = [phase_gen_c.split(batch_gpu) for phase_gen_c in all_gen_c.split(batch_size)]
 
         # Execute training phases.
@@ -275,25 +401,18 @@ def training_loop(
             if phase.start_event is not None:
                 phase.start_event.record(torch.cuda.current_stream(device))
 
-            # Accumulate gradients.
+            # Accumulate gradients, reducing them across GPUs during the last round.
             phase.opt.zero_grad(set_to_none=True)
             phase.module.requires_grad_(True)
-            for real_img, real_c, gen_z, gen_c in zip(phase_real_img, phase_real_c, phase_gen_z, phase_gen_c):
+            rounds = list(zip(phase_real_img, phase_real_c, phase_gen_z, phase_gen_c))
+            for round_idx, (real_img, real_c, gen_z, gen_c) in enumerate(rounds):
+                phase.reducer.begin(key=phase.name, final=(round_idx == len(rounds) - 1))
                 loss.accumulate_gradients(phase=phase.name, real_img=real_img, real_c=real_c, gen_z=gen_z, gen_c=gen_c, gain=phase.interval, cur_nimg=cur_nimg)
             phase.module.requires_grad_(False)
 
             # Update weights.
             with torch.autograd.profiler.record_function(phase.name + '_opt'):
-                params = [param for param in phase.module.parameters() if param.grad is not None]
-                if len(params) > 0:
-                    flat = torch.cat([param.grad.flatten() for param in params])
-                    if num_gpus > 1:
-                        torch.distributed.all_reduce(flat)
-                        flat /= num_gpus
-                    misc.nan_to_num(flat, nan=0, posinf=1e5, neginf=-1e5, out=flat)
-                    grads = flat.split([param.numel() for param in params])
-                    for param, grad in zip(params, grads):
-                        param.grad = grad.reshape(param.shape)
+                phase.reducer.finish()
                 phase.opt.step()
 
             # Phase done.
@@ -301,18 +420,18 @@ def training_loop(
                 phase.end_event.record(torch.cuda.current_stream(device))
 
         # Update G_ema.
-        with torch.autograd.profiler.record_function('Gema'):
-            ema_nimg = ema_kimg * 1000
-            if ema_rampup is not None:
-                ema_nimg = min(ema_nimg, cur_nimg * ema_rampup)
-            ema_beta = 0.5 ** (batch_size / max(ema_nimg, 1e-8))
-            for p_ema, p in zip(G_ema.parameters(), G.parameters()):
-                p_ema.copy_(p.lerp(p_ema, ema_beta))
-            for b_ema, b in zip(G_ema.buffers(), G.buffers()):
-                b_ema.copy_(b)
+        if batch_idx % ema_interval == 0:
+            with torch.autograd.profiler.record_function('Gema'):
+                ema_nimg = ema_kimg * 1000
+                if ema_rampup is not None:
+                    ema_nimg = min(ema_nimg, cur_nimg * ema_rampup)
+                ema_beta = 0.5 ** (batch_size * ema_interval / max(ema_nimg, 1e-8))
+                misc.lerp_multi_(ema_params, G_params, 1 - ema_beta)
+                misc.copy_multi_(ema_buffers, G_buffers)
 
         # Update state.
         cur_nimg += batch_size
+        sampler_idx += batch_size
         batch_idx += 1
 
         # Execute ADA heuristic.
@@ -321,8 +440,25 @@ def training_loop(
             adjust = np.sign(ada_stats['Loss/signs/real'] - ada_target) * (batch_size * ada_interval) / (ada_kimg * 1000)
             augment_pipe.p.copy_((augment_pipe.p + adjust).max(misc.constant(0, device=device)))
 
+        # Check for preemption. With multiple GPUs, the ranks must agree: the flags are all-reduced without
+        # blocking, and every rank reads the result one iteration later, so it only waits for that iteration.
+        if sigterm_flag is not None:
+            if num_gpus == 1:
+                preempted = sigterm_flag.received
+            else:
+                if preempt_check is not None:
+                    host_flag, event = preempt_check
+                    event.synchronize()
+                    preempted = (float(host_flag) != 0)
+                flag = torch.full([], float(sigterm_flag.received), device=device)
+                torch.distributed.all_reduce(flag)
+                host_flag = torch.empty([], pin_memory=True).copy_(flag, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(torch.cuda.current_stream(device))
+                preempt_check = (host_flag, event)
+
         # Perform maintenance tasks once per tick.
-        done = (cur_nimg >= total_kimg * 1000)
+        done = (cur_nimg >= total_kimg * 1000) or preempted
         if (not done) and (cur_tick != 0) and (cur_nimg < tick_start_nimg + kimg_per_tick * 1000):
             continue
 
@@ -352,6 +488,28 @@ def training_loop(
                 print()
                 print('Aborting...')
 
+        # Save training state checkpoint.
+        if (checkpoint_ticks is not None and (done or cur_tick % checkpoint_ticks == 0)) or preempted:
+            state = dict(
+                progress    = dict(cur_nimg=cur_nimg, cur_tick=cur_tick+1, batch_idx=batch_idx, sampler_idx=sampler_idx),
+                sampler     = training_set_sampler.state_dict(sampler_idx),
+                modules     = {name: module.state_dict() for name, module in [('G', G), ('D', D), ('G_ema', G_ema), ('augment_pipe', augment_pipe)] if module is not None},
+                optimizers  = {name: opt.state_dict() for name, opt in optimizers.items()},
+                loss        = loss.state_dict(),
+                ada_stats   = ada_stats.state_dict() if ada_stats is not None else None,
+                rng         = checkpoint.get_rng_states(prefetcher.generator_state, num_gpus=num_gpus, device=device),
+            )
+            state = checkpoint.copy_to_host(state)
+            if rank == 0:
+                snapshot_writer.write_state(os.path.join(run_dir, 'training-state.pt'), state)
+            del state # conserve memory
+            if preempted:
+                snapshot_writer.wait()
+                if rank == 0:
+                    print()
+                    print('Training state saved; exiting due to preemption...')
+                break
+
         # Save image snapshot.
         if (rank == 0) and (image_snapshot_ticks is not None) and (done or cur_tick % image_snapshot_ticks == 0):
             images = torch.cat([G_ema(z=z, c=c, noise_mode='const').cpu() for z, c in zip(grid_z, grid_c)]).numpy()
@@ -364,31 +522,30 @@ def training_loop(
         snapshot_pkl = None
         snapshot_data = None
         if (network_snapshot_ticks is not None) and (done or cur_tick % network_snapshot_ticks == 0):
-            snapshot_data = dict(G=G, D=D, G_ema=G_ema, augment_pipe=augment_pipe, training_set_kwargs=dict(training_set_kwargs))
-            for key, value in snapshot_data.items():
-                if isinstance(value, torch.nn.Module):
-                    value = copy.deepcopy(value).eval().requires_grad_(False)
-                    if num_gpus > 1:
-                        misc.check_ddp_consistency(value, ignore_regex=r'.*\.[^.]+_(avg|ema)')
-                        for param in misc.params_and_buffers(value):
-                            torch.distributed.broadcast(param, src=0)
-                    snapshot_data[key] = value.cpu()
-                del value # conserve memory
+            snapshot_modules = dict(G=G, D=D, G_ema=G_ema, augment_pipe=augment_pipe)
+            if num_gpus > 1:
+                for module in snapshot_modules.values():
+                    if module is not None:
+                        misc.check_ddp_consistency(module, ignore_regex=r'.*\.[^.]+_(avg|ema)')
+            snapshot_data = snapshot_writer.capture(snapshot_modules, num_gpus=num_gpus) # waits for the previous write, if any
+            snapshot_data['training_set_kwargs'] = dict(training_set_kwargs)
             snapshot_pkl = os.path.join(run_dir, f'network-snapshot-{cur_nimg//1000:06d}.pkl')
             if rank == 0:
-                with open(snapshot_pkl, 'wb') as f:
-                    pickle.dump(snapshot_data, f)
+                on_done = None
+                if metrics_async and len(metrics) > 0:
+                    on_done = functools.partial(metric_queue.enqueue_snapshot, run_dir=run_dir, snapshot_pkl=snapshot_pkl, metrics=metrics, kimg=cur_nimg//1000, max_pending=metrics_queue)
+                snapshot_writer.write(snapshot_pkl, snapshot_data, on_done=on_done)
 
         # Evaluate metrics.
-        if (snapshot_data is not None) and (len(metrics) > 0):
+        if (snapshot_data is not None) and (len(metrics) > 0) and (not metrics_async):
             if rank == 0:
                 print('Evaluating metrics...')
-            for metric in metrics:
-                result_dict = metric_main.calc_metric(metric=metric, G=snapshot_data['G_ema'],
-                    dataset_kwargs=training_set_kwargs, num_gpus=num_gpus, rank=rank, device=device)
-                if rank == 0:
-                    metric_main.report_metric(result_dict, run_dir=run_dir, snapshot_pkl=snapshot_pkl)
-                stats_metrics.update(result_dict.results)
+            with checkpoint.preserve_rng_states(device=device): # the training state checkpoint was captured before
+                for result_dict in metric_main.calc_metrics(metrics=metrics, G=snapshot_data['G_ema'],
+                        dataset_kwargs=training_set_kwargs, num_gpus=num_gpus, rank=rank, device=device):
+                    if rank == 0:
+                        metric_main.report_metric(result_dict, run_dir=run_dir, snapshot_pkl=snapshot_pkl)
+                    stats_metrics.update(result_dict.results)
         del snapshot_data # conserve memory
 
         # Collect statistics.
@@ -427,6 +584,12 @@ def training_loop(
             break
 
     # Done.
+    snapshot_writer.wait()
+    if (rank == 0) and metrics_async and (len(metrics) > 0):
+        metric_queue.enqueue_done(run_dir)
+    if metric_worker is not None:
+        print('Waiting for the metric worker to evaluate the remaining snapshots...')
+        metric_worker.wait()
     if rank == 0:
         print()
         print('Exiting...')